@@ -5,6 +5,7 @@ test for competition creation via api
 import sys
 import os
 import json
+import mock
 from django.utils import timezone
 
 # This is a really, really long way around saying that if the script is in
@@ -24,7 +25,9 @@ importer.install()
 
 from django.contrib.auth import get_user_model
 from django.core import mail
+from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from apps.web.models import *
 
@@ -308,3 +311,94 @@ class CompetitionPublishTests(TestCase):
         resp = self.client.get(reverse("competition-publish", kwargs={"pk": self.competition.pk}))
 
         self.assertEquals(resp.status_code, 200)
+
+
+from apps.web.tests.test_leaderboard import LeaderboardTestCase
+
+
+class PhaseLeaderboardRanksApiTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(PhaseLeaderboardRanksApiTests, self).setUp()
+        self.submissions = []
+        for i in range(10):
+            submission = self.add_submission("user%d" % i, {self.accuracy: 1.0 - i * 0.05, self.error: i * 0.05})
+            self.add_entry(submission)
+            self.submissions.append(submission)
+        self.url = reverse('api_phase_leaderboard_ranks',
+                           kwargs={'competition_id': self.competition.pk, 'phase_id': self.phase.pk})
+
+    def get(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(200, response.status_code)
+        return json.loads(response.content)
+
+    def test_top_k(self):
+        data = self.get(limit=3)
+        self.assertEqual(10, data['count'])
+        self.assertEqual("avg", data['selection_key'])
+        self.assertEqual([1, 2, 3], [entry['rank'] for entry in data['entries']])
+        self.assertEqual(["user0", "user1", "user2"], [entry['username'] for entry in data['entries']])
+        self.assertEqual(self.submissions[0].pk, data['entries'][0]['submission_id'])
+
+    def test_offset(self):
+        data = self.get(limit=4, offset=8)
+        self.assertEqual([9, 10], [entry['position'] for entry in data['entries']])
+
+    def test_around_participant(self):
+        participant = self.submissions[6].participant
+        data = self.get(limit=3, participant=participant.pk)
+        self.assertEqual(["user5", "user6", "user7"], [entry['username'] for entry in data['entries']])
+
+    def test_around_me(self):
+        self.client.login(username="user0", password="pass")
+        data = self.get(limit=3, participant='me')
+        self.assertEqual(0, data['offset'])
+        self.assertEqual("user0", data['entries'][0]['username'])
+
+    def test_participant_not_on_leaderboard(self):
+        response = self.client.get(self.url, {'participant': 'me'})
+        self.assertEqual(404, response.status_code)
+
+    def test_invalid_limit(self):
+        self.assertEqual(400, self.client.get(self.url, {'limit': 'x'}).status_code)
+
+    def test_blind_phase_hidden_from_participants(self):
+        self.phase.leaderboard_management_mode = LeaderboardManagementMode.HIDE_RESULTS
+        self.phase.save()
+        self.assertEqual(403, self.client.get(self.url).status_code)
+        self.client.login(username="organizer", password="pass")
+        self.assertEqual(200, self.client.get(self.url).status_code)
+
+    def test_fixed_query_count(self):
+        self.phase.leaderboard_snapshot()
+        # phase, snapshots, entries fingerprint, count and page
+        with self.assertNumQueries(5):
+            self.get(limit=5)
+
+
+class SubmissionLeaderboardApiTests(LeaderboardTestCase):
+
+    def test_add_returns_rank(self):
+        self.add_entry(self.add_submission("first", {self.accuracy: 0.9, self.error: 0.1}))
+        submission = self.add_submission("second", {self.accuracy: 0.95, self.error: 0.05})
+        self.client.login(username="second", password="pass")
+        url = reverse('api_competition_submission_leaderboard',
+                      kwargs={'competition_id': self.competition.pk, 'pk': submission.pk})
+        response = self.client.post(url)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(1, json.loads(response.content)['rank'])
+
+
+class BlobSasUrlTests(TestCase):
+
+    @override_settings(BUNDLE_AZURE_ACCOUNT_NAME='account', BUNDLE_AZURE_ACCOUNT_KEY='key',
+                       BUNDLE_AZURE_CONTAINER='bundles')
+    def test_storage_without_upload_url(self):
+        from apps.api import views
+        with mock.patch.object(views.webmodels, 'BundleStorage', object()):
+            with mock.patch.object(views, 'make_blob_sas_url', return_value='https://sas') as make_url:
+                data = views._generate_blob_sas_url('competition/upload/1', '.zip')
+        self.assertEqual('https://sas', data['url'])
+        self.assertEqual(('account', 'key', 'bundles', data['id']), make_url.call_args[0])
+        self.assertTrue(data['id'].startswith('competition/upload/1/'))
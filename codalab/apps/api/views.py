@@ -29,6 +29,7 @@ from apps.authenz.models import ClUser
 from apps.jobs.models import Job
 from apps.web import models as webmodels
 from apps.web.bundles import BundleService
+from apps.web.leaderboard import submission_rank
 from apps.web.tasks import (create_competition, evaluate_submission)
 
 from codalab.azure_storage import make_blob_sas_url, PREFERRED_STORAGE_X_MS_VERSION
@@ -40,11 +41,15 @@ def _generate_blob_sas_url(prefix, extension):
     Helper to generate SAS URL for creating a BLOB.
     """
     blob_name = '{0}/{1}{2}'.format(prefix, str(uuid4()), extension)
-    url = make_blob_sas_url(settings.BUNDLE_AZURE_ACCOUNT_NAME,
-                            settings.BUNDLE_AZURE_ACCOUNT_KEY,
-                            settings.BUNDLE_AZURE_CONTAINER,
-                            blob_name,
-                            duration=60)
+    if hasattr(webmodels.BundleStorage, 'upload_url'):
+        url = webmodels.BundleStorage.upload_url(blob_name, duration=60)
+    else:
+        # Storages other than AzureStorage and LocalStorage: sign for the bundle account.
+        url = make_blob_sas_url(settings.BUNDLE_AZURE_ACCOUNT_NAME,
+                                settings.BUNDLE_AZURE_ACCOUNT_KEY,
+                                settings.BUNDLE_AZURE_CONTAINER,
+                                blob_name,
+                                duration=60)
     logger.debug("_generate_blob_sas_url: sas=%s; blob_name=%s.", url, blob_name)
     return {'url': url, 'id': blob_name, 'version': PREFERRED_STORAGE_X_MS_VERSION}
 
@@ -509,6 +514,7 @@ class CompetitionSubmissionViewSet(viewsets.ModelViewSet):
         if len(blob_name) <= 0:
             raise ParseError(detail='Invalid or missing tracking ID.')
         obj.file.name = blob_name
+        obj.original_filename = self.request.DATA.get('name', '')[:256]
 
     def post_save(self, obj, created):
         if created:
@@ -539,6 +545,7 @@ class CompetitionSubmissionViewSet(viewsets.ModelViewSet):
         lb = webmodels.PhaseLeaderBoard.objects.get(phase=submission.phase)
         lbe = webmodels.PhaseLeaderBoardEntry.objects.get(board=lb, result=submission)
         lbe.delete()
+        webmodels.update_leaderboard_snapshot(submission.phase)
         response['status'] = lbe.id
         return Response(response, status=response['status'], content_type="application/json")
 
@@ -561,6 +568,7 @@ class CompetitionSubmissionViewSet(viewsets.ModelViewSet):
         response = dict()
         _, cr = webmodels.add_submission_to_leaderboard(submission)
         response['status'] = (201 if cr else 200)
+        response['rank'] = submission_rank(submission)
         return Response(response, status=response['status'], content_type="application/json")
 
 competition_submission_retrieve = CompetitionSubmissionViewSet.as_view({'get':'retrieve'})
@@ -585,6 +593,75 @@ class LeaderBoardViewSet(viewsets.ModelViewSet):
 leaderboard_list = LeaderBoardViewSet.as_view({'get':'list', 'post':'create'})
 leaderboard_retrieve = LeaderBoardViewSet.as_view({'get':'retrieve', 'put':'update', 'patch':'partial_update'})
 
+class PhaseLeaderboardRanksApi(views.APIView):
+    """
+    Provides a web API to read a page of the ranked leaderboard of a phase. The page is read from
+    the leaderboard snapshot, in rank order, without touching blob storage.
+
+    Query parameters:
+        group: Ordering of the result group to read (default: 1, the first group).
+        limit: Number of entries to return (default: 50, at most 500).
+        offset: Number of entries to skip from the top (default: 0).
+        participant: Id of a participant, or 'me', to center the page on the participant's entry
+            instead of using the offset.
+    """
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 500
+
+    @staticmethod
+    def _get_int(request, name, default, minimum):
+        value = request.QUERY_PARAMS.get(name, default)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise ParseError(detail='Invalid value for %s.' % name)
+        if value < minimum:
+            raise ParseError(detail='Invalid value for %s.' % name)
+        return value
+
+    def get(self, request, competition_id, phase_id):
+        try:
+            phase = webmodels.CompetitionPhase.objects.select_related('competition').get(
+                pk=phase_id, competition__pk=competition_id)
+        except ObjectDoesNotExist:
+            raise Http404()
+        if phase.is_blind and request.user.id != phase.competition.creator_id:
+            raise PermissionDenied(detail='Competition phase does not show results to participants.')
+
+        group = self._get_int(request, 'group', 1, 1)
+        limit = min(self._get_int(request, 'limit', self.DEFAULT_LIMIT, 1), self.MAX_LIMIT)
+        offset = self._get_int(request, 'offset', 0, 0)
+        snapshots = phase.leaderboard_snapshot()
+        if group > len(snapshots):
+            raise Http404()
+        snapshot = snapshots[group - 1]
+
+        participant = request.QUERY_PARAMS.get('participant', None)
+        if participant is not None:
+            qs = webmodels.CompetitionParticipant.objects.filter(competition__pk=competition_id)
+            if participant == 'me':
+                qs = qs.filter(user__pk=request.user.id)
+            else:
+                qs = qs.filter(pk=self._get_int(request, 'participant', None, 1))
+            participant_ids = list(qs.values_list('id', flat=True))
+            position = snapshot.position_of(participant_ids[0]) if len(participant_ids) > 0 else None
+            if position is None:
+                raise Http404()
+            offset = max(0, position - 1 - limit // 2)
+
+        logger.debug("PhaseLeaderboardRanksApi: phase_id=%s, group=%s, offset=%s, limit=%s.",
+                     phase_id, group, offset, limit)
+        return Response({
+            'phase': phase.pk,
+            'group': snapshot.label,
+            'headers': snapshot.headers,
+            'selection_key': snapshot.selection_key,
+            'count': snapshot.entries.count(),
+            'offset': offset,
+            'limit': limit,
+            'entries': snapshot.page(offset, limit),
+        })
+
 class DefaultContentViewSet(viewsets.ModelViewSet):
     queryset = webmodels.DefaultContentItem.objects.all()
     serializer_class = serializers.DefaultContentSerial
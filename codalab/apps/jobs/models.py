@@ -5,7 +5,8 @@ import json
 import logging
 import threading
 
-from codalabtools.azure_extensions import AzureServiceBusQueue
+from codalabtools.azure_extensions import AzureServiceBusQueue, AzureServiceBusTopic
+from codalabtools.local_queue import SQLiteQueue
 from django.conf import settings
 from django.db import (models,
                        transaction)
@@ -16,6 +17,14 @@ logger = logging.getLogger(__name__)
 
 _lock = threading.Lock()
 _queues = {}
+_topics = {}
+
+def _local_queue_path():
+    """
+    Returns the path of the SQLite database holding the queues when Service Bus is replaced
+    by a local queue (single node deployments), None otherwise.
+    """
+    return getattr(settings, 'SBS_LOCAL_QUEUE_PATH', None)
 
 def getQueue(name=None):
     """
@@ -28,14 +37,38 @@ def getQueue(name=None):
 
     queue = None
     with _lock:
-        queue = AzureServiceBusQueue(settings.SBS_NAMESPACE,
-                                     settings.SBS_ACCOUNT_KEY,
-                                     settings.SBS_ISSUER,
-                                     name)
+        if _local_queue_path() is not None:
+            queue = SQLiteQueue(_local_queue_path(), name)
+        else:
+            queue = AzureServiceBusQueue(settings.SBS_NAMESPACE,
+                                         settings.SBS_ACCOUNT_KEY,
+                                         settings.SBS_ISSUER,
+                                         name)
         _queues[name] = queue
 
     return queue
 
+def getTopic(name):
+    """
+    Returns a Queue sending messages to the Service Bus topic with the given name. With a
+    local queue, the topic is a queue of the same name read by the single subscriber.
+    """
+    if name in _topics:
+        return _topics[name]
+
+    topic = None
+    with _lock:
+        if _local_queue_path() is not None:
+            topic = SQLiteQueue(_local_queue_path(), name)
+        else:
+            topic = AzureServiceBusTopic(settings.SBS_NAMESPACE,
+                                         settings.SBS_ACCOUNT_KEY,
+                                         settings.SBS_ISSUER,
+                                         name)
+        _topics[name] = topic
+
+    return topic
+
 # Jobs
 
 class JobManager(models.Manager):
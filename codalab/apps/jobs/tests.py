@@ -3,13 +3,18 @@ Defines unit tests for this Django app.
 """
 import json
 import logging
+import os
+import shutil
+import tempfile
 import time
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils import timezone
 
 from apps.jobs import models
 from apps.jobs.models import Job, run_job_task, JobTaskResult
+from codalabtools.local_queue import SQLiteQueue
 
 class JobsTests(TestCase):
     """
@@ -228,3 +233,27 @@ class JobsTests(TestCase):
         self.assertEqual(j.status, Job.FINISHED)
         self.assertDictEqual(j.get_task_info(), info2)
         job.delete()
+
+class LocalQueueTests(TestCase):
+    """
+    Tests for queues backed by a local SQLite database.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'queues.sqlite')
+
+    def tearDown(self):
+        models._queues.clear()
+        models._topics.clear()
+        shutil.rmtree(self.root)
+
+    def test_get_queue(self):
+        """getQueue and getTopic return local queues when SBS_LOCAL_QUEUE_PATH is set."""
+        with override_settings(SBS_LOCAL_QUEUE_PATH=self.path, SBS_RESPONSE_QUEUE='response'):
+            queue = models.getQueue()
+            self.assertIsInstance(queue, SQLiteQueue)
+            self.assertIsInstance(models.getTopic('assets'), SQLiteQueue)
+            queue.send_message('hello')
+        # Another process using the same database receives the message.
+        msg = SQLiteQueue(self.path, 'response').receive_message()
+        self.assertEqual('hello', msg.get_body())
@@ -0,0 +1,624 @@
+"""
+Loading of the scores behind the leaderboard of a phase.
+
+The leaderboard schema of a competition (result groups, columns, sort directions, number
+formats and computed score dependencies) is static once the competition is created. It is
+compiled with values_list in a fixed number of queries and kept in a bounded in-process LRU
+cache, which is invalidated when the competition is edited or its schema rows change. Other
+processes see the invalidation through a version stamp kept in the leaderboard cache. The
+cached leaderboards and the leaderboard snapshots of the phases of the competition are
+dropped at the same time, since their columns, order and formatting follow the schema.
+
+Loading the leaderboard of a phase then costs two more queries, whatever the number of
+result groups, columns or submissions:
+
+    1. the leaderboard entries (submission id, username);
+    2. the score values, if there are entries.
+
+Score values are returned as a dense (submission x scoredef) float matrix, along with the
+stored Decimal values which are used for display and to tell ties apart exactly.
+
+For rank queries on a single submission ("your rank is N"), a PhaseRankIndex keeps one
+RankIndex per column of a phase. It is built lazily from the loaded scores and kept in a
+bounded in-process cache. Every change of the leaderboard entries or of the scores of the
+submissions on the leaderboard increments the version of the leaderboard of the phase in the
+leaderboard cache; changes made in this process are applied to the cached index, which then
+follows the version. A cached index is only used while the version and the leaderboard
+entries of the phase (their count and highest id) are those it was built from, so changes
+made by other processes cause a rebuild. The rank index also gives the ranked rows of each
+result group, from which the leaderboard snapshot is updated without loading every score.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.web import leaderboard_cache
+from apps.web.models import (CompetitionPhase,
+                             PhaseLeaderBoard,
+                             PhaseLeaderBoardEntry,
+                             PhaseLeaderBoardSnapshot,
+                             SubmissionComputedScore,
+                             SubmissionComputedScoreField,
+                             SubmissionResultGroup,
+                             SubmissionResultGroupPhase,
+                             SubmissionScore,
+                             SubmissionScoreDef,
+                             SubmissionScoreDefGroup,
+                             SubmissionScoreSet)
+from apps.web.ranking import RankIndex, average_ranks, order_by_rank, rank_column
+
+ScoreDefInfo = namedtuple('ScoreDefInfo', ['id', 'key', 'sorting', 'numeric_format', 'show_rank',
+                                           'selection_default', 'computed'])
+
+ScoreSetInfo = namedtuple('ScoreSetInfo', ['key', 'label', 'ordering',
+                                           'parent_key', 'parent_label', 'parent_ordering',
+                                           'scoredef_id'])
+
+logger = logging.getLogger(__name__)
+
+
+class ResultGroupScores(object):
+    """
+    Columns of one result group of a leaderboard.
+
+    id: Id of the SubmissionResultGroup.
+    label: Label of the group.
+    phase_ids: Ids of the phases showing the group.
+    scoresets: ScoreSetInfo tuples of the group, in tree order.
+    """
+    def __init__(self, id, label):
+        self.id = id
+        self.label = label
+        self.phase_ids = set()
+        self.scoresets = []
+
+    @property
+    def scoredef_ids(self):
+        return [x.scoredef_id for x in self.scoresets]
+
+
+class CompetitionSchema(object):
+    """
+    Compiled leaderboard schema of a competition.
+
+    competition_id: Id of the Competition.
+    groups: ResultGroupScores of the competition, ordered.
+    scoredefs: Maps a scoredef id to a ScoreDefInfo, for every scoredef of the competition.
+    operations: Maps the id of a computed scoredef to its operation name ('Avg', 'Max').
+    computed_deps: Maps the id of a computed scoredef to the ids of its input scoredefs.
+    """
+    def __init__(self, competition_id, groups, scoredefs, operations, computed_deps):
+        self.competition_id = competition_id
+        self.groups = groups
+        self.scoredefs = scoredefs
+        self.operations = operations
+        self.computed_deps = computed_deps
+        self.keys = dict((sdef.key, sdef.id) for sdef in scoredefs.itervalues())
+
+    def phase_groups(self, phase_id):
+        """ Returns the result groups shown in the given phase. """
+        return [g for g in self.groups if phase_id in g.phase_ids]
+
+
+class PhaseScores(object):
+    """
+    Scores of the submissions on the leaderboard of a phase.
+
+    submission_ids: Ids of the submissions on the leaderboard, one per row.
+    usernames: Username of the participant behind each submission.
+    groups: ResultGroupScores of the phase, ordered.
+    scoredefs: Maps a scoredef id to a ScoreDefInfo. Includes the inputs of computed scores.
+    operations: Maps the id of a computed scoredef to its operation name ('Avg', 'Max').
+    computed_deps: Maps the id of a computed scoredef to the ids of its input scoredefs.
+    columns: Ids of the non-computed scoredefs, one per column of values.
+    values: Float array of shape (submissions, columns).
+    present: Boolean array of the same shape telling which values are known.
+    stored: Object array of the same shape holding the stored Decimal values, or None.
+    """
+    def __init__(self, submission_ids, usernames, groups, scoredefs, operations, computed_deps,
+                 columns, values, present, stored):
+        self.submission_ids = submission_ids
+        self.usernames = usernames
+        self.groups = groups
+        self.scoredefs = scoredefs
+        self.operations = operations
+        self.computed_deps = computed_deps
+        self.columns = columns
+        self.column_of = dict((sdef_id, j) for j, sdef_id in enumerate(columns))
+        self.values = values
+        self.present = present
+        self.stored = stored
+
+    def rank_keys(self):
+        """
+        Returns a float array ordered exactly as the stored values, for ranking. Each value is
+        replaced by its index among the distinct values of its column: Decimals with more
+        significant digits than a float holds would otherwise collapse into false ties.
+        Stored values have at most 10 decimal places, so distinct values never tie under eps.
+        """
+        keys = np.zeros(self.values.shape)
+        for j in range(len(self.columns)):
+            rows = self.present[:, j]
+            if rows.any():
+                keys[rows, j] = np.unique(self.stored[rows, j], return_inverse=True)[1]
+        return keys
+
+    def sort_ascending(self):
+        """ Returns a boolean array telling, for each column, whether lower values rank first. """
+        return np.array([self.scoredefs[sdef_id].sorting == 'asc' for sdef_id in self.columns], dtype=bool)
+
+
+def compile_schema(competition_id, **kwargs):
+    """
+    Reads the leaderboard schema of a competition from the database.
+
+    competition_id: Id of the Competition.
+    kwargs: Additional filters on the SubmissionScoreSet objects making up the columns.
+    """
+    groups = [ResultGroupScores(gid, label) for (gid, label) in
+              SubmissionResultGroup.objects.filter(competition_id=competition_id).order_by('ordering').values_list('id', 'label')]
+    by_id = dict((g.id, g) for g in groups)
+    for (gid, phase_id) in SubmissionResultGroupPhase.objects.filter(
+            group__competition_id=competition_id).values_list('group_id', 'phase_id'):
+        by_id[gid].phase_ids.add(phase_id)
+    groups_of = {}
+    for (gid, sdef_id) in SubmissionScoreDefGroup.objects.filter(
+            group__competition_id=competition_id).values_list('group_id', 'scoredef_id'):
+        groups_of.setdefault(sdef_id, set()).add(gid)
+
+    scoredefs = {}
+    for row in SubmissionScoreDef.objects.filter(competition_id=competition_id).values_list(
+            'id', 'key', 'sorting', 'numeric_format', 'show_rank', 'selection_default', 'computed'):
+        scoredefs[row[0]] = ScoreDefInfo(*row)
+
+    if len(groups_of) > 0:
+        for row in SubmissionScoreSet.objects.order_by('tree_id', 'lft').filter(
+                scoredef_id__in=list(groups_of.keys()), **kwargs).values_list(
+                    'key', 'label', 'ordering', 'parent__key', 'parent__label', 'parent__ordering', 'scoredef_id'):
+            scoreset = ScoreSetInfo(*row)
+            for group in groups:
+                if group.id in groups_of[scoreset.scoredef_id]:
+                    group.scoresets.append(scoreset)
+
+    operations = {}
+    computed_deps = {}
+    for (computed_id, operation, sdef_id) in SubmissionComputedScoreField.objects.filter(
+            computed__scoredef__competition_id=competition_id).values_list(
+                'computed__scoredef_id', 'computed__operation', 'scoredef_id'):
+        operations[computed_id] = operation
+        computed_deps.setdefault(computed_id, []).append(sdef_id)
+
+    return CompetitionSchema(competition_id, groups, scoredefs, operations, computed_deps)
+
+
+_schema_cache = OrderedDict()
+_schema_cache_lock = threading.Lock()
+
+
+def get_schema(competition_id):
+    """
+    Returns the compiled leaderboard schema of a competition from the in-process cache,
+    compiling it on a miss or when its version stamp changed. The cache holds at most
+    LEADERBOARD_SCHEMA_CACHE_SIZE schemas and drops entries older than
+    LEADERBOARD_SCHEMA_CACHE_TIMEOUT seconds, so that processes which do not share the
+    leaderboard cache eventually catch up.
+
+    competition_id: Id of the Competition.
+    """
+    timeout = getattr(settings, 'LEADERBOARD_SCHEMA_CACHE_TIMEOUT', 300)
+    # Read before compiling: a change made meanwhile leaves the entry out of date.
+    version = leaderboard_cache.get_schema_version(competition_id)
+    with _schema_cache_lock:
+        entry = _schema_cache.pop(competition_id, None)
+        if entry is not None and entry[1] == version and time.time() - entry[0] < timeout:
+            _schema_cache[competition_id] = entry
+            return entry[2]
+    schema = compile_schema(competition_id)
+    size = getattr(settings, 'LEADERBOARD_SCHEMA_CACHE_SIZE', 128)
+    with _schema_cache_lock:
+        _schema_cache[competition_id] = (time.time(), version, schema)
+        while len(_schema_cache) > size:
+            _schema_cache.popitem(last=False)
+    return schema
+
+
+def invalidate_schema(competition_id):
+    """
+    Drops the cached leaderboard schema of a competition, along with the rank indexes, the
+    cached leaderboards and the leaderboard snapshots of its phases. Snapshots are rebuilt
+    with the new schema on their next read.
+
+    competition_id: Id of the Competition.
+    """
+    leaderboard_cache.bump_schema_version(competition_id)
+    with _schema_cache_lock:
+        _schema_cache.pop(competition_id, None)
+    drop_rank_indexes(competition_id)
+    phase_ids = list(CompetitionPhase.objects.filter(competition_id=competition_id).values_list('id', flat=True))
+    if len(phase_ids) > 0:
+        PhaseLeaderBoardSnapshot.objects.filter(phase_id__in=phase_ids).delete()
+        for phase_id in phase_ids:
+            leaderboard_cache.invalidate(phase_id)
+
+
+def clear_schema_cache():
+    """ Drops every cached leaderboard schema. """
+    with _schema_cache_lock:
+        _schema_cache.clear()
+
+
+# Schema rows and the relation leading to their competition.
+_SCHEMA_MODELS = {
+    SubmissionResultGroup: None,
+    SubmissionScoreDef: None,
+    SubmissionScoreSet: None,
+    SubmissionResultGroupPhase: 'group',
+    SubmissionScoreDefGroup: 'scoredef',
+    SubmissionComputedScore: 'scoredef',
+    SubmissionComputedScoreField: 'scoredef',
+}
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_schema_on_change(sender, instance, **kwargs):
+    """
+    Drops the cached schema of a competition when one of its schema rows changes.
+    """
+    if sender not in _SCHEMA_MODELS:
+        return
+    related = _SCHEMA_MODELS[sender]
+    try:
+        owner = getattr(instance, related) if related is not None else instance
+    except Exception:
+        # The related row is already gone (cascading delete): play it safe. The deletion of
+        # that row invalidates the snapshots of its competition.
+        clear_schema_cache()
+        clear_rank_indexes()
+        return
+    invalidate_schema(owner.competition_id)
+
+
+def load_phase_scores(phase, **kwargs):
+    """
+    Loads the leaderboard scores of a phase.
+
+    phase: The CompetitionPhase to load.
+    kwargs: Additional filters on the SubmissionScoreSet objects making up the columns. The
+        schema is compiled without caching when filters are given.
+    """
+    if len(kwargs) > 0:
+        schema = compile_schema(phase.competition_id, **kwargs)
+    else:
+        schema = get_schema(phase.competition_id)
+    groups = schema.phase_groups(phase.pk)
+
+    # Restrict computed scores and columns to those shown in the phase.
+    shown = set()
+    for group in groups:
+        shown.update(group.scoredef_ids)
+    computed_deps = dict((sdef_id, deps) for (sdef_id, deps) in schema.computed_deps.iteritems() if sdef_id in shown)
+    operations = dict((sdef_id, schema.operations[sdef_id]) for sdef_id in computed_deps)
+    for deps in computed_deps.itervalues():
+        shown.update(deps)
+    columns = [sdef_id for sdef_id in shown if not schema.scoredefs[sdef_id].computed]
+
+    entries = list(PhaseLeaderBoardEntry.objects.filter(board__phase=phase).order_by('id').values_list(
+        'result_id', 'result__participant__user__username'))
+    submission_ids = [rid for (rid, name) in entries]
+    usernames = [name for (rid, name) in entries]
+
+    values = np.zeros((len(submission_ids), len(columns)))
+    present = np.zeros((len(submission_ids), len(columns)), dtype=bool)
+    stored = np.empty((len(submission_ids), len(columns)), dtype=object)
+    if len(submission_ids) > 0 and len(columns) > 0:
+        row_of = dict((rid, i) for i, rid in enumerate(submission_ids))
+        column_of = dict((sdef_id, j) for j, sdef_id in enumerate(columns))
+        for (rid, sdef_id, value) in SubmissionScore.objects.filter(
+                scoredef_id__in=columns, result_id__in=submission_ids).values_list('result_id', 'scoredef_id', 'value'):
+            i, j = row_of[rid], column_of[sdef_id]
+            values[i, j] = value
+            present[i, j] = True
+            stored[i, j] = value
+
+    return PhaseScores(submission_ids, usernames, groups, schema.scoredefs, operations, computed_deps,
+                       columns, values, present, stored)
+
+
+class PhaseRankIndex(object):
+    """
+    Rank indexes of the columns of a phase leaderboard, giving the overall rank of a submission
+    without ranking the whole leaderboard.
+
+    competition_id: Id of the Competition.
+    loaded: PhaseScores of the phase.
+    """
+    def __init__(self, competition_id, loaded):
+        self.competition_id = competition_id
+        self.groups = loaded.groups
+        self.scoredefs = loaded.scoredefs
+        self.operations = loaded.operations
+        self.computed_deps = loaded.computed_deps
+        self.submission_ids = set(loaded.submission_ids)
+        self.indexes = dict((sdef_id, RankIndex(loaded.scoredefs[sdef_id].sorting == 'asc'))
+                            for sdef_id in loaded.columns)
+        for (sdef_id, j) in loaded.column_of.iteritems():
+            index = self.indexes[sdef_id]
+            for i in np.flatnonzero(loaded.present[:, j]).tolist():
+                index.add(loaded.submission_ids[i], loaded.stored[i, j])
+        # selected scoredef of each result group, as in CompetitionPhase.compute_scores
+        self.selections = []
+        for group in loaded.groups:
+            selection, selection_order = None, 0
+            for sdef_id in group.scoredef_ids:
+                sdef = loaded.scoredefs[sdef_id]
+                if (selection is None) or (sdef.selection_default > selection_order):
+                    selection, selection_order = sdef_id, sdef.selection_default
+            self.selections.append(selection)
+
+    def add(self, submission_id, values):
+        """
+        Adds a submission, or replaces its scores.
+
+        submission_id: Id of the CompetitionSubmission.
+        values: Maps a scoredef id to the value of the submission.
+        """
+        self.submission_ids.add(submission_id)
+        for (sdef_id, index) in self.indexes.iteritems():
+            if sdef_id in values:
+                index.add(submission_id, values[sdef_id])
+            else:
+                index.remove(submission_id)
+
+    def copy(self):
+        """
+        Returns a copy of the index which can be changed without affecting this one.
+        """
+        copy = object.__new__(PhaseRankIndex)
+        copy.__dict__.update(self.__dict__)
+        copy.submission_ids = set(self.submission_ids)
+        copy.indexes = dict((sdef_id, index.copy()) for (sdef_id, index) in self.indexes.iteritems())
+        return copy
+
+    def remove(self, submission_id):
+        """
+        Removes a submission.
+
+        submission_id: Id of the CompetitionSubmission.
+        """
+        self.submission_ids.discard(submission_id)
+        for index in self.indexes.itervalues():
+            index.remove(submission_id)
+
+    def _column_ranks(self, sdef_id, submission_ids):
+        """ Returns the ranks of the given submissions for a plain column. """
+        index = self.indexes[sdef_id]
+        ranks, missing = index.ranks(), index.missing_rank()
+        return [ranks.get(i, missing) for i in submission_ids]
+
+    def _average_ranks(self, sdef_id, submission_ids):
+        """ Returns the values and the ranks of the given submissions for an average rank column. """
+        deps = self.computed_deps[sdef_id]
+        dep_ranks = np.array([self._column_ranks(dep, submission_ids) for dep in deps]).reshape(
+            (len(deps), len(submission_ids))).T
+        averages = average_ranks(dep_ranks, range(len(deps)))
+        ranks = rank_column(averages, np.ones(len(submission_ids), dtype=bool),
+                            sort_ascending=self.scoredefs[sdef_id].sorting == 'asc')
+        return averages, ranks
+
+    def rank(self, submission_id, group=0):
+        """
+        Returns the overall rank of a submission in a result group, i.e. its rank for the
+        selected column of the group, or None if the submission is not on the leaderboard.
+        Ranks of plain columns take O(log n). Average ranks are computed from the indexes of
+        their inputs, in O(n) per input.
+
+        submission_id: Id of the CompetitionSubmission.
+        group: Index of the result group.
+        """
+        if submission_id not in self.submission_ids:
+            return None
+        if group >= len(self.selections):
+            return 1
+        sdef_id = self.selections[group]
+        if sdef_id in self.indexes:
+            return self.indexes[sdef_id].rank(submission_id)
+        if self.operations.get(sdef_id) != 'Avg':
+            return 1
+        ids = list(self.submission_ids)
+        ranks = self._average_ranks(sdef_id, ids)[1]
+        return int(ranks[ids.index(submission_id)])
+
+    def group_scores(self, group, submission_ids, formatted):
+        """
+        Returns the rows of the leaderboard of a result group in rank order, as (rank,
+        submission id, values) tuples where values is in the format of CompetitionPhase.scores().
+        The rows are those CompetitionPhase.compute_scores returns.
+
+        group: Index of the result group.
+        submission_ids: Ids of the submissions on the leaderboard, in the order of their entries.
+        formatted: Function returning the displayed value of a plain score given a submission
+            id and a ScoreDefInfo. Only called for the submissions which have that score.
+        """
+        if len(submission_ids) == 0:
+            return []
+        columns = []
+        overall_ranks = np.ones(len(submission_ids), dtype=np.int64)
+        selection = self.selections[group]
+        for sdef_id in self.groups[group].scoredef_ids:
+            sdef = self.scoredefs[sdef_id]
+            ranks = None
+            if sdef_id in self.indexes and len(self.indexes[sdef_id]) > 0:
+                index = self.indexes[sdef_id]
+                ranks = np.array(self._column_ranks(sdef_id, submission_ids), dtype=np.int64)
+                values = [formatted(i, sdef) if i in index else "-" for i in submission_ids]
+            elif self.operations.get(sdef_id) == 'Avg':
+                averages, ranks = self._average_ranks(sdef_id, submission_ids)
+                values = [CompetitionPhase.format_value(v, sdef.numeric_format) for v in averages.tolist()]
+            if ranks is None:
+                values = ["-"] * len(submission_ids)
+                rnks = values
+            else:
+                rnks = ranks.tolist()
+                if sdef_id == selection:
+                    overall_ranks = ranks
+            columns.append((sdef, values, rnks))
+        ranks_list = overall_ranks.tolist()
+        rows = []
+        for i in order_by_rank(overall_ranks).tolist():
+            values = [{'val': column_values[i], ('rnk' if column.show_rank else 'hidden_rnk'): column_ranks[i],
+                       'name': column.key} for (column, column_values, column_ranks) in columns]
+            rows.append((ranks_list[i], submission_ids[i], values))
+        return rows
+
+
+def _leaderboard_fingerprint(phase_id):
+    """
+    Returns the version of the leaderboard of a phase with the number and the highest id of
+    its entries.
+    """
+    stats = PhaseLeaderBoardEntry.objects.filter(board__phase_id=phase_id).aggregate(Count('id'), Max('id'))
+    return (leaderboard_cache.get_leaderboard_version(phase_id), stats['id__count'], stats['id__max'])
+
+
+def _submission_values(submission_id, columns):
+    """ Returns a dictionary scoredef id -> value with the scores of a submission. """
+    return dict((sdef_id, value) for (sdef_id, value) in SubmissionScore.objects.filter(
+        result_id=submission_id, scoredef_id__in=columns).values_list('scoredef_id', 'value'))
+
+
+_rank_indexes = OrderedDict()
+_rank_indexes_lock = threading.Lock()
+
+
+def _store_rank_index(phase_id, fingerprint, index, replacing=None):
+    """
+    Caches the rank index of a phase. When replacing is given, the index is only cached if
+    replacing is still the cached entry of the phase, and the entry is dropped otherwise.
+    """
+    size = getattr(settings, 'LEADERBOARD_RANK_INDEX_CACHE_SIZE', 32)
+    with _rank_indexes_lock:
+        current = _rank_indexes.pop(phase_id, None)
+        if replacing is not None and current is not replacing:
+            return
+        _rank_indexes[phase_id] = (fingerprint, index)
+        while len(_rank_indexes) > size:
+            _rank_indexes.popitem(last=False)
+
+
+def get_rank_index(phase):
+    """
+    Returns the rank index of a phase, building it if it is not cached or if the leaderboard
+    of the phase changed since it was built.
+
+    phase: The CompetitionPhase.
+    """
+    fingerprint = _leaderboard_fingerprint(phase.pk)
+    with _rank_indexes_lock:
+        entry = _rank_indexes.pop(phase.pk, None)
+        if entry is not None and entry[0] == fingerprint:
+            _rank_indexes[phase.pk] = entry
+            return entry[1]
+    logger.debug("Building rank index (phase_id=%s)", phase.pk)
+    index = PhaseRankIndex(phase.competition_id, load_phase_scores(phase))
+    _store_rank_index(phase.pk, fingerprint, index)
+    return index
+
+
+def _apply_change(phase_id, added=None, removed=()):
+    """
+    Records a change of the leaderboard of a phase: increments the version of the leaderboard
+    and applies the change to the cached rank index of the phase. The index is dropped instead
+    if it missed an earlier change, or if another change replaced it in the meantime.
+
+    Readers use the cached index without holding the lock, so the change is applied to a copy
+    which then replaces the cached index.
+    """
+    version = leaderboard_cache.bump_leaderboard_version(phase_id)
+    with _rank_indexes_lock:
+        entry = _rank_indexes.get(phase_id)
+        if entry is None:
+            return
+        if entry[0][0] != version - 1:
+            del _rank_indexes[phase_id]
+            return
+    index = entry[1].copy()
+    for submission_id in removed:
+        index.remove(submission_id)
+    if added is not None:
+        index.add(added, _submission_values(added, index.indexes.keys()))
+    _store_rank_index(phase_id, _leaderboard_fingerprint(phase_id), index, replacing=entry)
+
+
+def update_rank_index(phase, added=None, removed=()):
+    """
+    Applies a change of the leaderboard of a phase to its cached rank index. Changes made with
+    model instances are applied by signal handlers: this is for changes which send no signal,
+    such as the bulk insertion of scores.
+
+    phase: The CompetitionPhase.
+    added: Id of a submission added to the leaderboard, or whose scores changed.
+    removed: Ids of submissions removed from the leaderboard.
+    """
+    _apply_change(phase.pk, added, removed)
+
+
+@receiver(post_save, sender=PhaseLeaderBoardEntry)
+@receiver(post_delete, sender=PhaseLeaderBoardEntry)
+def update_rank_index_on_entry(sender, instance, **kwargs):
+    """
+    Applies the addition or the removal of a leaderboard entry to the rank index of its phase.
+    """
+    deleted = kwargs.get('signal') is post_delete
+    for phase_id in PhaseLeaderBoard.objects.filter(pk=instance.board_id).values_list('phase_id', flat=True):
+        if deleted:
+            _apply_change(phase_id, removed=[instance.result_id])
+        else:
+            _apply_change(phase_id, added=instance.result_id)
+
+
+@receiver(post_save, sender=SubmissionScore)
+@receiver(post_delete, sender=SubmissionScore)
+def update_rank_index_on_score(sender, instance, **kwargs):
+    """
+    Applies a change of a score of a submission to the rank index of the phase whose
+    leaderboard shows the submission.
+    """
+    for phase_id in PhaseLeaderBoardEntry.objects.filter(result_id=instance.result_id).values_list(
+            'board__phase_id', flat=True):
+        _apply_change(phase_id, added=instance.result_id)
+
+
+def submission_rank(submission, group=0):
+    """
+    Returns the overall rank of a submission on the leaderboard of its phase, or None if the
+    submission is not on the leaderboard.
+
+    submission: The CompetitionSubmission.
+    group: Index of the result group.
+    """
+    return get_rank_index(submission.phase).rank(submission.pk, group)
+
+
+def drop_rank_indexes(competition_id):
+    """
+    Drops the cached rank indexes of the phases of a competition.
+
+    competition_id: Id of the Competition.
+    """
+    with _rank_indexes_lock:
+        for phase_id in [k for (k, v) in _rank_indexes.iteritems() if v[1].competition_id == competition_id]:
+            del _rank_indexes[phase_id]
+
+
+def clear_rank_indexes():
+    """ Drops every cached rank index. """
+    with _rank_indexes_lock:
+        _rank_indexes.clear()
@@ -0,0 +1,168 @@
+"""
+Read-through cache of phase leaderboards.
+
+Leaderboards are cached per phase and per leaderboard management mode in the cache named
+by the LEADERBOARD_CACHE setting. The cache must be shared by every process serving or
+changing leaderboards, including the site worker which stores scores: evictions and version
+stamps are only seen by the processes sharing the cache. A local memory cache, private to
+each process, is therefore not suitable; a file cache serves the processes of one machine,
+a database cache or memcached those of several machines.
+
+Hits and misses are counted in the same cache so that the counters are shared as well, and
+so is the version stamp of the leaderboard schema of each competition, which tells the
+processes keeping a compiled schema in memory that it changed. Likewise, the version of the
+leaderboard of each phase is a counter incremented on every change of its entries or
+scores, against which in-process rank indexes are validated.
+"""
+import logging
+import random
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+logger = logging.getLogger(__name__)
+
+HITS_KEY = 'leaderboard:hits'
+MISSES_KEY = 'leaderboard:misses'
+# Counters outlive cached leaderboards.
+COUNTER_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get_leaderboard_cache():
+    """ Returns the cache holding leaderboards. """
+    return get_cache(getattr(settings, 'LEADERBOARD_CACHE', 'default'))
+
+
+def cache_key(phase_id, mode):
+    """
+    Returns the key of the leaderboard of a phase in a given management mode.
+
+    phase_id: Id of the CompetitionPhase.
+    mode: One of the LeaderboardManagementMode constants.
+    """
+    return 'leaderboard:%s:%s' % (phase_id, mode)
+
+
+def _count(key):
+    cache = get_leaderboard_cache()
+    cache.add(key, 0, COUNTER_TIMEOUT)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter expired or was evicted between add and incr.
+        cache.set(key, 1, COUNTER_TIMEOUT)
+
+
+def get_scores(phase):
+    """
+    Returns the cached leaderboard of a phase, in the format of CompetitionPhase.scores(),
+    or None if it is not cached.
+    """
+    groups = get_leaderboard_cache().get(cache_key(phase.pk, phase.leaderboard_management_mode))
+    if groups is None:
+        _count(MISSES_KEY)
+    else:
+        _count(HITS_KEY)
+    return groups
+
+
+def set_scores(phase, groups):
+    """ Caches the leaderboard of a phase. """
+    get_leaderboard_cache().set(cache_key(phase.pk, phase.leaderboard_management_mode), groups)
+
+
+def invalidate(phase_id):
+    """
+    Evicts the leaderboards of a phase, in every management mode.
+
+    phase_id: Id of the CompetitionPhase.
+    """
+    from apps.web.models import LeaderboardManagementMode
+    modes = (LeaderboardManagementMode.DEFAULT, LeaderboardManagementMode.HIDE_RESULTS)
+    logger.debug("Evicting cached leaderboard (phase_id=%s)", phase_id)
+    get_leaderboard_cache().delete_many([cache_key(phase_id, mode) for mode in modes])
+
+
+def schema_version_key(competition_id):
+    """
+    Returns the key of the version stamp of the leaderboard schema of a competition.
+
+    competition_id: Id of the Competition.
+    """
+    return 'leaderboard:schema:%s' % competition_id
+
+
+def get_schema_version(competition_id):
+    """
+    Returns the version stamp of the leaderboard schema of a competition. A stamp is created
+    if there is none, so that an expired or evicted stamp reads as a change.
+
+    competition_id: Id of the Competition.
+    """
+    cache = get_leaderboard_cache()
+    key = schema_version_key(competition_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, COUNTER_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_schema_version(competition_id):
+    """
+    Gives a new version stamp to the leaderboard schema of a competition.
+
+    competition_id: Id of the Competition.
+    """
+    get_leaderboard_cache().set(schema_version_key(competition_id), uuid.uuid4().hex, COUNTER_TIMEOUT)
+
+
+def leaderboard_version_key(phase_id):
+    """
+    Returns the key of the version counter of the leaderboard of a phase.
+
+    phase_id: Id of the CompetitionPhase.
+    """
+    return 'leaderboard:version:%s' % phase_id
+
+
+def get_leaderboard_version(phase_id):
+    """
+    Returns the version of the leaderboard of a phase. A counter starting at a random value
+    is created if there is none, so that an expired or evicted counter reads as a change.
+
+    phase_id: Id of the CompetitionPhase.
+    """
+    cache = get_leaderboard_cache()
+    key = leaderboard_version_key(phase_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, random.randint(0, 2 ** 30), COUNTER_TIMEOUT)
+        version = cache.get(key)
+    return version
+
+
+def bump_leaderboard_version(phase_id):
+    """
+    Increments the version of the leaderboard of a phase and returns the new version.
+
+    phase_id: Id of the CompetitionPhase.
+    """
+    get_leaderboard_version(phase_id)
+    try:
+        return get_leaderboard_cache().incr(leaderboard_version_key(phase_id))
+    except ValueError:
+        # The counter expired or was evicted between get and incr: start a new one.
+        return get_leaderboard_version(phase_id)
+
+
+def get_stats():
+    """ Returns a dictionary with the number of hits and misses of the leaderboard cache. """
+    counters = get_leaderboard_cache().get_many([HITS_KEY, MISSES_KEY])
+    return {'hits': counters.get(HITS_KEY, 0), 'misses': counters.get(MISSES_KEY, 0)}
+
+
+def reset_stats():
+    """ Resets the hit and miss counters of the leaderboard cache. """
+    get_leaderboard_cache().delete_many([HITS_KEY, MISSES_KEY])
@@ -5,6 +5,7 @@ User = get_user_model()
 from optparse import make_option
 
 from django.core.files.base import File
+from os.path import basename
 
 
 class Command(BaseCommand):
@@ -81,5 +82,6 @@ class Command(BaseCommand):
                                                   )
         submission_file = File(open(options['submission'], 'rb'))
         s = CompetitionSubmission(
-            participant=part, phase=phase, file=submission_file)
+            participant=part, phase=phase, file=submission_file,
+            original_filename=basename(options['submission']))
         s.save()
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.web.models import CompetitionPhase
+from apps.web.tasks import announce_phase_assets
+
+
+class Command(BaseCommand):
+    help = """Announces the scoring program and reference data of every phase which has not
+ended on the phase assets topic, so that compute workers in warm mode stage them. Run it
+when warm workers start or on a schedule."""
+
+    def handle(self, *args, **options):
+        if getattr(settings, 'SBS_PHASE_ASSETS_TOPIC', None) is None:
+            raise CommandError("SBS_PHASE_ASSETS_TOPIC is not set")
+        count = 0
+        for phase in CompetitionPhase.objects.select_related('competition'):
+            if phase.is_past:
+                continue
+            announce_phase_assets(phase)
+            count += 1
+        self.stdout.write("Announced the assets of %d phase(s)." % count)
@@ -0,0 +1,294 @@
+import datetime
+import resource
+import time
+
+from optparse import make_option
+
+import numpy as np
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.client import RequestFactory
+from django.utils.timezone import now
+
+from apps.web import leaderboard, leaderboard_cache
+from apps.web.models import (Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             CompetitionSubmissionStatus,
+                             ParticipantStatus,
+                             PhaseLeaderBoard,
+                             PhaseLeaderBoardEntry,
+                             refresh_leaderboard_snapshot,
+                             SubmissionComputedScore,
+                             SubmissionComputedScoreField,
+                             SubmissionResultGroup,
+                             SubmissionResultGroupPhase,
+                             SubmissionScore,
+                             SubmissionScoreDef,
+                             SubmissionScoreDefGroup,
+                             SubmissionScoreSet)
+from apps.web.views import CompetitionResultsDownload, MyCompetitionSubmissionsPage
+
+User = get_user_model()
+
+DISTRIBUTIONS = ('uniform', 'normal', 'ties')
+# Rows per INSERT; SQLite limits the number of rows of a single insert.
+BATCH_SIZE = 400
+
+
+def synthetic_scores(rng, size, columns, distribution, missing):
+    """
+    Returns random (values, present) arrays of shape (size, columns).
+
+    rng: numpy RandomState.
+    size: Number of submissions.
+    columns: Number of scores per submission.
+    distribution: 'uniform' for values in [0, 1), 'normal' for values around 0.5, or 'ties'
+        for values with two decimals, which makes many ties.
+    missing: Fraction of scores which are missing.
+    """
+    if distribution == 'normal':
+        values = rng.normal(0.5, 0.1, (size, columns))
+    elif distribution == 'ties':
+        values = np.round(rng.rand(size, columns), 2)
+    else:
+        values = rng.rand(size, columns)
+    return np.round(values, 10), rng.rand(size, columns) >= missing
+
+
+def build_phase(prefix, participants, groups, columns, computed, distribution, missing, rng):
+    """
+    Creates a competition with a single phase whose leaderboard has one finished submission
+    per participant. Returns the phase.
+
+    prefix: Prefix of the usernames created for the competition.
+    participants: Number of participants.
+    groups: Number of result groups.
+    columns: Number of scores in each result group.
+    computed: Number of 'Avg' computed scores in each result group.
+    distribution: Distribution of the scores, see synthetic_scores.
+    missing: Fraction of scores which are missing.
+    rng: numpy RandomState.
+    """
+    creator = User.objects.create(username="%s-organizer" % prefix)
+    competition = Competition.objects.create(title="Benchmark %s" % prefix, creator=creator, modified_by=creator)
+    phase = CompetitionPhase.objects.create(competition=competition, phasenumber=1,
+                                            start_date=now() - datetime.timedelta(days=1))
+
+    scoredefs = []
+    for g in range(groups):
+        group = SubmissionResultGroup.objects.create(competition=competition, key="g%d" % g,
+                                                     label="Group %d" % g, ordering=g + 1)
+        SubmissionResultGroupPhase.objects.create(group=group, phase=phase)
+        inputs = []
+        for c in range(columns + computed):
+            key = "g%d_s%d" % (g, c)
+            sdef = SubmissionScoreDef.objects.create(competition=competition, key=key, label=key,
+                                                     sorting='asc' if c % 2 == 0 else 'desc',
+                                                     show_rank=c < columns, computed=c >= columns,
+                                                     selection_default=1 if c == columns else 0,
+                                                     ordering=c + 1)
+            SubmissionScoreDefGroup.objects.create(scoredef=sdef, group=group)
+            SubmissionScoreSet.objects.create(competition=competition, key=key, label=key,
+                                              scoredef=sdef, ordering=c + 1)
+            if c < columns:
+                inputs.append(sdef)
+                scoredefs.append(sdef)
+            else:
+                average = SubmissionComputedScore.objects.create(scoredef=sdef, operation='Avg')
+                for scoredef in inputs:
+                    SubmissionComputedScoreField.objects.create(computed=average, scoredef=scoredef)
+
+    User.objects.bulk_create([User(username="%s-%d" % (prefix, i)) for i in range(participants)],
+                             batch_size=BATCH_SIZE)
+    users = User.objects.filter(username__startswith="%s-" % prefix).exclude(pk=creator.pk)
+    approved = ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+    CompetitionParticipant.objects.bulk_create([CompetitionParticipant(user=user, competition=competition,
+                                                                       status=approved) for user in users],
+                                                batch_size=BATCH_SIZE)
+    finished = CompetitionSubmissionStatus.objects.get_or_create(name="finished",
+                                                                 codename=CompetitionSubmissionStatus.FINISHED)[0]
+    CompetitionSubmission.objects.bulk_create([
+        CompetitionSubmission(participant=participant, phase=phase, status=finished, submission_number=1)
+        for participant in CompetitionParticipant.objects.filter(competition=competition)], batch_size=BATCH_SIZE)
+    submission_ids = list(CompetitionSubmission.objects.filter(phase=phase).values_list('id', flat=True))
+
+    board = PhaseLeaderBoard.objects.create(phase=phase)
+    PhaseLeaderBoardEntry.objects.bulk_create([PhaseLeaderBoardEntry(board=board, result_id=submission_id)
+                                               for submission_id in submission_ids],
+                                              batch_size=BATCH_SIZE)
+    values, present = synthetic_scores(rng, len(submission_ids), len(scoredefs), distribution, missing)
+    scores = []
+    for (i, submission_id) in enumerate(submission_ids):
+        for (j, sdef) in enumerate(scoredefs):
+            if present[i, j]:
+                scores.append(SubmissionScore(result_id=submission_id, scoredef=sdef, value=values[i, j]))
+    SubmissionScore.objects.bulk_create(scores, batch_size=BATCH_SIZE)
+    return phase
+
+
+def delete_synthetic(prefix):
+    """ Deletes the competition and the users created by build_phase for a prefix. """
+    Competition.objects.filter(creator__username="%s-organizer" % prefix).delete()
+    User.objects.filter(username__startswith="%s-" % prefix).delete()
+
+
+def measure(func, repeat=1):
+    """
+    Calls func repeat times and returns the best time in seconds, the number of queries of
+    the last call and the peak resident memory of the process in MB.
+    """
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        best = None
+        for _ in range(repeat):
+            start_queries = len(connection.queries)
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            queries = len(connection.queries) - start_queries
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return best, queries, peak
+
+
+def leaderboard_cases(phase):
+    """
+    Returns the list of (name, function) timed by the benchmark for a phase.
+    """
+    factory = RequestFactory()
+    creator = phase.competition.creator
+
+    def clear_caches():
+        leaderboard_cache.invalidate(phase.pk)
+        leaderboard.invalidate_schema(phase.competition_id)
+
+    def refresh_snapshot():
+        clear_caches()
+        refresh_leaderboard_snapshot(phase)
+
+    def scores_cold():
+        clear_caches()
+        phase.scores()
+
+    def scores_warm():
+        phase.scores()
+
+    def download(format):
+        def run():
+            request = factory.get('/', {'format': format})
+            request.user = creator
+            response = CompetitionResultsDownload.as_view()(request, id=phase.competition_id, phase=phase.pk)
+            for chunk in response.streaming_content:
+                pass
+        return run
+
+    def submissions_page():
+        request = factory.get('/', {'phase': phase.pk})
+        request.user = creator
+        view = MyCompetitionSubmissionsPage(request=request, args=(),
+                                            kwargs={'competition_id': phase.competition_id})
+        view.get_context_data()
+
+    return [('refresh snapshot', refresh_snapshot),
+            ('scores (cold)', scores_cold),
+            ('scores (warm)', scores_warm),
+            ('download csv', download('csv')),
+            ('download ndjson', download('ndjson')),
+            ('submissions page', submissions_page)]
+
+
+class Command(BaseCommand):
+    help = """Times the leaderboard of synthetic competitions end to end: phase scores, results
+download and the submissions page of the organizer. Records the number of queries and the
+peak memory of the process. The synthetic competitions are deleted afterwards."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--participants',
+                    dest='participants',
+                    default='100,1000',
+                    help="Comma separated numbers of participants, one competition per number"
+                    ),
+        make_option('--groups',
+                    dest='groups',
+                    type='int',
+                    default=2,
+                    help="Number of result groups"
+                    ),
+        make_option('--columns',
+                    dest='columns',
+                    type='int',
+                    default=3,
+                    help="Number of scores in each result group"
+                    ),
+        make_option('--computed',
+                    dest='computed',
+                    type='int',
+                    default=1,
+                    help="Number of 'Avg' computed scores in each result group"
+                    ),
+        make_option('--distribution',
+                    dest='distribution',
+                    type='choice',
+                    choices=DISTRIBUTIONS,
+                    default='uniform',
+                    help="Distribution of the scores: %s" % ", ".join(DISTRIBUTIONS)
+                    ),
+        make_option('--missing',
+                    dest='missing',
+                    type='float',
+                    default=0.05,
+                    help="Fraction of scores which are missing"
+                    ),
+        make_option('--repeat',
+                    dest='repeat',
+                    type='int',
+                    default=3,
+                    help="Number of runs of each case; the best time is reported"
+                    ),
+        make_option('--seed',
+                    dest='seed',
+                    type='int',
+                    default=0,
+                    help="Seed of the random scores"
+                    ),
+        make_option('--keep',
+                    dest='keep',
+                    action="store_true",
+                    default=False,
+                    help="Keep the synthetic competitions instead of deleting them"
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['participants'].split(',')]
+        except ValueError:
+            raise CommandError("--participants must be a comma separated list of integers")
+        if options['groups'] < 1 or options['columns'] < 1:
+            raise CommandError("--groups and --columns must be at least 1")
+        rng = np.random.RandomState(options['seed'])
+
+        self.stdout.write("%-18s %12s %10s %8s %14s" % ("case", "participants", "time (s)", "queries", "peak RSS (MB)"))
+        for size in sizes:
+            prefix = "bench%d-%d" % (options['seed'], size)
+            # Leftovers of a run with --keep or of a failed run.
+            delete_synthetic(prefix)
+            try:
+                start = time.time()
+                phase = build_phase(prefix, size, options['groups'], options['columns'], options['computed'],
+                                    options['distribution'], options['missing'], rng)
+                self.stdout.write("%-18s %12d %10.4f" % ("build", size, time.time() - start))
+                for (name, func) in leaderboard_cases(phase):
+                    elapsed, queries, peak = measure(func, options['repeat'])
+                    self.stdout.write("%-18s %12d %10.4f %8d %14.1f" % (name, size, elapsed, queries, peak))
+            finally:
+                if not options['keep']:
+                    delete_synthetic(prefix)
@@ -0,0 +1,125 @@
+import time
+
+from optparse import make_option
+
+import numpy as np
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.web import ranking
+
+
+def rank_values_loop(ids, id_value_pairs, sort_ascending=True, eps=ranking.DEFAULT_EPS):
+    """
+    Pure Python ranking of a single score, as leaderboards were ranked before the
+    vectorized engine. Kept as the baseline of the benchmark and as a reference for tests.
+    Membership is tested against a set, which makes the baseline faster than the original
+    code (it tested against the list of submission ids).
+    """
+    ranks = {}
+    members = set(ids)
+    valid_pairs = {k: v for k, v in id_value_pairs.iteritems() if k in members}
+    if len(valid_pairs) == 0:
+        return {id: 1 for id in ids}
+    sorted_pairs = sorted(valid_pairs.iteritems(), key=lambda pair: pair[1], reverse=not sort_ascending)
+    r = 1
+    k, v = sorted_pairs[0]
+    ranks[k] = r
+    for i in range(1, len(sorted_pairs)):
+        k, vnow = sorted_pairs[i]
+        if abs(vnow - v) > eps:
+            r = r + 1
+            v = vnow
+        ranks[k] = r
+    r = r + 1
+    for id in ids:
+        if id not in ranks:
+            ranks[id] = r
+    return ranks
+
+
+def rank_leaderboard_loop(ids, columns, sort_ascending):
+    """
+    Ranks every column, averages the ranks and orders the submissions with dictionaries.
+
+    ids: List of submission identifiers.
+    columns: List of {id: value} dictionaries, one per score.
+    sort_ascending: List of booleans, one per score.
+    """
+    ranks = [rank_values_loop(ids, values, asc) for (values, asc) in zip(columns, sort_ascending)]
+    averages = {id: sum([r[id] for r in ranks]) / float(len(ranks)) for id in ids}
+    overall = rank_values_loop(ids, averages, True)
+    return [(overall[id], id) for id in sorted(ids, key=lambda id: overall[id])]
+
+
+def rank_leaderboard_vectorized(values, present, sort_ascending):
+    """
+    Same as rank_leaderboard_loop on a dense (submission x score) matrix.
+    """
+    ranks = ranking.rank_matrix(values, present, sort_ascending)
+    averages = ranking.average_ranks(ranks, range(ranks.shape[1]))
+    overall = ranking.rank_column(averages, np.ones(len(averages), dtype=bool))
+    order = ranking.order_by_rank(overall)
+    return overall[order], order
+
+
+class Command(BaseCommand):
+    help = """Times the leaderboard ranking engine against the pure Python ranking on synthetic scores."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes',
+                    dest='sizes',
+                    default='1000,10000,100000',
+                    help="Comma separated numbers of submissions to rank"
+                    ),
+        make_option('--columns',
+                    dest='columns',
+                    type='int',
+                    default=4,
+                    help="Number of scores per submission"
+                    ),
+        make_option('--missing',
+                    dest='missing',
+                    type='float',
+                    default=0.05,
+                    help="Fraction of scores which are missing"
+                    ),
+        make_option('--seed',
+                    dest='seed',
+                    type='int',
+                    default=0,
+                    help="Seed of the random scores"
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError("--sizes must be a comma separated list of integers")
+        n_columns = options['columns']
+        if n_columns < 1:
+            raise CommandError("--columns must be at least 1")
+        rng = np.random.RandomState(options['seed'])
+
+        self.stdout.write("%10s %12s %12s %8s" % ("submissions", "loop (s)", "numpy (s)", "speedup"))
+        for size in sizes:
+            # Round the scores so that the leaderboard has ties.
+            values = np.round(rng.rand(size, n_columns), 4)
+            present = rng.rand(size, n_columns) >= options['missing']
+            sort_ascending = [j % 2 == 0 for j in range(n_columns)]
+
+            ids = range(size)
+            columns = [{i: values[i, j] for i in ids if present[i, j]} for j in range(n_columns)]
+            start = time.time()
+            expected = rank_leaderboard_loop(ids, columns, sort_ascending)
+            loop_time = time.time() - start
+
+            start = time.time()
+            overall, order = rank_leaderboard_vectorized(values, present, np.array(sort_ascending))
+            numpy_time = time.time() - start
+
+            if expected != zip(overall.tolist(), order.tolist()):
+                raise CommandError("Rankings differ for %d submissions" % size)
+            self.stdout.write("%10d %12.4f %12.4f %7.1fx" % (size, loop_time, numpy_time,
+                                                            loop_time / max(numpy_time, 1e-9)))
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from optparse import make_option
+
+from django.core.files.base import File
+from django.core.management.base import BaseCommand, CommandError
+
+from codalab.local_storage import LocalStorage
+from codalabtools.local_storage import LocalBlobService
+
+
+class RemoteBlobService(LocalBlobService):
+    """
+    LocalBlobService adding a fixed latency to each request, as a stand-in for a remote
+    storage service. Counts the requests.
+    """
+    def __init__(self, root_path, latency):
+        super(RemoteBlobService, self).__init__(root_path)
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+    def put_block(self, *args, **kwargs):
+        self._request()
+        return super(RemoteBlobService, self).put_block(*args, **kwargs)
+
+    def put_block_list(self, *args, **kwargs):
+        self._request()
+        return super(RemoteBlobService, self).put_block_list(*args, **kwargs)
+
+
+def write_random_file(path, size):
+    """ Writes size random bytes to a file. """
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 1024 * 1024)
+            f.write(os.urandom(chunk))
+            remaining -= chunk
+
+
+def measure_save(root_path, source_path, block_size, threads, latency, repeat):
+    """
+    Stores a file with LocalStorage repeat times and returns the best time in seconds and the
+    number of requests of the last run.
+    """
+    best = None
+    for i in range(repeat):
+        storage = LocalStorage(root_path=root_path, azure_container='benchmark',
+                               upload_block_size=block_size, upload_threads=threads)
+        storage._connection = RemoteBlobService(root_path, latency)
+        name = 'upload-%d-%d-%d.bin' % (block_size, threads, i)
+        with open(source_path, 'rb') as f:
+            start = time.time()
+            storage.save(name, File(f))
+            elapsed = time.time() - start
+        storage.delete(name)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, storage.connection.requests
+
+
+class Command(BaseCommand):
+    help = """Times AzureStorage._save against the local storage stand-in with a simulated
+request latency, for several block sizes and numbers of upload threads. The first case,
+64 KB blocks uploaded one at a time, is how files were stored before parallel uploads."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--size-mb',
+                    dest='size_mb',
+                    type='int',
+                    default=64,
+                    help="Size of the stored file in MB"
+                    ),
+        make_option('--latency-ms',
+                    dest='latency_ms',
+                    type='float',
+                    default=20.0,
+                    help="Simulated latency of each request in milliseconds"
+                    ),
+        make_option('--block-sizes-kb',
+                    dest='block_sizes_kb',
+                    default='1024,4096',
+                    help="Comma separated block sizes in KB"
+                    ),
+        make_option('--threads',
+                    dest='threads',
+                    default='1,4,8',
+                    help="Comma separated numbers of upload threads"
+                    ),
+        make_option('--repeat',
+                    dest='repeat',
+                    type='int',
+                    default=1,
+                    help="Number of runs of each case; the best time is reported"
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            block_sizes = [int(size) * 1024 for size in options['block_sizes_kb'].split(',')]
+            thread_counts = [int(count) for count in options['threads'].split(',')]
+        except ValueError:
+            raise CommandError("--block-sizes-kb and --threads must be comma separated lists of integers")
+        size = options['size_mb'] * 1024 * 1024
+        latency = options['latency_ms'] / 1000.0
+        cases = [(64 * 1024, 1)] + [(block_size, threads) for block_size in block_sizes
+                                    for threads in thread_counts]
+
+        root_path = tempfile.mkdtemp()
+        try:
+            source_path = os.path.join(root_path, 'source.bin')
+            write_random_file(source_path, size)
+            self.stdout.write("%12s %8s %10s %10s %9s" % ("block (KB)", "threads", "time (s)", "MB/s", "requests"))
+            for (block_size, threads) in cases:
+                elapsed, requests = measure_save(os.path.join(root_path, 'blobs'), source_path, block_size,
+                                                 threads, latency, options['repeat'])
+                self.stdout.write("%12d %8d %10.3f %10.1f %9d" % (block_size / 1024, threads, elapsed,
+                                                                   options['size_mb'] / elapsed, requests))
+        finally:
+            shutil.rmtree(root_path)
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from apps.web import leaderboard_cache
+
+
+class Command(BaseCommand):
+    help = """Prints the hit and miss counters of the leaderboard cache."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--reset',
+                    dest='reset',
+                    action="store_true",
+                    default=False,
+                    help="Reset the counters after printing them"
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        stats = leaderboard_cache.get_stats()
+        total = stats['hits'] + stats['misses']
+        ratio = (100.0 * stats['hits'] / total) if total > 0 else 0.0
+        self.stdout.write("hits: %d" % stats['hits'])
+        self.stdout.write("misses: %d" % stats['misses'])
+        self.stdout.write("hit ratio: %.1f%%" % ratio)
+        if options['reset']:
+            leaderboard_cache.reset_stats()
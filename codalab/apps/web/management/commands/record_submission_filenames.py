@@ -0,0 +1,60 @@
+import logging
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.web.models import BundleStorage, CompetitionSubmission
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """Records the original file name of the submissions made before it was stored in the
+database, reading it from the metadata of their Blob in the bundle storage. Submissions are
+read in batches of increasing id and each batch is committed on its own. Submissions whose
+Blob cannot be read are logged and left as they are: run the command again to retry them."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=500,
+                    help="Number of submissions read and updated per batch"
+                    ),
+        make_option('--from-id',
+                    dest='from_id',
+                    type='int',
+                    default=0,
+                    help="Only handle the submissions with a greater id, to resume an interrupted run"
+                    ),
+    )
+
+    def handle(self, *args, **options):
+        submissions = CompetitionSubmission.objects.filter(original_filename='').exclude(
+            file='').exclude(file__isnull=True)
+        after = options['from_id']
+        recorded, failed = 0, 0
+        while True:
+            batch = list(submissions.filter(pk__gt=after).order_by('pk').values_list(
+                'pk', 'file')[:options['batch_size']])
+            if len(batch) == 0:
+                break
+            names = {}
+            for (pk, file_name) in batch:
+                try:
+                    name = BundleStorage.properties(file_name).get('x-ms-meta-name', '')
+                except Exception as e:
+                    logger.warning("Cannot read the properties of %s (submission_id=%s): %s", file_name, pk, e)
+                    failed += 1
+                    continue
+                if len(name) > 0:
+                    names[pk] = name[:256]
+            with transaction.commit_on_success():
+                for (pk, name) in names.iteritems():
+                    CompetitionSubmission.objects.filter(pk=pk).update(original_filename=name)
+            recorded += len(names)
+            after = batch[-1][0]
+            self.stdout.write("Recorded %d name(s), up to submission %d." % (recorded, after))
+        self.stdout.write("Recorded the original file name of %d submission(s), %d failed." % (recorded, failed))
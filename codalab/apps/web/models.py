@@ -1,7 +1,7 @@
 import exceptions
+import json
 import logging
 import random
-import operator
 import os, io
 from os.path import abspath, basename, dirname, join, normpath, split
 import zipfile
@@ -12,10 +12,11 @@ import django.dispatch
 import time
 import string
 import uuid
+import numpy as np
 from django.db import models
 from django.db import IntegrityError
 from django.db.models import Max
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_init, post_save
 from django.db import transaction
 from django.dispatch import receiver
 from django.conf import settings
@@ -33,6 +34,8 @@ from pytz import utc
 from guardian.shortcuts import assign_perm
 from django_extensions.db.fields import UUIDField
 
+from apps.web import leaderboard_cache, ranking
+
 logger = logging.getLogger(__name__)
 
 ## Needed for computation service handling
@@ -236,6 +239,7 @@ class Competition(models.Model):
                 new_submission = CompetitionSubmission.objects.create(
                     participant=participant,
                     file=submission.file,
+                    original_filename=submission.original_filename,
                     phase=current_phase
                 )
 
@@ -245,6 +249,8 @@ class Competition(models.Model):
 
         current_phase.is_migrated = True
         current_phase.save()
+        leaderboard_cache.invalidate(last_phase.pk)
+        leaderboard_cache.invalidate(current_phase.pk)
 
         # TODO: ONLY IF SUCCESSFUL
         self.is_migrating = False # this should really be True until evaluate_submission tasks are all the way completed
@@ -422,6 +428,8 @@ class CompetitionPhase(models.Model):
     """
         A phase of a competition.
     """
+    OUTPUT_COMPRESSION_CHOICES = tuple([(0, 'Store only')] + [(level, str(level)) for level in range(1, 10)])
+
     COLOR_CHOICES = (
         ('white', 'White'),
         ('orange', 'Orange'),
@@ -446,6 +454,8 @@ class CompetitionPhase(models.Model):
     auto_migration = models.BooleanField(default=False)
     is_migrated = models.BooleanField(default=False)
     execution_time_limit = models.PositiveIntegerField(default=(5 * 60))
+    # zlib level of the archives of run outputs; 0 stores files without compression.
+    output_compression_level = models.PositiveSmallIntegerField(default=6, choices=OUTPUT_COMPRESSION_CHOICES)
     color = models.CharField(max_length=24, choices=COLOR_CHOICES, blank=True, null=True)
 
     input_data_organizer_dataset = models.ForeignKey('OrganizerDataSet', null=True, blank=True, related_name="input_data_organizer_dataset", verbose_name="Input Data", on_delete=models.SET_NULL)
@@ -489,49 +499,20 @@ class CompetitionPhase(models.Model):
         return self.leaderboard_management_mode == LeaderboardManagementMode.HIDE_RESULTS
 
     @staticmethod
-    def rank_values(ids, id_value_pairs, sort_ascending=True, eps=1.0e-12):
+    def rank_values(ids, id_value_pairs, sort_ascending=True, eps=ranking.DEFAULT_EPS):
         """ Given a set of identifiers (ids) and a set of (id, value)-pairs
             computes a ranking based on the value. The ranking is provided
             as a set of (id, rank) pairs for all id in ids.
         """
-        ranks = {}
-        # Only keep pairs for which the key is in the list of ids
-        valid_pairs = {k: v for k, v in id_value_pairs.iteritems() if k in ids}
-        if len(valid_pairs) == 0:
-            return {id: 1 for id in ids}
-        # Sort and compute ranks
-        sorted_pairs = sorted(valid_pairs.iteritems(), key = operator.itemgetter(1), reverse=not sort_ascending)
-        r = 1
-        k, v = sorted_pairs[0]
-        ranks[k] = r
-        for i in range(1, len(sorted_pairs)):
-            k, vnow = sorted_pairs[i]
-            # Increment the rank only when values are different
-            if abs(vnow - v) > eps:
-                r = r + 1
-                v = vnow
-            ranks[k] = r
-        # Fill in ranks for ids which were not seen in the input
-        r = r + 1
-        for id in ids:
-            if id not in ranks:
-                ranks[id] = r
-        return ranks
-
-    @staticmethod
-    def rank_submissions(ranks_by_id):
-        def compare_ranks(a, b):
-            limit = 1000000
-            try:
-                ia = int(ranks_by_id[a])
-            except exceptions.ValueError:
-                ia = limit
-            try:
-                ib = int(ranks_by_id[b])
-            except exceptions.ValueError:
-                ib = limit
-            return ia - ib
-        return compare_ranks
+        ids = list(ids)
+        values = np.zeros(len(ids))
+        present = np.zeros(len(ids), dtype=bool)
+        for i, id in enumerate(ids):
+            if id in id_value_pairs:
+                values[i] = id_value_pairs[id]
+                present[i] = True
+        ranks = ranking.rank_column(values, present, sort_ascending=sort_ascending, eps=eps)
+        return {id: int(r) for id, r in zip(ids, ranks)}
 
     @staticmethod
     def format_value(v, precision="2"):
@@ -544,32 +525,57 @@ class CompetitionPhase(models.Model):
         return ("{:." + str(p) + "f}").format(v)
 
     def scores(self,**kwargs):
-        score_filters = kwargs.pop('score_filters',{})
+        """
+        Returns the leaderboard of this phase as a list of result groups. The groups are read
+        from the leaderboard cache or else from the leaderboard snapshot of the phase, which is
+        built on first use and refreshed whenever the scores or the entries of the leaderboard
+        change.
+
+        kwargs: Additional filters on the SubmissionScoreSet objects making up the columns. The
+            leaderboard is then computed without the snapshot.
+        """
+        if len(kwargs) > 0:
+            # Ad-hoc filters are not materialized.
+            results = self.compute_scores(**kwargs)
+            for result in results:
+                del result['group_id']
+            return results
+        results = leaderboard_cache.get_scores(self)
+        if results is None:
+            results = PhaseLeaderBoardSnapshot.read_groups(self.leaderboard_snapshot())
+            leaderboard_cache.set_scores(self, results)
+        return results
+
+    def leaderboard_snapshot(self):
+        """
+        Returns the list of PhaseLeaderBoardSnapshot objects of this phase, one per result
+        group. The snapshot is rebuilt if it does not exist yet or is out of date, i.e. the
+        entries or the scores of the leaderboard were changed without updating it (admin
+        edits, cascading deletes).
+        """
+        snapshots = list(PhaseLeaderBoardSnapshot.objects.filter(phase=self).order_by('ordering', 'id'))
+        if not _snapshot_is_current(self, snapshots):
+            snapshots = _refresh_outdated_leaderboard_snapshot(self)
+        return snapshots
 
-        # Get the list of submissions in this leaderboard
-        submissions = []
-        lb, created = PhaseLeaderBoard.objects.get_or_create(phase=self)
-        if not created:
-            qs = PhaseLeaderBoardEntry.objects.filter(board=lb)
-            for (rid, name) in qs.values_list('result_id', 'result__participant__user__username'):
-                submissions.append((rid,  name))
+    def compute_scores(self,**kwargs):
+        """
+        Computes the leaderboard of this phase from the submission scores. Each result group
+        is identified by the 'group_id' key in addition to the keys returned by scores().
+        """
+        from apps.web.leaderboard import load_phase_scores
+        loaded = load_phase_scores(self, **kwargs)
+        submission_ids = loaded.submission_ids
 
         results = []
-        for g in SubmissionResultGroup.objects.filter(phases__in=[self]).order_by('ordering'):
-            label = g.label
+        for g in loaded.groups:
             headers = []
-            scores = {}
-            for (pk,name) in submissions: scores[pk] = {'username': name, 'values': []}
-
-            scoreDefs = []
             columnKeys = {} # maps a column key to its index in headers list
-            for x in SubmissionScoreSet.objects.order_by('tree_id','lft').filter(scoredef__isnull=False,
-                                                                        scoredef__groups__in=[g],
-                                                                        **kwargs).select_related('scoredef', 'parent'):
-                if x.parent is not None:
-                    columnKey = x.parent.key
-                    columnLabel = x.parent.label
-                    columnOrdering = x.parent.ordering
+            for x in g.scoresets:
+                if x.parent_key is not None:
+                    columnKey = x.parent_key
+                    columnLabel = x.parent_label
+                    columnOrdering = x.parent_ordering
                     columnSubLabels = [{'key': x.key, 'label': x.label, 'ordering': x.ordering}]
                 else:
                     columnKey = x.key
@@ -581,8 +587,7 @@ class CompetitionPhase(models.Model):
                     headers.append({'key': columnKey, 'label': columnLabel, 'subs': columnSubLabels, 'ordering': columnOrdering})
                 else:
                     headers[columnKeys[columnKey]]['subs'].extend(columnSubLabels)
-
-                scoreDefs.append(x.scoredef)
+            scoreDefs = [loaded.scoredefs[sdef_id] for sdef_id in g.scoredef_ids]
             # Sort headers appropiately
             def sortkey(x):
                 return x['ordering']
@@ -600,88 +605,52 @@ class CompetitionPhase(models.Model):
                 if (selection_key is None) or (scoreDefs[i].selection_default > selection_order):
                     selection_key, selection_order = scoreDefs[i].key, scoreDefs[i].selection_default
 
-            results.append({ 'label': label, 'headers': headers, 'total_span' : column_span, 'selection_key': selection_key,
-                             'scores': scores, 'scoredefs': scoreDefs })
-
-        if len(submissions) > 0:
-            # Figure out which submission scores we need to read from the database.
-            submission_ids = [id for (id,name) in submissions]
-            # not_computed_scoredefs: map (scoredef.id, scoredef) to keep track of non-computed scoredefs
-            not_computed_scoredefs = {}
-            computed_scoredef_ids = []
-            # computed_deps: maps id of a computed scoredef to a list of ids for scoredefs which are
-            #                input to the computation
-            computed_deps = {}
-            for result in results:
-                for sdef in result['scoredefs']:
-                    if sdef.computed is True:
-                        computed_scoredef_ids.append(sdef.id)
-                    else:
-                        not_computed_scoredefs[sdef.id] = sdef
-                if len(computed_scoredef_ids) > 0:
-                    computed_ids = SubmissionComputedScore.objects.filter(scoredef_id__in=computed_scoredef_ids).values_list('id')
-                    fields = SubmissionComputedScoreField.objects.filter(computed_id__in=computed_ids).select_related('scoredef', 'computed')
-                    for field in fields:
-                        if not field.scoredef.computed:
-                            not_computed_scoredefs[field.scoredef.id] = field.scoredef
-                        if field.computed.scoredef_id not in computed_deps:
-                            computed_deps[field.computed.scoredef_id] = []
-                        computed_deps[field.computed.scoredef_id].append(field.scoredef)
-            # Now read the submission scores
-            values = {}
-            scoredef_ids = [sdef_id for (sdef_id, sdef) in not_computed_scoredefs.iteritems()]
-            for s in SubmissionScore.objects.filter(scoredef_id__in=scoredef_ids, result_id__in=submission_ids):
-                if s.scoredef_id not in values:
-                    values[s.scoredef_id] = {}
-                values[s.scoredef_id][s.result_id] = s.value
-
-            # rank values per scoredef.key (not computed)
-            ranks = {}
-            for (sdef_id, v) in values.iteritems():
-                sdef = not_computed_scoredefs[sdef_id]
-                ranks[sdef_id] = self.rank_values(submission_ids, v, sort_ascending=sdef.sorting=='asc')
+            results.append({ 'group_id': g.id, 'label': g.label, 'headers': headers, 'total_span' : column_span,
+                             'selection_key': selection_key, 'scores': [], 'scoredefs': scoreDefs })
+
+        if len(submission_ids) > 0:
+            # rank values per scoredef (not computed), all columns at once, in the exact order
+            # of the stored decimals
+            column_ranks = ranking.rank_matrix(loaded.rank_keys(), loaded.present, loaded.sort_ascending())
+            # values and ranks by scoredef id; scoredefs without any score have no ranks
+            known = {}
+            for (sdef_id, j) in loaded.column_of.iteritems():
+                if loaded.present[:, j].any():
+                    known[sdef_id] = (loaded.stored[:, j].tolist(), column_ranks[:, j])
 
             # compute values for computed scoredefs
-            for result in results:
-                for sdef in result['scoredefs']:
-                    if sdef.computed:
-                        operation = getattr(models, sdef.computed_score.operation)
-                        if (operation.name == 'Avg'):
-                            cnt = len(computed_deps[sdef.id])
-                            if (cnt > 0):
-                                computed_values = {}
-                                for id in submission_ids:
-                                    computed_values[id] = sum([ranks[d.id][id] for d in computed_deps[sdef.id]]) / float(cnt)
-                                values[sdef.id] = computed_values
-                                ranks[sdef.id] = self.rank_values(submission_ids, computed_values, sort_ascending=sdef.sorting=='asc')
+            everyone = np.ones(len(submission_ids), dtype=bool)
+            for (sdef_id, deps) in loaded.computed_deps.iteritems():
+                operation = getattr(models, loaded.operations[sdef_id])
+                if (operation.name == 'Avg'):
+                    computed_values = ranking.average_ranks(column_ranks, [loaded.column_of[d] for d in deps])
+                    computed_ranks = ranking.rank_column(computed_values, everyone,
+                                                         sort_ascending=loaded.scoredefs[sdef_id].sorting=='asc')
+                    known[sdef_id] = (computed_values.tolist(), computed_ranks)
 
             #format values
             for result in results:
-                scores = result['scores']
+                scores = [{'id': id, 'username': name, 'values': []}
+                          for (id, name) in zip(submission_ids, loaded.usernames)]
+                overall_ranks = np.ones(len(submission_ids), dtype=np.int64)
                 for sdef in result['scoredefs']:
-                    knownValues = {}
-                    if sdef.id in values:
-                        knownValues = values[sdef.id]
-                    knownRanks = {}
-                    if sdef.id in ranks:
-                        knownRanks = ranks[sdef.id]
-                    for id in submission_ids:
-                        v = "-"
-                        if id in knownValues:
-                            v = CompetitionPhase.format_value(knownValues[id], sdef.numeric_format)
-                        r = "-"
-                        if id in knownRanks:
-                            r = knownRanks[id]
-                        if sdef.show_rank:
-                            scores[id]['values'].append({'val': v, 'rnk': r, 'name' : sdef.key})
-                        else:
-                            scores[id]['values'].append({'val': v, 'hidden_rnk': r, 'name' : sdef.key})
-                    if (sdef.key == result['selection_key']):
-                        overall_ranks = ranks[sdef.id]
-                ranked_submissions = sorted(submission_ids, cmp=CompetitionPhase.rank_submissions(overall_ranks))
-                final_scores = [(overall_ranks[id], scores[id]) for id in ranked_submissions]
-                result['scores'] = final_scores
-                del result['scoredefs']
+                    if sdef.id in known:
+                        sdef_values, sdef_ranks = known[sdef.id]
+                        formatted = [CompetitionPhase.format_value(v, sdef.numeric_format) if v is not None else "-"
+                                     for v in sdef_values]
+                        rnks = sdef_ranks.tolist()
+                    else:
+                        formatted = ["-"] * len(submission_ids)
+                        rnks = formatted
+                    rank_key = 'rnk' if sdef.show_rank else 'hidden_rnk'
+                    for (score, v, r) in zip(scores, formatted, rnks):
+                        score['values'].append({'val': v, rank_key: r, 'name' : sdef.key})
+                    if (sdef.key == result['selection_key']) and (sdef.id in known):
+                        overall_ranks = known[sdef.id][1]
+                ranks_list = overall_ranks.tolist()
+                result['scores'] = [(ranks_list[i], scores[i]) for i in ranking.order_by_rank(overall_ranks).tolist()]
+        for result in results:
+            del result['scoredefs']
         return results
 
 # Competition Participant
@@ -726,6 +695,8 @@ class CompetitionSubmission(models.Model):
     phase = models.ForeignKey(CompetitionPhase, related_name='submissions')
     file = models.FileField(upload_to=submission_file_name, storage=BundleStorage, null=True, blank=True)
     file_url_base = models.CharField(max_length=2000, blank=True)
+    # Name of the uploaded file, recorded at submission time so listings need no storage lookup.
+    original_filename = models.CharField(max_length=256, blank=True, default="")
     description = models.CharField(max_length=256, blank=True)
     inputfile = models.FileField(upload_to=submission_inputfile_name, storage=BundleStorage, null=True, blank=True)
     runfile = models.FileField(upload_to=submission_runfile_name, storage=BundleStorage, null=True, blank=True)
@@ -784,15 +755,11 @@ class CompetitionSubmission(models.Model):
         """
         Returns the short name of the file which was uploaded to create the submission.
         """
-        name = ''
-        try:
-            name = self.file.storage.properties(self.file.name)['x-ms-meta-name']
-        except:
-            pass
-        if len(name) == 0:
-            # For backwards compat, fallback to this method of getting the name.
-            name = split(self.file.name)[1]
-        return name
+        if len(self.original_filename) > 0:
+            return self.original_filename
+        # The names of older submissions were recorded by migration 0023 from the Blob
+        # metadata. Fall back to the name of the stored file.
+        return split(self.file.name)[1]
 
     def get_file_for_download(self, key, requested_by):
         """
@@ -1174,6 +1141,8 @@ class CompetitionDefBundle(models.Model):
         resulting_participant, created = CompetitionParticipant.objects.get_or_create(user=self.owner, competition=comp, defaults={'status':approved})
         logger.debug("CompetitionDefBundle::unpack added owner as participant (pk=%s)", self.pk)
 
+        from apps.web.leaderboard import invalidate_schema
+        invalidate_schema(comp.pk)
         return comp
 
 class SubmissionScoreDefGroup(models.Model):
@@ -1249,7 +1218,8 @@ class PhaseLeaderBoard(models.Model):
         return self.phase.is_active
 
     def scores(self,**kwargs):
-        return self.phase.scores(score_filters=dict(result__leaderboard_entry_result__board=self))
+        # The leaderboard of a phase is made of the entries of its board.
+        return self.phase.scores(**kwargs)
 
 class PhaseLeaderBoardEntry(models.Model):
     board = models.ForeignKey(PhaseLeaderBoard, related_name='entries')
@@ -1258,6 +1228,137 @@ class PhaseLeaderBoardEntry(models.Model):
     class Meta:
         unique_together = (('board', 'result'),)
 
+class PhaseLeaderBoardSnapshot(models.Model):
+    """
+    Materialized leaderboard of a phase for one result group. The ranked rows are stored as
+    PhaseLeaderBoardSnapshotEntry objects in rank order.
+    """
+    phase = models.ForeignKey(CompetitionPhase, related_name='leaderboard_snapshots')
+    group = models.ForeignKey(SubmissionResultGroup, related_name='leaderboard_snapshots')
+    ordering = models.PositiveIntegerField(default=1)
+    label = models.CharField(max_length=50)
+    headers_json = models.TextField(blank=True)
+    total_span = models.PositiveIntegerField(default=2)
+    selection_key = models.CharField(max_length=50, null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+    # Number of entries of the leaderboard and largest entry id when the snapshot was last
+    # brought up to date, compared on read to catch entries changed by other means.
+    entry_count = models.PositiveIntegerField(default=0)
+    last_entry_id = models.PositiveIntegerField(default=0)
+    # Set when a score shown by the snapshot changed outside of update_leaderboard_snapshot.
+    stale = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('phase', 'group'),)
+        ordering = ['ordering']
+
+    def __unicode__(self):
+        return "%s [%s]" % (self.phase, self.label)
+
+    @staticmethod
+    def read_groups(snapshots):
+        """
+        Returns the result groups, in the format of CompetitionPhase.scores(), for the given
+        list of snapshots.
+        """
+        groups = []
+        by_id = {}
+        for snapshot in snapshots:
+            group = {'label': snapshot.label,
+                     'headers': snapshot.headers,
+                     'total_span': snapshot.total_span,
+                     'selection_key': snapshot.selection_key,
+                     'scores': []}
+            groups.append(group)
+            by_id[snapshot.id] = group
+        if len(by_id) > 0:
+            qs = PhaseLeaderBoardSnapshotEntry.objects.filter(snapshot_id__in=by_id.keys()).order_by('position')
+            for (snapshot_id, rank, result_id, username, values_json) in qs.values_list('snapshot_id', 'rank', 'result_id',
+                                                                                         'username', 'values_json'):
+                scores = {'id': result_id, 'username': username, 'values': json.loads(values_json)}
+                by_id[snapshot_id]['scores'].append((rank, scores))
+        return groups
+
+    @property
+    def headers(self):
+        return json.loads(self.headers_json) if len(self.headers_json) > 0 else []
+
+    @staticmethod
+    def iter_groups(snapshots, chunk_size=1000):
+        """
+        Returns an iterator of (snapshot, rows) pairs for the given snapshots of a phase, in
+        order, where rows yields the entries of the snapshot in rank order as (rank, scores)
+        tuples in the format of CompetitionPhase.scores().
+
+        The entries are read in chunks of chunk_size rows, each chunk starting after the last
+        position read, so that memory use does not depend on the size of the leaderboard:
+        MySQLdb holds the whole result of a query in memory. The first chunk is read before
+        this function returns and the other chunks by the same transaction, that of the
+        request. With the repeatable read isolation of InnoDB, the default of MySQL, every
+        chunk is read from the same consistent view and an update of the leaderboard made in
+        the meantime neither truncates nor mixes into the rows. With read committed isolation
+        such an update can show between two chunks.
+
+        snapshots: PhaseLeaderBoardSnapshot objects of a phase, ordered as by
+            CompetitionPhase.leaderboard_snapshot().
+        chunk_size: Number of entries read by each query.
+        """
+        def chunk(snapshot_id, after):
+            qs = PhaseLeaderBoardSnapshotEntry.objects.filter(snapshot_id=snapshot_id, position__gt=after)
+            qs = qs.order_by('position').values_list('position', 'rank', 'result_id', 'username', 'values_json')
+            return list(qs[:chunk_size])
+
+        def entries(snapshot_id, rows):
+            while len(rows) > 0:
+                for (position, rank, result_id, username, values_json) in rows:
+                    yield rank, {'id': result_id, 'username': username, 'values': json.loads(values_json)}
+                if len(rows) < chunk_size:
+                    break
+                rows = chunk(snapshot_id, position)
+
+        first = chunk(snapshots[0].id, 0) if len(snapshots) > 0 else []
+
+        def groups():
+            for (i, snapshot) in enumerate(snapshots):
+                yield snapshot, entries(snapshot.id, first if i == 0 else chunk(snapshot.id, 0))
+
+        return groups()
+
+    def page(self, offset, limit):
+        """
+        Returns the rows at positions offset+1 to offset+limit of this snapshot as dictionaries
+        with the keys 'position', 'rank', 'submission_id', 'username' and 'values'.
+
+        offset: Number of rows to skip from the top of the leaderboard.
+        limit: Maximum number of rows to return.
+        """
+        qs = self.entries.filter(position__gt=offset, position__lte=offset + limit).order_by('position')
+        return [{'position': position, 'rank': rank, 'submission_id': result_id, 'username': username,
+                 'values': json.loads(values_json)}
+                for (position, rank, result_id, username, values_json) in
+                qs.values_list('position', 'rank', 'result_id', 'username', 'values_json')]
+
+    def position_of(self, participant):
+        """
+        Returns the position of the best entry of a participant in this snapshot, or None if the
+        participant is not on the leaderboard.
+        """
+        positions = self.entries.filter(result__participant=participant).order_by('position')
+        positions = positions.values_list('position', flat=True)[:1]
+        return positions[0] if len(positions) > 0 else None
+
+class PhaseLeaderBoardSnapshotEntry(models.Model):
+    snapshot = models.ForeignKey(PhaseLeaderBoardSnapshot, related_name='entries')
+    position = models.PositiveIntegerField()
+    rank = models.PositiveIntegerField(null=True, blank=True)
+    result = models.ForeignKey(CompetitionSubmission, related_name='leaderboard_snapshot_entries')
+    username = models.CharField(max_length=255)
+    values_json = models.TextField()
+
+    class Meta:
+        unique_together = (('snapshot', 'position'),)
+        ordering = ['position']
+
 
 def dataset_data_file(dataset, filename="data.zip"):
     return os.path.join("datasets", str(dataset.pk), str(uuid.uuid4()), filename)
@@ -1305,4 +1406,217 @@ def add_submission_to_leaderboard(submission):
     for entry in entries:
         entry.delete()
     lbe, created = PhaseLeaderBoardEntry.objects.get_or_create(board=lb, result=submission)
+    update_leaderboard_snapshot(submission.phase, changed=[submission.pk])
     return lbe, created
+
+def _lock_leaderboard(phase):
+    """ Locks the leaderboard of a phase until the end of the transaction and returns it. """
+    lb, _ = PhaseLeaderBoard.objects.get_or_create(phase=phase)
+    return PhaseLeaderBoard.objects.select_for_update().get(pk=lb.pk)
+
+@transaction.commit_on_success
+def refresh_leaderboard_snapshot(phase):
+    """
+    Rebuilds the leaderboard snapshot of the given phase. Refreshes of the same phase are
+    serialized by locking the phase leaderboard.
+
+    Returns the list of PhaseLeaderBoardSnapshot objects for the phase.
+    """
+    _lock_leaderboard(phase)
+    return _rebuild_leaderboard_snapshot(phase)
+
+def _entries_fingerprint(phase):
+    """ Returns the number of entries of the leaderboard of a phase and the largest entry id. """
+    agg = PhaseLeaderBoardEntry.objects.filter(board__phase=phase).aggregate(count=models.Count('id'),
+                                                                              last=Max('id'))
+    return agg['count'], agg['last'] or 0
+
+def _snapshot_is_current(phase, snapshots):
+    """ Returns True if the given snapshots of a phase exist and match its leaderboard. """
+    if len(snapshots) == 0 or any(snapshot.stale for snapshot in snapshots):
+        return False
+    return (snapshots[0].entry_count, snapshots[0].last_entry_id) == _entries_fingerprint(phase)
+
+@transaction.commit_on_success
+def _refresh_outdated_leaderboard_snapshot(phase):
+    """
+    Rebuilds the leaderboard snapshot of the given phase unless a concurrent refresh brought
+    it up to date while waiting for the lock. Returns the list of PhaseLeaderBoardSnapshot
+    objects for the phase.
+    """
+    _lock_leaderboard(phase)
+    snapshots = list(PhaseLeaderBoardSnapshot.objects.filter(phase=phase).order_by('ordering', 'id'))
+    if _snapshot_is_current(phase, snapshots):
+        return snapshots
+    return _rebuild_leaderboard_snapshot(phase)
+
+def _rebuild_leaderboard_snapshot(phase):
+    logger.debug("Refreshing leaderboard snapshot (phase_id=%s)", phase.pk)
+    entry_count, last_entry_id = _entries_fingerprint(phase)
+    results = phase.compute_scores()
+    PhaseLeaderBoardSnapshot.objects.filter(phase=phase).delete()
+    snapshots = []
+    for index, result in enumerate(results):
+        snapshot = PhaseLeaderBoardSnapshot.objects.create(phase=phase,
+                                                           group_id=result['group_id'],
+                                                           ordering=index + 1,
+                                                           label=result['label'],
+                                                           headers_json=json.dumps(result['headers']),
+                                                           total_span=result['total_span'],
+                                                           selection_key=result['selection_key'],
+                                                           entry_count=entry_count,
+                                                           last_entry_id=last_entry_id)
+        entries = []
+        for position, (rank, scores) in enumerate(result['scores']):
+            entries.append(PhaseLeaderBoardSnapshotEntry(snapshot=snapshot,
+                                                         position=position + 1,
+                                                         rank=rank,
+                                                         result_id=scores['id'],
+                                                         username=scores['username'],
+                                                         values_json=json.dumps(scores['values'])))
+        PhaseLeaderBoardSnapshotEntry.objects.bulk_create(entries)
+        snapshots.append(snapshot)
+    leaderboard_cache.invalidate(phase.pk)
+    return snapshots
+
+@transaction.commit_on_success
+def update_leaderboard_snapshot(phase, changed=()):
+    """
+    Brings the leaderboard snapshot of the given phase up to date after a change of its
+    entries or of the scores of some of its submissions. The ranked rows are taken from the
+    rank index of the phase: only the scores of the changed submissions are read, and only
+    the rows whose position, rank or values changed are rewritten. The snapshot is rebuilt
+    if it does not exist yet, does not match the result groups of the phase or is stale.
+
+    changed: Ids of the submissions added to the leaderboard or whose scores changed.
+
+    Returns the list of PhaseLeaderBoardSnapshot objects for the phase.
+    """
+    from apps.web.leaderboard import get_rank_index
+    changed = set(changed)
+    lb = _lock_leaderboard(phase)
+    snapshots = list(PhaseLeaderBoardSnapshot.objects.filter(phase=phase).order_by('ordering', 'id'))
+    index = get_rank_index(phase)
+    entries = list(PhaseLeaderBoardEntry.objects.filter(board=lb).order_by('id').values_list(
+        'id', 'result_id', 'result__participant__user__username'))
+    submission_ids = [rid for (eid, rid, name) in entries]
+    usernames = dict((rid, name) for (eid, rid, name) in entries)
+    fingerprint = (len(entries), entries[-1][0] if len(entries) > 0 else 0)
+    if (len(snapshots) == 0 or any(s.stale for s in snapshots) or
+            [s.group_id for s in snapshots] != [g.id for g in index.groups] or
+            set(submission_ids) != index.submission_ids):
+        return _rebuild_leaderboard_snapshot(phase)
+    logger.debug("Updating leaderboard snapshot (phase_id=%s)", phase.pk)
+
+    # Current rows by snapshot and position, and the displayed values of the submissions
+    # which did not change.
+    rows = dict((snapshot.id, {}) for snapshot in snapshots)
+    displayed = {}
+    qs = PhaseLeaderBoardSnapshotEntry.objects.filter(snapshot__in=snapshots)
+    for row in qs.values_list('id', 'snapshot_id', 'position', 'rank', 'result_id', 'username', 'values_json'):
+        values = json.loads(row[6])
+        rows[row[1]][row[2]] = row[:6] + (values,)
+        if row[4] not in changed:
+            for v in values:
+                displayed[(row[4], v['name'])] = v['val']
+    unchanged = set(result_id for (result_id, key) in displayed)
+    # Scores the index has but the snapshot does not display are read with the changed ones.
+    for (sdef_id, sdef_index) in index.indexes.iteritems():
+        key = index.scoredefs[sdef_id].key
+        unchanged.difference_update([i for i in unchanged if i in sdef_index and
+                                     displayed.get((i, key)) in (None, "-")])
+    fresh = {}
+    fresh_ids = [i for i in submission_ids if i not in unchanged]
+    if len(fresh_ids) > 0:
+        qs = SubmissionScore.objects.filter(result_id__in=fresh_ids, scoredef_id__in=index.indexes.keys())
+        for (result_id, scoredef_id, value) in qs.values_list('result_id', 'scoredef_id', 'value'):
+            fresh[(result_id, scoredef_id)] = value
+
+    def formatted(result_id, sdef):
+        if result_id in unchanged:
+            return displayed[(result_id, sdef.key)]
+        return CompetitionPhase.format_value(fresh[(result_id, sdef.id)], sdef.numeric_format)
+
+    for (group, snapshot) in enumerate(snapshots):
+        current = rows[snapshot.id]
+        stale, created = [], []
+        for (position, (rank, result_id, values)) in enumerate(index.group_scores(group, submission_ids, formatted)):
+            row = current.pop(position + 1, None)
+            if row is not None and row[3:] == (rank, result_id, usernames[result_id], values):
+                continue
+            if row is not None:
+                stale.append(row[0])
+            created.append(PhaseLeaderBoardSnapshotEntry(snapshot=snapshot,
+                                                         position=position + 1,
+                                                         rank=rank,
+                                                         result_id=result_id,
+                                                         username=usernames[result_id],
+                                                         values_json=json.dumps(values)))
+        stale.extend(row[0] for row in current.itervalues())
+        for i in range(0, len(stale), 500):
+            PhaseLeaderBoardSnapshotEntry.objects.filter(id__in=stale[i:i + 500]).delete()
+        PhaseLeaderBoardSnapshotEntry.objects.bulk_create(created)
+        if len(stale) > 0 or len(created) > 0 or (snapshot.entry_count, snapshot.last_entry_id) != fingerprint:
+            (snapshot.entry_count, snapshot.last_entry_id) = fingerprint
+            PhaseLeaderBoardSnapshot.objects.filter(pk=snapshot.pk).update(updated=now(),
+                                                                           entry_count=fingerprint[0],
+                                                                           last_entry_id=fingerprint[1])
+    leaderboard_cache.invalidate(phase.pk)
+    return snapshots
+
+@receiver(post_save, sender=SubmissionScore)
+@receiver(post_delete, sender=SubmissionScore)
+def evict_leaderboard_on_score(sender, instance, **kwargs):
+    """
+    Evicts the cached leaderboard of the phase of a submission when one of its scores changes,
+    and marks the leaderboard snapshot stale if the submission is on the leaderboard. Scores
+    stored by update_submission_task are inserted in bulk and send no signal: the snapshot is
+    updated there.
+    """
+    phase_ids = CompetitionSubmission.objects.filter(pk=instance.result_id).values_list('phase_id', flat=True)
+    for phase_id in phase_ids:
+        leaderboard_cache.invalidate(phase_id)
+    board_phase_ids = PhaseLeaderBoardEntry.objects.filter(result_id=instance.result_id).values_list(
+        'board__phase_id', flat=True)
+    PhaseLeaderBoardSnapshot.objects.filter(phase_id__in=list(board_phase_ids)).update(stale=True)
+
+def _phase_assets(phase):
+    """ Returns the names of the scoring program and the reference data of a phase. """
+    return (phase.scoring_program.name, phase.reference_data.name)
+
+@receiver(post_init, sender=CompetitionPhase)
+def remember_phase_assets(sender, instance, **kwargs):
+    """
+    Remembers the assets of a phase as loaded, see announce_phase_assets_on_save.
+    """
+    instance._saved_assets = _phase_assets(instance)
+
+@receiver(post_save, sender=CompetitionPhase)
+def announce_phase_assets_on_save(sender, instance, created, **kwargs):
+    """
+    Queues the announcement of the assets of a phase to the compute workers in warm mode when
+    a phase is created with assets or when its scoring program or reference data change. The
+    site worker sends the announcement. Outside of transaction management the save is
+    committed by the time the job is dispatched.
+    """
+    assets = _phase_assets(instance)
+    changed = created or assets != instance._saved_assets
+    instance._saved_assets = assets
+    if not changed or not any(assets) or getattr(settings, 'SBS_PHASE_ASSETS_TOPIC', None) is None:
+        return
+    from apps.web.tasks import dispatch_phase_assets_announcement
+    try:
+        dispatch_phase_assets_announcement(instance.pk)
+    except Exception:
+        logger.exception("Failed to queue the announcement of the assets of phase %s", instance.pk)
+
+@receiver(post_save, sender=PhaseLeaderBoardEntry)
+@receiver(post_delete, sender=PhaseLeaderBoardEntry)
+def evict_leaderboard_on_entry(sender, instance, **kwargs):
+    """
+    Evicts the cached leaderboard of a phase when an entry of its leaderboard changes. The
+    leaderboard snapshot notices the change on read, see CompetitionPhase.leaderboard_snapshot.
+    """
+    phase_ids = PhaseLeaderBoard.objects.filter(pk=instance.board_id).values_list('phase_id', flat=True)
+    for phase_id in phase_ids:
+        leaderboard_cache.invalidate(phase_id)
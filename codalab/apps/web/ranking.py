@@ -0,0 +1,372 @@
+"""
+Vectorized ranking of leaderboard scores.
+
+Scores are handled as dense arrays with one row per submission and one column per
+score definition. A boolean mask of the same shape tells which scores are present.
+Ranks follow the rules of the leaderboard:
+
+    - values are sorted in the direction of the score definition;
+    - a value shares the rank of the previous group as long as it is within eps of the
+      first value of that group (the anchor), otherwise it starts a new rank;
+    - submissions without a value get the rank following the last group;
+    - when no submission has a value, every submission is ranked 1.
+
+RankIndex applies the same rules to a single column which changes one submission at a time.
+"""
+import numpy as np
+
+DEFAULT_EPS = 1.0e-12
+
+
+def _mark_group_starts(keys, present_count, eps):
+    """
+    Sequentially marks where a new rank starts in a column of sorted keys. This is only
+    needed for chains of values which are each within eps of their neighbour but not all
+    within eps of the anchor of their group.
+
+    keys: Keys of one column, sorted with the present values first.
+    present_count: Number of present values in the column.
+    eps: Tolerance under which two values are considered equal.
+    """
+    starts = np.zeros(len(keys), dtype=bool)
+    starts[0] = True
+    if present_count < len(keys):
+        starts[present_count] = True
+    anchor = keys[0]
+    for i in range(1, present_count):
+        if abs(keys[i] - anchor) > eps:
+            starts[i] = True
+            anchor = keys[i]
+    return starts
+
+
+def rank_matrix(values, present, sort_ascending, eps=DEFAULT_EPS):
+    """
+    Ranks every column of a score matrix and returns a matrix of integer ranks with
+    the same shape.
+
+    values: Float array of shape (submissions, columns).
+    present: Boolean array of the same shape telling which values are known.
+    sort_ascending: Boolean, or boolean array with one entry per column, telling whether
+        lower values rank first.
+    eps: Tolerance under which two values are considered equal.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    present = np.asarray(present, dtype=bool)
+    n, m = values.shape
+    if n == 0 or m == 0:
+        return np.zeros((n, m), dtype=np.int64)
+
+    # Missing values sort last and form a group of their own.
+    keys = np.where(sort_ascending, values, -values)
+    keys = np.where(present, keys, np.inf)
+    order = np.argsort(keys, axis=0, kind='mergesort')
+    keys = np.take_along_axis(keys, order, axis=0)
+
+    with np.errstate(invalid='ignore'):
+        starts = np.zeros((n, m), dtype=bool)
+        starts[0] = True
+        starts[1:] = np.abs(np.diff(keys, axis=0)) > eps
+        # Find the columns where a group spans more than eps from its anchor. These
+        # need the sequential walk; every other column is settled by the gaps alone.
+        rows = np.arange(n).reshape((n, 1))
+        anchors = np.maximum.accumulate(np.where(starts, rows, 0), axis=0)
+        chained = np.abs(keys - np.take_along_axis(keys, anchors, axis=0)) > eps
+    present_counts = present.sum(axis=0)
+    for j in np.flatnonzero(chained.any(axis=0)):
+        starts[:, j] = _mark_group_starts(keys[:, j], present_counts[j], eps)
+
+    ranks = np.empty((n, m), dtype=np.int64)
+    np.put_along_axis(ranks, order, np.cumsum(starts, axis=0), axis=0)
+    return ranks
+
+
+def rank_column(values, present, sort_ascending=True, eps=DEFAULT_EPS):
+    """
+    Ranks a single column of values and returns an array of integer ranks.
+
+    values: Float array with one value per submission.
+    present: Boolean array telling which values are known.
+    sort_ascending: True if lower values rank first.
+    eps: Tolerance under which two values are considered equal.
+    """
+    values = np.asarray(values, dtype=np.float64).reshape((-1, 1))
+    present = np.asarray(present, dtype=bool).reshape((-1, 1))
+    return rank_matrix(values, present, sort_ascending, eps)[:, 0]
+
+
+def average_ranks(ranks, columns):
+    """
+    Returns the mean rank of every submission over the given columns of a rank matrix.
+
+    ranks: Integer array of shape (submissions, columns) as returned by rank_matrix.
+    columns: Indices of the columns to average.
+    """
+    return ranks[:, columns].sum(axis=1) / float(len(columns))
+
+
+def order_by_rank(ranks):
+    """
+    Returns the indices which sort submissions by rank. Submissions sharing a rank keep
+    their original order.
+
+    ranks: Integer array with one rank per submission.
+    """
+    return np.argsort(ranks, kind='mergesort')
+
+
+class _Node(object):
+    """
+    Node of the treap behind RankIndex. Nodes are ordered by (key, id). A node starts a new
+    rank when its key is more than eps away from the key of the previous node.
+    """
+    __slots__ = ('key', 'id', 'priority', 'left', 'right', 'start', 'starts')
+
+    def __init__(self, key, id, priority):
+        self.key = key
+        self.id = id
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.start = True
+        self.starts = 1
+
+    def update(self):
+        self.starts = 1 if self.start else 0
+        for child in (self.left, self.right):
+            if child is not None:
+                self.starts += child.starts
+
+
+def _copy(node):
+    """ Returns a copy of a treap. """
+    if node is None:
+        return None
+    copy = _Node(node.key, node.id, node.priority)
+    copy.left, copy.right = _copy(node.left), _copy(node.right)
+    copy.start, copy.starts = node.start, node.starts
+    return copy
+
+
+def _split(node, key):
+    """ Splits a treap into the nodes ordered before (key, id) and the others. """
+    if node is None:
+        return None, None
+    if (node.key, node.id) < key:
+        left, right = _split(node.right, key)
+        node.right = left
+        node.update()
+        return node, right
+    left, right = _split(node.left, key)
+    node.left = right
+    node.update()
+    return left, node
+
+
+def _merge(left, right):
+    """ Merges two treaps, all nodes of the left one being ordered before those of the right one. """
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    right.left = _merge(left, right.left)
+    right.update()
+    return right
+
+
+def _pop_first(node):
+    """ Detaches the first node of a treap and returns it with the remaining treap. """
+    if node.left is None:
+        rest = node.right
+        node.right = None
+        node.update()
+        return node, rest
+    first, node.left = _pop_first(node.left)
+    node.update()
+    return first, node
+
+
+def _first(node):
+    while node is not None and node.left is not None:
+        node = node.left
+    return node
+
+
+def _last(node):
+    while node is not None and node.right is not None:
+        node = node.right
+    return node
+
+
+class RankIndex(object):
+    """
+    Sorted index of the values of one score, ranking them with the same rules as rank_column.
+    Values can be added and removed, and ranks queried, in O(log n).
+
+    Ranks are counted from the nodes which start a new rank. This matches the anchor rule of
+    rank_column as long as no two distinct values are within eps of each other. When such
+    values exist (a near-eps chain), ranks are computed with a linear walk instead.
+    """
+    def __init__(self, sort_ascending=True, eps=DEFAULT_EPS, seed=None):
+        self.sort_ascending = sort_ascending
+        self.eps = eps
+        self._root = None
+        self._keys = {}
+        # number of adjacent pairs with distinct keys within eps of each other
+        self._near_pairs = 0
+        self._random = np.random.RandomState(seed)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, id):
+        return id in self._keys
+
+    def _key(self, value):
+        # Values are kept as given: Decimal scores are compared exactly.
+        return value if self.sort_ascending else -value
+
+    def _is_near(self, a, b):
+        return a is not None and b is not None and a.key != b.key and abs(b.key - a.key) <= self.eps
+
+    def _starts(self, previous, key):
+        return previous is None or abs(key - previous.key) > self.eps
+
+    def _set_first_start(self, node, start):
+        """ Sets the start flag of the first node of a treap and updates the counts on its path. """
+        path = []
+        while node is not None:
+            path.append(node)
+            node = node.left
+        if len(path) > 0 and path[-1].start != start:
+            path[-1].start = start
+            for n in reversed(path):
+                n.update()
+
+    def add(self, id, value):
+        """
+        Adds the value of a submission, replacing its previous value if any.
+
+        id: Identifier of the submission.
+        value: Value of the score.
+        """
+        if id in self._keys:
+            self.remove(id)
+        key = self._key(value)
+        left, right = _split(self._root, (key, id))
+        previous, following = _last(left), _first(right)
+        if self._is_near(previous, following):
+            self._near_pairs -= 1
+        node = _Node(key, id, self._random.random_sample())
+        node.start = self._starts(previous, key)
+        node.update()
+        if following is not None:
+            self._set_first_start(right, self._starts(node, following.key))
+        self._near_pairs += int(self._is_near(previous, node)) + int(self._is_near(node, following))
+        self._root = _merge(_merge(left, node), right)
+        self._keys[id] = key
+
+    def copy(self):
+        """ Returns an independent copy of the index, in O(n). """
+        copy = RankIndex(self.sort_ascending, self.eps)
+        copy._root = _copy(self._root)
+        copy._keys = dict(self._keys)
+        copy._near_pairs = self._near_pairs
+        copy._random.set_state(self._random.get_state())
+        return copy
+
+    def remove(self, id):
+        """
+        Removes the value of a submission. Does nothing if the submission is not indexed.
+
+        id: Identifier of the submission.
+        """
+        if id not in self._keys:
+            return
+        key = self._keys.pop(id)
+        left, right = _split(self._root, (key, id))
+        node, right = _pop_first(right)
+        previous, following = _last(left), _first(right)
+        self._near_pairs -= int(self._is_near(previous, node)) + int(self._is_near(node, following))
+        if following is not None:
+            self._set_first_start(right, self._starts(previous, following.key))
+        if self._is_near(previous, following):
+            self._near_pairs += 1
+        self._root = _merge(left, right)
+
+    def _count_starts_before(self, key):
+        """ Returns the number of rank starts among the nodes ordered before key. """
+        count = 0
+        node = self._root
+        while node is not None:
+            if (node.key, node.id) < key:
+                count += (node.left.starts if node.left is not None else 0) + (1 if node.start else 0)
+                node = node.right
+            else:
+                node = node.left
+        return count
+
+    def _linear_ranks(self):
+        """ Returns a dictionary id -> rank computed with the sequential anchor walk. """
+        ranks = {}
+        stack, node = [], self._root
+        rank, anchor = 0, None
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            if anchor is None or abs(node.key - anchor) > self.eps:
+                rank += 1
+                anchor = node.key
+            ranks[node.id] = rank
+            node = node.right
+        return ranks
+
+    def ranks(self):
+        """ Returns a dictionary id -> rank for every indexed submission, in O(n). """
+        if self._near_pairs == 0:
+            ranks = {}
+            stack, node, rank = [], self._root, 0
+            while stack or node is not None:
+                while node is not None:
+                    stack.append(node)
+                    node = node.left
+                node = stack.pop()
+                rank += 1 if node.start else 0
+                ranks[node.id] = rank
+                node = node.right
+            return ranks
+        return self._linear_ranks()
+
+    def rank(self, id):
+        """
+        Returns the rank of a submission. Submissions which are not indexed get the rank
+        following the last one, as missing values do in rank_column.
+
+        id: Identifier of the submission.
+        """
+        if id not in self._keys:
+            return self.missing_rank()
+        if self._near_pairs > 0:
+            return self._linear_ranks()[id]
+        return self._count_starts_before((self._keys[id], id)) + (1 if self._find(id).start else 0)
+
+    def _find(self, id):
+        key = (self._keys[id], id)
+        node = self._root
+        while (node.key, node.id) != key:
+            node = node.left if key < (node.key, node.id) else node.right
+        return node
+
+    def missing_rank(self):
+        """ Returns the rank of submissions without a value. """
+        if self._root is None:
+            return 1
+        if self._near_pairs > 0:
+            return max(self._linear_ranks().values()) + 1
+        return self._root.starts + 1
@@ -1,7 +1,7 @@
 """
 Defines background tasks needed by the web site.
 """
-import io
+import calendar
 import json
 import logging
 import yaml
@@ -11,19 +11,23 @@ from zipfile import ZipFile
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.mail import get_connection, EmailMultiAlternatives
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.template import Context
 from django.template.loader import render_to_string
 from django.contrib.sites.models import Site
 from apps.jobs.models import (Job,
                               run_job_task,
                               JobTaskResult,
-                              getQueue)
+                              getQueue,
+                              getTopic)
 from apps.web.models import (add_submission_to_leaderboard,
+                             update_leaderboard_snapshot,
                              Competition,
                              CompetitionSubmission,
                              CompetitionDefBundle,
+                             CompetitionPhase,
                              CompetitionSubmissionStatus,
+                             PhaseLeaderBoardEntry,
                              submission_prediction_output_filename,
                              submission_output_filename,
                              submission_private_output_filename,
@@ -32,6 +36,8 @@ from apps.web.models import (add_submission_to_leaderboard,
                              submission_history_file_name,
                              SubmissionScore,
                              SubmissionScoreDef)
+from apps.web import leaderboard_cache
+from apps.web.leaderboard import update_rank_index
 
 logger = logging.getLogger(__name__)
 
@@ -128,6 +134,58 @@ def _set_submission_status(submission_id, status_codename):
             logger.info("Skipping update of submission status: invalid transition %s -> %s  (id=%s).",
                         status_codename, old_status_codename, submission_id)
 
+def _parse_scores(text):
+    """
+    Parses the content of a scores.txt file into a list of (key, value) pairs. Each non-empty
+    line has the form 'key: value'.
+
+    text: The content of the scores file.
+    """
+    scores = []
+    for line in text.split("\n"):
+        if len(line.strip()) > 0:
+            label, value = line.split(":")
+            scores.append((label.strip(), float(value)))
+    return scores
+
+@transaction.commit_on_success
+def _save_submission_scores(submission, scores):
+    """
+    Saves the scores of a submission with one query for the score definitions of the
+    competition and a single INSERT. Scores whose key does not match a
+    score definition of the competition are skipped. When a key is repeated, its last value wins.
+    As in SubmissionScore.save, an IntegrityError is raised when a value is given for a computed
+    score.
+
+    submission: The CompetitionSubmission object to which the scores belong.
+    scores: A list of (key, value) pairs as returned by _parse_scores.
+    """
+    # Read from the database rather than the cached schema, which may miss a key just added.
+    scoredefs = dict((key, (scoredef_id, computed)) for (key, scoredef_id, computed) in
+                     SubmissionScoreDef.objects.filter(competition_id=submission.phase.competition_id).values_list(
+                         'key', 'id', 'computed'))
+    values = {}
+    for key, value in scores:
+        if key in scoredefs:
+            scoredef_id, computed = scoredefs[key]
+            if computed and value:
+                raise IntegrityError("Score is computed. Cannot assign a value")
+            values[scoredef_id] = value
+        else:
+            logger.warning("Score %s does not exist (submission_id=%s)", key, submission.id)
+    SubmissionScore.objects.bulk_create([SubmissionScore(result=submission, scoredef_id=sdef_id, value=sdef_value)
+                                         for (sdef_id, sdef_value) in values.iteritems()])
+    # bulk_create does not send post_save signals.
+    leaderboard_cache.invalidate(submission.phase_id)
+    return len(values)
+
+def phase_asset_names(phase):
+    """
+    Returns the names of the bundles provided by the organizers of a phase (scoring program,
+    reference and input data). Compute workers may cache these bundles across runs.
+    """
+    return [f.name for f in (phase.scoring_program, phase.reference_data, phase.input_data) if f]
+
 def predict(submission, job_id):
     """
     Dispatches the prediction taks for the given submission to an appropriate compute worker.
@@ -166,7 +224,9 @@ def predict(submission, job_id):
             "bundle_id" : submission.prediction_runfile.name,
             "container_name" : settings.BUNDLE_AZURE_CONTAINER,
             "reply_to" : settings.SBS_RESPONSE_QUEUE,
-            "execution_time_limit": submission.phase.execution_time_limit
+            "execution_time_limit": submission.phase.execution_time_limit,
+            "output_compression_level": submission.phase.output_compression_level,
+            "cached_bundles": phase_asset_names(submission.phase)
         }
     })
 
@@ -278,13 +338,79 @@ def score(submission, job_id):
             "bundle_id" : submission.runfile.name,
             "container_name" : settings.BUNDLE_AZURE_CONTAINER,
             "reply_to" : settings.SBS_RESPONSE_QUEUE,
-            "execution_time_limit": submission.phase.execution_time_limit
+            "execution_time_limit": submission.phase.execution_time_limit,
+            "output_compression_level": submission.phase.output_compression_level,
+            "cached_bundles": phase_asset_names(submission.phase)
         }
     })
     getQueue(settings.SBS_COMPUTE_QUEUE).send_message(body)
     if has_generated_predictions == False:
         _set_submission_status(submission.id, CompetitionSubmissionStatus.SUBMITTED)
 
+def phase_end_date(phase):
+    """
+    Returns the date when a phase ends: the start of the next phase, or the end of the
+    competition for the last phase. None if the end is not known.
+    """
+    next_phases = phase.competition.phases.filter(phasenumber=phase.phasenumber + 1)[:1]
+    if len(next_phases) > 0:
+        return next_phases[0].start_date
+    return phase.competition.end_date
+
+def announce_phase_assets(phase):
+    """
+    Announces the scoring program and reference data of a phase on the phase assets topic, so
+    that compute workers in warm mode stage them before the first submission needs them and
+    keep them until the phase ends. Does nothing if SBS_PHASE_ASSETS_TOPIC is not set or if
+    the phase has ended.
+
+    phase: The CompetitionPhase object.
+    """
+    topic_name = getattr(settings, 'SBS_PHASE_ASSETS_TOPIC', None)
+    if topic_name is None or phase.is_past:
+        return
+    bundles = [f.name for f in (phase.scoring_program, phase.reference_data) if f]
+    if len(bundles) == 0:
+        return
+    end_date = phase_end_date(phase)
+    body = json.dumps({
+        "id" : "phase-%d" % phase.pk,
+        "task_type": "prestage",
+        "task_args": {
+            "phase_id": phase.pk,
+            "container_name" : settings.BUNDLE_AZURE_CONTAINER,
+            "bundles": bundles,
+            "keep_until": None if end_date is None else calendar.timegm(end_date.utctimetuple())
+        }
+    })
+    getTopic(topic_name).send_message(body)
+
+def announce_phase_assets_task(job_id, args):
+    """
+    A task to announce the assets of a phase, see announce_phase_assets.
+
+    job_id: The ID of the job.
+    args: A dictionary with the arguments for the task. Expected items are:
+        args['phase_id']: The ID of the CompetitionPhase.
+    """
+    def announce_it(job):
+        """Announces the assets of the phase"""
+        phase = CompetitionPhase.objects.select_related('competition').get(pk=args['phase_id'])
+        announce_phase_assets(phase)
+        return JobTaskResult(status=Job.FINISHED)
+
+    run_job_task(job_id, announce_it)
+
+def dispatch_phase_assets_announcement(phase_id):
+    """
+    Queues the announcement of the assets of a phase for the site worker.
+
+    phase_id: The ID of the CompetitionPhase.
+
+    Returns a Job object which can be used to track the progress of the operation.
+    """
+    return Job.objects.create_and_dispatch_job('announce_phase_assets', {'phase_id': phase_id})
+
 class SubmissionUpdateException(Exception):
     """Defines an exception that occurs during the update of a CompetitionSubmission object."""
     def __init__(self, submission, inner_exception):
@@ -292,6 +418,20 @@ class SubmissionUpdateException(Exception):
         self.submission = submission
         self.inner_exception = inner_exception
 
+def _read_zip_member(field_file, member):
+    """
+    Returns the content of a member of a zip file stored in a FileField. Storages which can
+    read a single member (AzureStorage) do so without downloading the whole archive.
+
+    field_file: The FieldFile of the archive.
+    member: Name of the member in the archive.
+    """
+    storage = field_file.storage
+    if hasattr(storage, 'read_zip_member'):
+        return storage.read_zip_member(field_file.name, member)
+    with ZipFile(field_file) as zf:
+        return zf.read(member)
+
 def update_submission_task(job_id, args):
     """
     A task to update the status of a submission in a competition.
@@ -325,29 +465,28 @@ def update_submission_task(job_id, args):
                 submission.private_output_file.name = pathname2url(submission_private_output_filename(submission))
                 submission.save()
                 logger.debug("Retrieving output.zip and 'scores.txt' file (submission_id=%s)", submission.id)
-                ozip = ZipFile(io.BytesIO(submission.output_file.read()))
-                scores = open(ozip.extract('scores.txt'), 'r').read()
+                scores = _parse_scores(_read_zip_member(submission.output_file, 'scores.txt'))
                 logger.debug("Processing scores... (submission_id=%s)", submission.id)
-                for line in scores.split("\n"):
-                    if len(line) > 0:
-                        label, value = line.split(":")
-                        try:
-                            scoredef = SubmissionScoreDef.objects.get(competition=submission.phase.competition,
-                                                                      key=label.strip())
-                            SubmissionScore.objects.create(result=submission, scoredef=scoredef, value=float(value))
-                        except SubmissionScoreDef.DoesNotExist:
-                            logger.warning("Score %s does not exist (submission_id=%s)", label, submission.id)
-                logger.debug("Done processing scores... (submission_id=%s)", submission.id)
+                count = _save_submission_scores(submission, scores)
+                logger.debug("Done processing %s scores... (submission_id=%s)", count, submission.id)
                 _set_submission_status(submission.id, CompetitionSubmissionStatus.FINISHED)
-                # Automatically submit to the leaderboard?
+                if PhaseLeaderBoardEntry.objects.filter(result=submission).exists():
+                    # The scores were inserted in bulk, without signals.
+                    update_rank_index(submission.phase, added=submission.pk)
+                    on_leaderboard = True
+                else:
+                    on_leaderboard = False
+                # Automatically submit to the leaderboard? Adding updates the leaderboard snapshot.
                 if submission.phase.is_blind:
                     logger.debug("Adding to leaderboard... (submission_id=%s)", submission.id)
                     add_submission_to_leaderboard(submission)
                     logger.debug("Leaderboard updated with latest submission (submission_id=%s)", submission.id)
-
-                if submission.phase.competition.force_submission_to_leaderboard:
+                elif submission.phase.competition.force_submission_to_leaderboard:
                     add_submission_to_leaderboard(submission)
                     logger.debug("Force submission added submission to leaderboard (submission_id=%s)", submission.id)
+                elif on_leaderboard:
+                    update_leaderboard_snapshot(submission.phase, changed=[submission.pk])
+                    logger.debug("Leaderboard snapshot refreshed with new scores (submission_id=%s)", submission.id)
 
                 result = Job.FINISHED
             else:
@@ -0,0 +1,220 @@
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from io import BytesIO
+
+import azure
+
+from codalab.azure_storage import AzureBlockBlobFile
+from codalab.local_storage import LocalStorage
+from codalabtools.local_storage import LocalBlobService
+from django.core.files.base import ContentFile
+from django.test import TestCase
+
+from apps.web.tasks import _read_zip_member
+
+
+class CountingBlobService(LocalBlobService):
+
+    def __init__(self, root_path):
+        super(CountingBlobService, self).__init__(root_path)
+        self.ranges = []
+        self.heads = 0
+
+    def get_blob_properties(self, container_name, blob_name, x_ms_lease_id=None):
+        self.heads += 1
+        return super(CountingBlobService, self).get_blob_properties(container_name, blob_name)
+
+    def get_blob(self, container_name, blob_name, snapshot=None, x_ms_range=None, x_ms_lease_id=None,
+                 x_ms_range_get_content_md5=None):
+        self.ranges.append(x_ms_range)
+        return super(CountingBlobService, self).get_blob(container_name, blob_name, x_ms_range=x_ms_range)
+
+
+class BlockBlobReaderTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.service = CountingBlobService(self.root)
+        self.content = os.urandom(10000)
+        self.service.put_blob('c', 'data.bin', self.content, 'BlockBlob')
+
+    def open(self, name='data.bin', **kwargs):
+        return AzureBlockBlobFile(self.service, 'c', name, 'rb', **kwargs)
+
+    def test_seek_tell(self):
+        f = self.open(block_size=1000)
+        self.assertEqual(9990, f.seek(-10, 2))
+        self.assertEqual(self.content[-10:], f.read())
+        self.assertEqual(10000, f.tell())
+        self.assertEqual('', f.read(10))
+        f.seek(12000)
+        self.assertEqual('', f.read())
+        f.seek(1500)
+        f.seek(-500, 1)
+        self.assertEqual(self.content[1000:1010], f.read(10))
+        self.assertRaises(IOError, f.seek, -1)
+
+    def test_blocks_cached(self):
+        f = self.open(block_size=1000, cache_blocks=2)
+        f.seek(2100)
+        self.assertEqual(self.content[2100:2200], f.read(100))
+        f.seek(2500)
+        self.assertEqual(self.content[2500:2600], f.read(100))
+        self.assertEqual(['bytes=2000-2999'], self.service.ranges)
+        # A read spanning cached and missing blocks only fetches the missing ones, plus the
+        # read-ahead since reads continue from the last block.
+        f.seek(2900)
+        self.assertEqual(self.content[2900:4100], f.read(1200))
+        self.assertEqual(['bytes=2000-2999', 'bytes=3000-6999'], self.service.ranges)
+        # Only the most recent blocks stay cached.
+        f.seek(6000)
+        f.read(10)
+        f.seek(2000)
+        f.read(10)
+        self.assertEqual(['bytes=2000-2999', 'bytes=3000-6999', 'bytes=2000-2999'], self.service.ranges)
+
+    def test_sequential_read_ahead(self):
+        f = self.open(block_size=1000, read_ahead=3)
+        data = ''.join(iter(lambda: f.read(500), ''))
+        self.assertEqual(self.content, data)
+        self.assertEqual(['bytes=0-999', 'bytes=1000-4999', 'bytes=5000-8999', 'bytes=9000-9999'],
+                         self.service.ranges)
+
+    def test_zip_member(self):
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as z:
+            z.writestr('data.bin', os.urandom(200000))
+            z.writestr('scores.txt', 'accuracy: 0.5\n')
+            for i in range(50):
+                z.writestr('other/%d.txt' % i, os.urandom(10000))
+        self.service.put_blob('c', 'output.zip', archive.getvalue(), 'BlockBlob')
+        z = zipfile.ZipFile(self.open('output.zip', block_size=16384))
+        self.assertEqual('accuracy: 0.5\n', z.read('scores.txt'))
+        self.assertLessEqual(len(self.service.ranges), 4)
+
+
+class ZipMemberTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = LocalStorage(root_path=self.root, azure_container='bundles')
+        self.storage._connection = CountingBlobService(self.root)
+        self.large = os.urandom(300000)
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr('scores.txt', 'accuracy: 0.5\n')
+            z.writestr('predictions/large.bin', self.large)
+            for i in range(20):
+                z.writestr('predictions/%d.txt' % i, os.urandom(20000))
+        self.storage.save('output.zip', ContentFile(archive.getvalue()))
+
+    def test_list_members(self):
+        names = [info.filename for info in self.storage.list_zip_members('output.zip')]
+        self.assertEqual(22, len(names))
+        self.assertEqual(1, len(self.storage.connection.ranges))
+
+    def test_read_members(self):
+        self.assertEqual('accuracy: 0.5\n', self.storage.read_zip_member('output.zip', 'scores.txt'))
+        self.assertEqual(2, len(self.storage.connection.ranges))
+        self.assertEqual(self.large, self.storage.read_zip_member('output.zip', 'predictions/large.bin'))
+        self.assertLessEqual(len(self.storage.connection.ranges), 5)
+        self.assertRaises(KeyError, self.storage.read_zip_member, 'output.zip', 'missing.txt')
+
+    def test_read_zip_member_of_field_file(self):
+        class FieldFile(object):
+            storage = self.storage
+            name = 'output.zip'
+        self.assertEqual('accuracy: 0.5\n', _read_zip_member(FieldFile(), 'scores.txt'))
+
+
+class FlakyBlobService(LocalBlobService):
+
+    def __init__(self, root_path, failures):
+        super(FlakyBlobService, self).__init__(root_path)
+        self.failures = failures
+        self.blocks = []
+
+    def put_block(self, container_name, blob_name, block, blockid, content_md5=None, x_ms_lease_id=None):
+        self.blocks.append(blockid)
+        if self.failures.get(blockid, 0) > 0:
+            self.failures[blockid] -= 1
+            raise azure.WindowsAzureError("Server busy")
+        return super(FlakyBlobService, self).put_block(container_name, blob_name, block, blockid, content_md5)
+
+
+class BlockUploadTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        # Retries are logged as warnings.
+        logger = logging.getLogger('codalabtools')
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.ERROR)
+
+    def storage(self, failures):
+        storage = LocalStorage(root_path=self.root, azure_container='bundles', upload_block_size=1000,
+                               upload_threads=3)
+        storage.upload_retry_wait = 0
+        storage._connection = FlakyBlobService(self.root, failures)
+        return storage
+
+    def test_save_in_blocks(self):
+        storage = self.storage({'000002': 1})
+        content = os.urandom(4500)
+        name = storage.save('datasets/data.zip', ContentFile(content))
+        self.assertEqual(content, storage.open(name).read())
+        self.assertEqual(6, len(storage.connection.blocks))
+        self.assertIn('content-md5', storage.properties(name))
+
+    def test_failed_block(self):
+        storage = self.storage({'000001': 10})
+        storage.upload_max_retries = 0
+        self.assertRaises(azure.WindowsAzureError, storage.save, 'datasets/data.zip', ContentFile('x' * 3000))
+        self.assertFalse(storage.exists('datasets/data.zip'))
+
+
+class PropertiesCacheTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.storage = LocalStorage(root_path=self.root, azure_container='bundles')
+        self.storage._connection = CountingBlobService(self.root)
+        self.storage.connection.put_blob('bundles', 'a.zip', 'a', 'BlockBlob', x_ms_meta_name_values={'name': 'a.zip'})
+        self.addCleanup(self.storage.invalidate_properties, 'a.zip')
+
+    def test_cached(self):
+        for _ in range(3):
+            self.assertEqual('a.zip', self.storage.properties('a.zip')['x-ms-meta-name'])
+        self.assertEqual(1, self.storage.connection.heads)
+        # Missing Blobs are not cached.
+        for _ in range(2):
+            self.assertRaises(azure.WindowsAzureMissingResourceError, self.storage.properties, 'b.zip')
+        self.assertEqual(3, self.storage.connection.heads)
+
+    def test_exists_not_cached(self):
+        self.storage.properties('a.zip')
+        # Deleted without going through the storage, e.g. by another process.
+        self.storage.connection.delete_blob('bundles', 'a.zip')
+        self.assertFalse(self.storage.exists('a.zip'))
+        self.storage.connection.put_blob('bundles', 'b.zip', 'b', 'BlockBlob')
+        self.assertTrue(self.storage.exists('b.zip'))
+
+    def test_invalidated_on_write(self):
+        self.storage.properties('a.zip')
+        self.storage.delete('a.zip')
+        self.assertFalse(self.storage.exists('a.zip'))
+        self.storage.save('a.zip', ContentFile('new content'))
+        self.assertEqual('11', self.storage.properties('a.zip')['content-length'])
+
+    def test_disabled(self):
+        self.storage.properties_cache_ttl = 0
+        self.storage.properties('a.zip')
+        self.storage.properties('a.zip')
+        self.assertEqual(2, self.storage.connection.heads)
@@ -119,6 +119,14 @@ class CompetitionPhaseToPhase(TestCase):
 
         self.assertEquals(self.competition.last_phase_migration, 2)
 
+    def test_migrated_submissions_keep_original_filename(self):
+        CompetitionSubmission.objects.filter(phase=self.phase_1).update(original_filename="entry.zip")
+        with mock.patch('apps.web.tasks.evaluate_submission'):
+            self.competition.check_trailing_phase_submissions()
+
+        self.assertEquals(["entry.zip", "entry.zip"], list(CompetitionSubmission.objects.filter(
+            phase=self.phase_2).values_list('original_filename', flat=True)))
+
     def test_phase_to_phase_migrations_only_when_auto_migration_flag_is_true(self):
         with mock.patch('apps.web.models.Competition.do_phase_migration') as do_migration_mock:
             competition = Competition.objects.create(creator=self.user, modified_by=self.user)
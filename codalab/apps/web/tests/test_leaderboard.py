@@ -0,0 +1,574 @@
+import datetime
+import json
+from decimal import Decimal
+from StringIO import StringIO
+
+import mock
+import numpy as np
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+
+from apps.web import leaderboard_cache
+from apps.web import leaderboard
+from apps.web import ranking
+from apps.web.leaderboard import load_phase_scores
+from apps.web.models import (add_submission_to_leaderboard,
+                             Competition,
+                             CompetitionParticipant,
+                             CompetitionPhase,
+                             CompetitionSubmission,
+                             CompetitionSubmissionStatus,
+                             LeaderboardManagementMode,
+                             ParticipantStatus,
+                             PhaseLeaderBoard,
+                             PhaseLeaderBoardEntry,
+                             PhaseLeaderBoardSnapshot,
+                             PhaseLeaderBoardSnapshotEntry,
+                             SubmissionComputedScore,
+                             SubmissionComputedScoreField,
+                             SubmissionResultGroup,
+                             SubmissionResultGroupPhase,
+                             SubmissionScore,
+                             SubmissionScoreDef,
+                             SubmissionScoreDefGroup,
+                             SubmissionScoreSet,
+                             refresh_leaderboard_snapshot,
+                             update_leaderboard_snapshot)
+
+User = get_user_model()
+
+
+class LeaderboardTestCase(TestCase):
+    """
+    Builds a phase with one leaderboard made of two scores and an averaged rank column.
+    """
+    def setUp(self):
+        leaderboard_cache.get_leaderboard_cache().clear()
+        leaderboard.clear_schema_cache()
+        leaderboard.clear_rank_indexes()
+        self.organizer = User.objects.create_user(username="organizer", password="pass")
+        self.competition = Competition.objects.create(creator=self.organizer, modified_by=self.organizer)
+        self.phase = CompetitionPhase.objects.create(
+            competition=self.competition,
+            phasenumber=1,
+            start_date=datetime.datetime.now() - datetime.timedelta(days=30),
+        )
+        self.approved = ParticipantStatus.objects.get_or_create(name='approved', codename=ParticipantStatus.APPROVED)[0]
+        self.finished = CompetitionSubmissionStatus.objects.get_or_create(name="finished", codename="finished")[0]
+
+        self.group = SubmissionResultGroup.objects.create(competition=self.competition, key="results",
+                                                          label="Results", ordering=1)
+        SubmissionResultGroupPhase.objects.create(group=self.group, phase=self.phase)
+        self.accuracy = self.add_scoredef("accuracy", "Accuracy", sorting='desc', ordering=1)
+        self.error = self.add_scoredef("error", "Error", sorting='asc', ordering=2)
+        self.avg = self.add_scoredef("avg", "Avg rank", sorting='asc', ordering=3, computed=True, selection_default=1)
+        computed = SubmissionComputedScore.objects.create(scoredef=self.avg, operation='Avg')
+        SubmissionComputedScoreField.objects.create(computed=computed, scoredef=self.accuracy)
+        SubmissionComputedScoreField.objects.create(computed=computed, scoredef=self.error)
+
+        self.board = PhaseLeaderBoard.objects.create(phase=self.phase)
+
+    def add_scoredef(self, key, label, group=None, **kwargs):
+        sdef = SubmissionScoreDef.objects.create(competition=self.competition, key=key, label=label,
+                                                 show_rank=not kwargs.get('computed', False), **kwargs)
+        SubmissionScoreDefGroup.objects.create(scoredef=sdef, group=group or self.group)
+        SubmissionScoreSet.objects.create(competition=self.competition, key=key, label=label,
+                                          scoredef=sdef, ordering=sdef.ordering)
+        return sdef
+
+    def add_submission(self, username, scores):
+        user = User.objects.create_user(username=username, password="pass")
+        participant = CompetitionParticipant.objects.create(user=user, competition=self.competition,
+                                                            status=self.approved)
+        submission = CompetitionSubmission.objects.create(participant=participant, phase=self.phase)
+        submission.status = self.finished
+        submission.save()
+        for scoredef, value in scores.items():
+            SubmissionScore.objects.create(result=submission, scoredef=scoredef, value=value)
+        return submission
+
+    def add_entry(self, submission):
+        return PhaseLeaderBoardEntry.objects.create(board=self.board, result=submission)
+
+
+class LeaderboardSnapshotTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(LeaderboardSnapshotTests, self).setUp()
+        self.first = self.add_submission("first", {self.accuracy: 0.9, self.error: 0.1})
+        self.second = self.add_submission("second", {self.accuracy: 0.8, self.error: 0.3})
+        self.add_entry(self.second)
+        self.add_entry(self.first)
+
+    def test_scores_match_computed_leaderboard(self):
+        expected = self.phase.compute_scores()
+        for group in expected:
+            del group['group_id']
+        self.assertEqual(expected, self.phase.scores())
+
+    def test_board_scores(self):
+        self.assertEqual(self.phase.scores(), self.board.scores())
+
+    def test_scores_with_column_filters(self):
+        groups = self.phase.scores(key__in=["accuracy", "avg"])
+        self.assertEqual(["accuracy", "avg"], [header['key'] for header in groups[0]['headers']])
+        self.assertEqual(["first", "second"], [scores['username'] for rank, scores in groups[0]['scores']])
+
+    def test_scores_are_ranked(self):
+        groups = self.phase.scores()
+        self.assertEqual(1, len(groups))
+        self.assertEqual("avg", groups[0]['selection_key'])
+        self.assertEqual([(1, "first"), (2, "second")],
+                         [(rank, scores['username']) for rank, scores in groups[0]['scores']])
+
+    def test_scores_builds_snapshot_once(self):
+        self.phase.scores()
+        self.assertEqual(1, PhaseLeaderBoardSnapshot.objects.filter(phase=self.phase).count())
+        self.assertEqual(2, PhaseLeaderBoardSnapshotEntry.objects.filter(snapshot__phase=self.phase).count())
+        leaderboard_cache.invalidate(self.phase.pk)
+        # snapshots, entries fingerprint and snapshot entries
+        with self.assertNumQueries(3):
+            self.phase.scores()
+
+    def test_add_submission_to_leaderboard_refreshes_snapshot(self):
+        self.phase.scores()
+        third = self.add_submission("third", {self.accuracy: 0.95, self.error: 0.05})
+        add_submission_to_leaderboard(third)
+        groups = self.phase.scores()
+        self.assertEqual(["third", "first", "second"],
+                         [scores['username'] for rank, scores in groups[0]['scores']])
+
+    def assertSnapshotUpToDate(self):
+        expected = self.phase.compute_scores()
+        for group in expected:
+            del group['group_id']
+        self.assertEqual(expected, PhaseLeaderBoardSnapshot.read_groups(self.phase.leaderboard_snapshot()))
+
+    def test_snapshot_updated_incrementally(self):
+        self.phase.scores()
+        rows = list(PhaseLeaderBoardSnapshotEntry.objects.order_by('position').values_list('id', flat=True))
+        # Ranked last in every column: the rows above it do not change.
+        add_submission_to_leaderboard(self.add_submission("third", {self.accuracy: 0.1, self.error: 0.9}))
+        self.assertSnapshotUpToDate()
+        self.assertEqual(rows, list(PhaseLeaderBoardSnapshotEntry.objects.order_by('position').values_list(
+            'id', flat=True))[:2])
+        fourth = self.add_submission("fourth", {self.accuracy: 0.95})
+        add_submission_to_leaderboard(fourth)
+        self.assertSnapshotUpToDate()
+        PhaseLeaderBoardEntry.objects.get(result=self.first).delete()
+        update_leaderboard_snapshot(self.phase)
+        self.assertSnapshotUpToDate()
+        # Inserted in bulk, as by update_submission_task.
+        SubmissionScore.objects.bulk_create([SubmissionScore(result=fourth, scoredef=self.error, value=0.01)])
+        leaderboard.update_rank_index(self.phase, added=fourth.pk)
+        update_leaderboard_snapshot(self.phase, changed=[fourth.pk])
+        self.assertFalse(PhaseLeaderBoardSnapshot.objects.filter(phase=self.phase, stale=True).exists())
+        self.assertSnapshotUpToDate()
+
+    def test_scores_missing_from_snapshot_read_at_once(self):
+        third = self.add_submission("third", {self.accuracy: 0.5})
+        fourth = self.add_submission("fourth", {self.accuracy: 0.4})
+        self.add_entry(third)
+        self.add_entry(fourth)
+        self.phase.leaderboard_snapshot()
+        # Scores the snapshot shows as missing, inserted without marking it stale.
+        SubmissionScore.objects.bulk_create([SubmissionScore(result=third, scoredef=self.error, value=0.2),
+                                             SubmissionScore(result=fourth, scoredef=self.error, value=0.05)])
+        leaderboard.update_rank_index(self.phase, added=third.pk)
+        leaderboard.update_rank_index(self.phase, added=fourth.pk)
+        leaderboard.get_rank_index(self.phase)
+        # The missing scores are read in one query, with those of the changed submissions.
+        with self.assertNumQueries(11):
+            update_leaderboard_snapshot(self.phase)
+        self.assertSnapshotUpToDate()
+
+    def test_entry_change_noticed_on_read(self):
+        self.phase.leaderboard_snapshot()
+        # Cascades to the leaderboard entry without updating the snapshot.
+        self.first.delete()
+        self.assertSnapshotUpToDate()
+        self.add_entry(self.add_submission("third", {self.accuracy: 0.5, self.error: 0.5}))
+        self.assertSnapshotUpToDate()
+
+    def test_score_edit_marks_snapshot_stale(self):
+        self.phase.leaderboard_snapshot()
+        score = SubmissionScore.objects.get(result=self.second, scoredef=self.accuracy)
+        score.value = 0.99
+        score.save()
+        self.assertTrue(PhaseLeaderBoardSnapshot.objects.get(phase=self.phase).stale)
+        self.assertSnapshotUpToDate()
+        self.assertFalse(PhaseLeaderBoardSnapshot.objects.get(phase=self.phase).stale)
+
+    def test_current_snapshot_not_rebuilt(self):
+        snapshots = self.phase.leaderboard_snapshot()
+        self.assertEqual([s.pk for s in snapshots], [s.pk for s in self.phase.leaderboard_snapshot()])
+
+    def test_schema_change_drops_snapshot(self):
+        self.phase.scores()
+        self.accuracy.numeric_format = "4"
+        self.accuracy.save()
+        self.assertEqual(0, PhaseLeaderBoardSnapshot.objects.filter(phase=self.phase).count())
+        groups = self.phase.scores()
+        self.assertEqual("0.9000", groups[0]['scores'][0][1]['values'][0]['val'])
+
+    def test_invalidate_schema_drops_snapshot(self):
+        self.phase.scores()
+        leaderboard.invalidate_schema(self.competition.pk)
+        self.assertEqual(0, PhaseLeaderBoardSnapshot.objects.filter(phase=self.phase).count())
+        key = leaderboard_cache.cache_key(self.phase.pk, self.phase.leaderboard_management_mode)
+        self.assertIsNone(leaderboard_cache.get_leaderboard_cache().get(key))
+
+    def test_group_without_entries(self):
+        PhaseLeaderBoardEntry.objects.all().delete()
+        PhaseLeaderBoardSnapshot.objects.all().delete()
+        groups = self.phase.scores()
+        self.assertEqual(1, len(groups))
+        self.assertEqual(0, len(groups[0]['scores']))
+
+
+class ScoreLoaderTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(ScoreLoaderTests, self).setUp()
+        self.first = self.add_submission("first", {self.accuracy: 0.9, self.error: 0.1})
+        self.second = self.add_submission("second", {self.accuracy: 0.8})
+        self.add_entry(self.first)
+        self.add_entry(self.second)
+
+    def add_group(self, key, ordering, n_columns):
+        group = SubmissionResultGroup.objects.create(competition=self.competition, key=key,
+                                                     label=key, ordering=ordering)
+        SubmissionResultGroupPhase.objects.create(group=group, phase=self.phase)
+        for i in range(n_columns):
+            sdef = self.add_scoredef("%s_%d" % (key, i), "Column %d" % i, group=group, ordering=i + 1)
+            for submission in (self.first, self.second):
+                SubmissionScore.objects.create(result=submission, scoredef=sdef, value=i)
+        return group
+
+    def test_column_arrays(self):
+        loaded = load_phase_scores(self.phase)
+        self.assertEqual([self.first.id, self.second.id], loaded.submission_ids)
+        self.assertEqual(["first", "second"], loaded.usernames)
+        self.assertEqual([self.group.id], [g.id for g in loaded.groups])
+        self.assertEqual([self.accuracy.id, self.error.id, self.avg.id], loaded.groups[0].scoredef_ids)
+        self.assertEqual({self.avg.id: [self.accuracy.id, self.error.id]}, loaded.computed_deps)
+        self.assertEqual(set([self.accuracy.id, self.error.id]), set(loaded.columns))
+        accuracy, error = loaded.column_of[self.accuracy.id], loaded.column_of[self.error.id]
+        self.assertTrue(np.allclose([0.9, 0.8], loaded.values[:, accuracy]))
+        self.assertEqual([True, True], loaded.present[:, accuracy].tolist())
+        self.assertEqual([True, False], loaded.present[:, error].tolist())
+        self.assertEqual([Decimal("0.9"), Decimal("0.8")], loaded.stored[:, accuracy].tolist())
+        self.assertEqual([Decimal("0.1"), None], loaded.stored[:, error].tolist())
+
+    def test_rank_keys_are_exact(self):
+        loaded = load_phase_scores(self.phase)
+        j = loaded.column_of[self.accuracy.id]
+        # Both values round to the same float.
+        loaded.stored[:, j] = [Decimal("1234567890.1234567891"), Decimal("1234567890.1234567892")]
+        loaded.values[:, j] = [float(v) for v in loaded.stored[:, j]]
+        self.assertEqual(loaded.values[0, j], loaded.values[1, j])
+        self.assertEqual([0, 1], loaded.rank_keys()[:, j].tolist())
+        ranks = ranking.rank_matrix(loaded.rank_keys(), loaded.present, loaded.sort_ascending())
+        self.assertEqual([2, 1], ranks[:, j].tolist())
+
+    def test_query_count_is_flat(self):
+        # six queries to compile the schema, then entries and scores
+        with self.assertNumQueries(8):
+            self.phase.compute_scores()
+        with self.assertNumQueries(2):
+            self.phase.compute_scores()
+        self.add_group("extra", 2, 5)
+        self.add_group("more", 3, 8)
+        with self.assertNumQueries(8):
+            groups = self.phase.compute_scores()
+        with self.assertNumQueries(2):
+            self.phase.compute_scores()
+        self.assertEqual([3, 5, 8], [len(g['headers']) for g in groups])
+
+
+class SchemaCacheTests(LeaderboardTestCase):
+
+    def test_schema(self):
+        schema = leaderboard.get_schema(self.competition.pk)
+        self.assertEqual({"accuracy": self.accuracy.id, "error": self.error.id, "avg": self.avg.id}, schema.keys)
+        self.assertEqual([self.group.id], [g.id for g in schema.phase_groups(self.phase.pk)])
+        self.assertEqual('desc', schema.scoredefs[self.accuracy.id].sorting)
+        self.assertEqual({self.avg.id: 'Avg'}, schema.operations)
+
+    def test_cached(self):
+        schema = leaderboard.get_schema(self.competition.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(schema, leaderboard.get_schema(self.competition.pk))
+
+    def test_invalidated_on_schema_change(self):
+        schema = leaderboard.get_schema(self.competition.pk)
+        self.add_scoredef("recall", "Recall", ordering=4)
+        refreshed = leaderboard.get_schema(self.competition.pk)
+        self.assertIsNot(schema, refreshed)
+        self.assertIn("recall", refreshed.keys)
+
+    def test_invalidated_by_other_process(self):
+        schema = leaderboard.get_schema(self.competition.pk)
+        SubmissionScoreDef.objects.filter(pk=self.accuracy.pk).update(sorting='asc')
+        leaderboard_cache.bump_schema_version(self.competition.pk)
+        refreshed = leaderboard.get_schema(self.competition.pk)
+        self.assertIsNot(schema, refreshed)
+        self.assertEqual('asc', refreshed.scoredefs[self.accuracy.id].sorting)
+
+    def test_lru_bound(self):
+        with self.settings(LEADERBOARD_SCHEMA_CACHE_SIZE=1):
+            leaderboard.get_schema(self.competition.pk)
+            other = Competition.objects.create(creator=self.organizer, modified_by=self.organizer)
+            leaderboard.get_schema(other.pk)
+            with self.assertNumQueries(6):
+                leaderboard.get_schema(self.competition.pk)
+
+    def test_expired(self):
+        leaderboard.get_schema(self.competition.pk)
+        with self.settings(LEADERBOARD_SCHEMA_CACHE_TIMEOUT=0):
+            with self.assertNumQueries(6):
+                leaderboard.get_schema(self.competition.pk)
+
+
+class RankIndexTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(RankIndexTests, self).setUp()
+        self.submissions = [self.add_submission("first", {self.accuracy: 0.9, self.error: 0.3}),
+                            self.add_submission("second", {self.accuracy: 0.8, self.error: 0.1}),
+                            self.add_submission("third", {self.accuracy: 0.7, self.error: 0.4}),
+                            self.add_submission("fourth", {self.error: 0.2})]
+        for submission in self.submissions:
+            self.add_entry(submission)
+
+    def assertSameRanks(self):
+        ranks = dict((scores['id'], rank) for rank, scores in self.phase.compute_scores()[0]['scores'])
+        self.assertEqual(ranks, dict((s, leaderboard.submission_rank(CompetitionSubmission.objects.get(pk=s)))
+                                     for s in ranks))
+
+    def test_average_rank(self):
+        self.assertSameRanks()
+
+    def test_plain_selection(self):
+        self.accuracy.selection_default = 2
+        self.accuracy.save()
+        self.assertSameRanks()
+        self.assertEqual(4, leaderboard.submission_rank(self.submissions[3]))
+
+    def test_updated_on_add(self):
+        index = leaderboard.get_rank_index(self.phase)
+        fifth = self.add_submission("fifth", {self.accuracy: 0.95, self.error: 0.05})
+        self.assertIsNone(index.rank(fifth.pk))
+        add_submission_to_leaderboard(fifth)
+        updated = leaderboard.get_rank_index(self.phase)
+        self.assertEqual(1, updated.rank(fifth.pk))
+        # The index readers may hold is replaced, not changed.
+        self.assertIsNone(index.rank(fifth.pk))
+        self.assertSameRanks()
+
+    def test_updated_on_remove(self):
+        index = leaderboard.get_rank_index(self.phase)
+        PhaseLeaderBoardEntry.objects.get(result=self.submissions[0]).delete()
+        self.assertIsNone(leaderboard.get_rank_index(self.phase).rank(self.submissions[0].pk))
+        self.assertEqual(1, index.indexes[self.accuracy.id].rank(self.submissions[0].pk))
+        self.assertSameRanks()
+
+    def test_updated_on_score_change(self):
+        index = leaderboard.get_rank_index(self.phase)
+        score = SubmissionScore.objects.get(result=self.submissions[2], scoredef=self.accuracy)
+        score.value = 0.99
+        score.save()
+        updated = leaderboard.get_rank_index(self.phase)
+        self.assertEqual(1, updated.indexes[self.accuracy.id].rank(self.submissions[2].pk))
+        self.assertEqual(3, index.indexes[self.accuracy.id].rank(self.submissions[2].pk))
+        self.assertSameRanks()
+
+    def test_not_rebuilt_on_change(self):
+        leaderboard.get_rank_index(self.phase)
+        fifth = self.add_submission("fifth", {self.accuracy: 0.95})
+        with mock.patch('apps.web.leaderboard.load_phase_scores') as load_phase_scores:
+            self.add_entry(fifth)
+            self.assertIsNotNone(leaderboard.get_rank_index(self.phase).rank(fifth.pk))
+        self.assertFalse(load_phase_scores.called)
+        self.assertSameRanks()
+
+    def test_dropped_when_replaced_concurrently(self):
+        leaderboard.get_rank_index(self.phase)
+        fifth = self.add_submission("fifth", {self.accuracy: 0.95})
+        entry = leaderboard._rank_indexes[self.phase.pk]
+
+        def values(submission_id, columns):
+            # Another change replaces the cached index while this one is applied.
+            leaderboard._store_rank_index(self.phase.pk, entry[0], entry[1].copy())
+            return {self.accuracy.id: Decimal('0.95')}
+        with mock.patch('apps.web.leaderboard._submission_values', side_effect=values):
+            leaderboard.update_rank_index(self.phase, added=fifth.pk)
+        self.assertEqual([], leaderboard._rank_indexes.keys())
+
+    def test_rebuilt_on_unknown_change(self):
+        index = leaderboard.get_rank_index(self.phase)
+        fifth = self.add_submission("fifth", {self.accuracy: 0.95, self.error: 0.05})
+        # No signal is sent.
+        PhaseLeaderBoardEntry.objects.bulk_create([PhaseLeaderBoardEntry(board=self.board, result=fifth)])
+        self.assertIsNot(index, leaderboard.get_rank_index(self.phase))
+        self.assertSameRanks()
+
+    def test_rebuilt_on_change_in_other_process(self):
+        index = leaderboard.get_rank_index(self.phase)
+        SubmissionScore.objects.filter(result=self.submissions[2], scoredef=self.accuracy).update(value=0.99)
+        leaderboard_cache.bump_leaderboard_version(self.phase.pk)
+        self.assertIsNot(index, leaderboard.get_rank_index(self.phase))
+        self.assertSameRanks()
+
+    def test_dropped_when_change_missed(self):
+        leaderboard.get_rank_index(self.phase)
+        leaderboard_cache.bump_leaderboard_version(self.phase.pk)
+        self.add_entry(self.add_submission("fifth", {self.accuracy: 0.95, self.error: 0.05}))
+        self.assertEqual([], leaderboard._rank_indexes.keys())
+        self.assertSameRanks()
+
+    def test_rank_query(self):
+        leaderboard.get_rank_index(self.phase)
+        # One query to check that the leaderboard entries did not change.
+        with self.assertNumQueries(1):
+            leaderboard.submission_rank(self.submissions[1])
+
+
+class LeaderboardCacheTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(LeaderboardCacheTests, self).setUp()
+        self.first = self.add_submission("first", {self.accuracy: 0.9, self.error: 0.1})
+        self.add_entry(self.first)
+        self.phase.scores()
+
+    def test_shared_between_processes(self):
+        # Scores are stored by the site worker: its evictions must reach the web processes.
+        self.assertNotIsInstance(leaderboard_cache.get_leaderboard_cache(), LocMemCache)
+
+    def is_cached(self, mode=LeaderboardManagementMode.DEFAULT):
+        key = leaderboard_cache.cache_key(self.phase.pk, mode)
+        return leaderboard_cache.get_leaderboard_cache().get(key) is not None
+
+    def test_hit_without_queries(self):
+        leaderboard_cache.reset_stats()
+        with self.assertNumQueries(0):
+            groups = self.phase.scores()
+        self.assertEqual(["first"], [scores['username'] for rank, scores in groups[0]['scores']])
+        self.assertEqual({'hits': 1, 'misses': 0}, leaderboard_cache.get_stats())
+
+    def test_keyed_by_management_mode(self):
+        self.phase.leaderboard_management_mode = LeaderboardManagementMode.HIDE_RESULTS
+        leaderboard_cache.reset_stats()
+        self.phase.scores()
+        self.assertEqual({'hits': 0, 'misses': 1}, leaderboard_cache.get_stats())
+        self.assertTrue(self.is_cached(LeaderboardManagementMode.HIDE_RESULTS))
+        leaderboard_cache.invalidate(self.phase.pk)
+        self.assertFalse(self.is_cached(LeaderboardManagementMode.DEFAULT))
+        self.assertFalse(self.is_cached(LeaderboardManagementMode.HIDE_RESULTS))
+
+    def test_evicted_on_score_created(self):
+        second = self.add_submission("second", {})
+        self.assertTrue(self.is_cached())
+        SubmissionScore.objects.create(result=second, scoredef=self.accuracy, value=0.5)
+        self.assertFalse(self.is_cached())
+
+    def test_evicted_on_entry_change(self):
+        second = self.add_submission("second", {self.accuracy: 0.95, self.error: 0.2})
+        entry = PhaseLeaderBoardEntry.objects.create(board=self.board, result=second)
+        self.assertFalse(self.is_cached())
+        self.phase.scores()
+        entry.delete()
+        self.assertFalse(self.is_cached())
+
+    def test_evicted_on_snapshot_refresh(self):
+        add_submission_to_leaderboard(self.add_submission("second", {self.accuracy: 0.95, self.error: 0.05}))
+        self.assertEqual(["second", "first"],
+                         [scores['username'] for rank, scores in self.phase.scores()[0]['scores']])
+
+
+class LeaderboardExportTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(LeaderboardExportTests, self).setUp()
+        self.add_entry(self.add_submission("first", {self.accuracy: 0.9, self.error: 0.1}))
+        self.add_entry(self.add_submission("second", {self.accuracy: 0.8, self.error: 0.3}))
+        self.url = reverse('competitions:competition_results_download',
+                           kwargs={'id': self.competition.pk, 'phase': self.phase.pk})
+
+    def download(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        return ''.join(response.streaming_content)
+
+    def test_csv(self):
+        lines = self.download().splitlines()
+        self.assertEqual(["Results", "", "User,Accuracy,Error,Avg rank", '""',
+                          "first,0.9 (1),0.1 (1),1.0 (1)", "second,0.8 (2),0.3 (2),2.0 (2)", "", ""], lines)
+
+    def test_csv_without_entries(self):
+        PhaseLeaderBoardEntry.objects.all().delete()
+        self.assertIn("No data available", self.download())
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.download(format='ndjson').splitlines()]
+        self.assertEqual(["first", "second"], [row['username'] for row in rows])
+        self.assertEqual([1, 2], [row['rank'] for row in rows])
+        self.assertEqual({'name': "accuracy", 'value': "0.9", 'rank': 1}, rows[0]['scores'][0])
+
+    def test_unknown_format(self):
+        self.assertEqual(400, self.client.get(self.url, {'format': 'xml'}).status_code)
+
+    def test_entries_read_in_chunks(self):
+        snapshots = self.phase.leaderboard_snapshot()
+        # Two chunks of one row, then an empty chunk.
+        with self.assertNumQueries(3):
+            groups = PhaseLeaderBoardSnapshot.iter_groups(snapshots, chunk_size=1)
+            rows = [(snapshot.label, [scores['username'] for rank, scores in entries])
+                    for snapshot, entries in groups]
+        self.assertEqual([("Results", ["first", "second"])], rows)
+
+    def test_first_chunk_read_on_call(self):
+        snapshots = self.phase.leaderboard_snapshot()
+        with self.assertNumQueries(1):
+            groups = PhaseLeaderBoardSnapshot.iter_groups(snapshots)
+        with self.assertNumQueries(0):
+            self.assertEqual([["first", "second"]],
+                             [[scores['username'] for rank, scores in entries] for snapshot, entries in groups])
+
+    def test_entries_unaffected_by_refresh(self):
+        groups = PhaseLeaderBoardSnapshot.iter_groups(self.phase.leaderboard_snapshot())
+        refresh_leaderboard_snapshot(self.phase)
+        self.assertEqual([["first", "second"]],
+                         [[scores['username'] for rank, scores in entries] for snapshot, entries in groups])
+
+    def test_unread_entries_skipped(self):
+        other = SubmissionResultGroup.objects.create(competition=self.competition, key="other",
+                                                     label="Other", ordering=2)
+        SubmissionResultGroupPhase.objects.create(group=other, phase=self.phase)
+        self.add_scoredef("other", "Other", group=other)
+        snapshots = self.phase.leaderboard_snapshot()
+        labels = [snapshot.label for snapshot, entries in PhaseLeaderBoardSnapshot.iter_groups(snapshots)]
+        self.assertEqual(["Results", "Other"], labels)
+        groups = PhaseLeaderBoardSnapshot.iter_groups(snapshots)
+        next(groups)
+        snapshot, entries = next(groups)
+        self.assertEqual(["first", "second"], [scores['username'] for rank, scores in entries])
+
+
+class LeaderboardBenchmarkTests(TestCase):
+
+    def test_benchmark_command(self):
+        out = StringIO()
+        call_command('benchmark_leaderboard', participants='5', repeat=1, distribution='ties', stdout=out)
+        lines = out.getvalue().splitlines()
+        cases = [line[:18].strip() for line in lines[1:]]
+        self.assertEqual(["build", "refresh snapshot", "scores (cold)", "scores (warm)",
+                          "download csv", "download ndjson", "submissions page"], cases)
+        self.assertEqual(0, Competition.objects.count())
+        self.assertFalse(User.objects.filter(username__startswith="bench").exists())
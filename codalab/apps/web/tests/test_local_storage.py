@@ -0,0 +1,67 @@
+import base64
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from codalab.local_storage import LocalStorage, make_local_blob_url
+
+
+class LocalStorageTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        override = override_settings(LOCAL_STORAGE_ROOT=self.root, AZURE_CONTAINER='public')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.storage = LocalStorage(azure_container='bundles')
+
+    def test_save_and_open(self):
+        name = self.storage.save('competition/1/data.zip', ContentFile('x' * 200000))
+        self.assertEqual('competition/1/data.zip', name)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual('200000', self.storage.size(name))
+        self.assertEqual('competition/1/data_1.zip', self.storage.get_available_name(name))
+        f = self.storage.open(name)
+        f.seek(199990)
+        self.assertEqual('x' * 10, f.read(10))
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+
+    def test_upload_url(self):
+        url = self.storage.upload_url('submission/1.zip')
+        for (blockid, data) in (('000001', 'hello '), ('000002', 'world')):
+            response = self.client.put(url + '&comp=block&blockid=' + base64.b64encode(blockid), data,
+                                       content_type='application/octet-stream')
+            self.assertEqual(201, response.status_code)
+        block_list = '<BlockList><Latest>%s</Latest><Latest>%s</Latest></BlockList>' % (
+            base64.b64encode('000001'), base64.b64encode('000002'))
+        response = self.client.put(url + '&comp=blocklist', block_list, content_type='application/xml',
+                                   HTTP_X_MS_META_NAME='my submission.zip')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('my submission.zip', self.storage.properties('submission/1.zip')['x-ms-meta-name'])
+        self.assertEqual('hello world', self.storage.open('submission/1.zip').read())
+
+    def test_access_control(self):
+        self.storage.save('private.txt', ContentFile('secret'))
+        self.assertEqual(403, self.client.get(self.storage.url('private.txt')).status_code)
+        self.assertEqual(403, self.client.put(self.storage.url('private.txt'), 'x').status_code)
+        signed = make_local_blob_url('bundles', 'private.txt', 'r')
+        self.assertEqual('secret', self.client.get(signed).content)
+        self.assertEqual(403, self.client.get(signed.replace('sp=r', 'sp=w')).status_code)
+
+    def test_public_ranged_read(self):
+        public = LocalStorage(azure_container='public')
+        public.save('logos/1.png', ContentFile('0123456789'))
+        response = self.client.get(public.url('logos/1.png'), HTTP_RANGE='bytes=2-5')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('2345', response.content)
+        self.assertEqual('bytes 2-5/10', response['Content-Range'])
+        self.assertEqual(404, self.client.get(public.url('logos/2.png')).status_code)
+
+    def test_container_name_restricted(self):
+        self.assertEqual(404, self.client.get('/local-storage/../bundles/private.txt').status_code)
+        self.assertEqual(404, self.client.get('/local-storage/Bundles/private.txt').status_code)
@@ -0,0 +1,127 @@
+import numpy as np
+
+from django.test import TestCase
+
+from apps.web import ranking
+from apps.web.management.commands.benchmark_ranking import (rank_leaderboard_loop,
+                                                            rank_leaderboard_vectorized,
+                                                            rank_values_loop)
+from apps.web.tests.test_leaderboard import LeaderboardTestCase
+
+
+class RankingEngineTests(TestCase):
+
+    def assertSameRanks(self, values, present, sort_ascending, eps=ranking.DEFAULT_EPS):
+        ids = range(len(values))
+        expected = rank_values_loop(ids, {i: values[i] for i in ids if present[i]}, sort_ascending, eps)
+        actual = ranking.rank_column(values, present, sort_ascending, eps)
+        self.assertEqual([expected[i] for i in ids], actual.tolist())
+
+    def test_random_scores_match_loop(self):
+        rng = np.random.RandomState(42)
+        for sort_ascending in (True, False):
+            values = np.round(rng.rand(500), 2)
+            present = rng.rand(500) > 0.1
+            self.assertSameRanks(values, present, sort_ascending)
+
+    def test_all_missing(self):
+        ranks = ranking.rank_column(np.zeros(4), np.zeros(4, dtype=bool))
+        self.assertEqual([1, 1, 1, 1], ranks.tolist())
+
+    def test_missing_ranked_last(self):
+        ranks = ranking.rank_column([4.0, 0.0, 1.0, 4.0], [True, False, True, True])
+        self.assertEqual([2, 3, 1, 2], ranks.tolist())
+
+    def test_chain_within_eps_uses_anchor(self):
+        # Each value is within eps of its neighbour but not of the first value of its group.
+        values = [1.0, 1.006, 1.012, 1.018, 1.024, 2.0]
+        for sort_ascending in (True, False):
+            self.assertSameRanks(values, [True] * len(values), sort_ascending, eps=0.01)
+        self.assertEqual([1, 1, 2, 2, 3, 4], ranking.rank_column(values, [True] * 6, eps=0.01).tolist())
+
+    def test_matrix_directions(self):
+        values = np.array([[1.0, 1.0], [2.0, 2.0], [3.0, 3.0]])
+        ranks = ranking.rank_matrix(values, np.ones(values.shape, dtype=bool), np.array([True, False]))
+        self.assertEqual([[1, 3], [2, 2], [3, 1]], ranks.tolist())
+
+    def test_order_by_rank_is_stable(self):
+        self.assertEqual([1, 3, 0, 2], ranking.order_by_rank(np.array([2, 1, 3, 1])).tolist())
+
+    def test_leaderboard_matches_loop(self):
+        rng = np.random.RandomState(7)
+        values = np.round(rng.rand(300, 3), 2)
+        present = rng.rand(300, 3) > 0.05
+        sort_ascending = [True, False, True]
+        ids = range(300)
+        columns = [{i: values[i, j] for i in ids if present[i, j]} for j in range(3)]
+        overall, order = rank_leaderboard_vectorized(values, present, np.array(sort_ascending))
+        self.assertEqual(rank_leaderboard_loop(ids, columns, sort_ascending),
+                         zip(overall.tolist(), order.tolist()))
+
+
+class RankIndexTests(TestCase):
+
+    def assertMatchesColumn(self, index, values, sort_ascending, eps):
+        ids = sorted(values)
+        expected = ranking.rank_column([values[i] for i in ids], [True] * len(ids), sort_ascending, eps)
+        self.assertEqual(dict(zip(ids, expected.tolist())), index.ranks())
+        self.assertEqual(expected.tolist(), [index.rank(i) for i in ids])
+        self.assertEqual(expected.max() + 1, index.missing_rank())
+
+    def test_random_updates_match_column(self):
+        rng = np.random.RandomState(3)
+        for eps, scale in ((ranking.DEFAULT_EPS, 1.0), (0.01, 0.2)):
+            for sort_ascending in (True, False):
+                index = ranking.RankIndex(sort_ascending, eps, seed=1)
+                values = {}
+                for step in range(600):
+                    if len(values) > 0 and rng.rand() < 0.3:
+                        i = rng.choice(sorted(values))
+                        index.remove(i)
+                        del values[i]
+                    else:
+                        i = int(rng.randint(0, 200))
+                        values[i] = round(rng.rand() * scale, 3)
+                        index.add(i, values[i])
+                    if step % 50 == 49:
+                        self.assertMatchesColumn(index, values, sort_ascending, eps)
+
+    def test_empty(self):
+        index = ranking.RankIndex()
+        self.assertEqual(1, index.missing_rank())
+        self.assertEqual(1, index.rank(1))
+        index.add(1, 0.5)
+        index.remove(1)
+        self.assertEqual(0, len(index))
+
+    def test_ties(self):
+        index = ranking.RankIndex(sort_ascending=False)
+        for (i, value) in enumerate([0.5, 0.9, 0.5, 0.1]):
+            index.add(i, value)
+        self.assertEqual({0: 2, 1: 1, 2: 2, 3: 3}, index.ranks())
+        index.add(1, 0.5)
+        self.assertEqual({0: 1, 1: 1, 2: 1, 3: 2}, index.ranks())
+
+    def test_copy(self):
+        index = ranking.RankIndex(sort_ascending=False)
+        for (i, value) in enumerate([0.5, 0.9, 0.5, 0.1]):
+            index.add(i, value)
+        copy = index.copy()
+        copy.add(4, 0.95)
+        copy.remove(1)
+        self.assertEqual({0: 2, 1: 1, 2: 2, 3: 3}, index.ranks())
+        self.assertMatchesColumn(copy, {0: 0.5, 2: 0.5, 3: 0.1, 4: 0.95}, False, ranking.DEFAULT_EPS)
+
+
+class LeaderboardRankingTests(LeaderboardTestCase):
+
+    def test_missing_score(self):
+        self.add_entry(self.add_submission("complete", {self.accuracy: 0.5, self.error: 0.5}))
+        self.add_entry(self.add_submission("partial", {self.accuracy: 0.9}))
+        groups = self.phase.compute_scores()
+        ranked = dict((scores['username'], scores['values']) for rank, scores in groups[0]['scores'])
+        error = ranked['partial'][1]
+        self.assertEqual({'val': "-", 'rnk': 2, 'name': "error"}, error)
+        self.assertEqual({'val': "0.5", 'rnk': 1, 'name': "error"}, ranked['complete'][1])
+        # Both average a rank of 1.5 and tie on the selected column.
+        self.assertEqual([1, 1], [rank for rank, scores in groups[0]['scores']])
@@ -1,6 +1,8 @@
 import datetime
 import mock
+from StringIO import StringIO
 
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import Client
@@ -72,3 +74,41 @@ class CompetitionSubmissionTests(TestCase):
     def test_delete_view_returns_302_if_not_logged_in(self):
         resp = self.client.post(reverse("competitions:submission_delete", kwargs={"pk": self.submission_1.pk}))
         self.assertEquals(resp.status_code, 302)
+
+    def test_recorded_filename_needs_no_storage_call(self):
+        self.submission_1.original_filename = "my submission.zip"
+        with mock.patch.object(self.submission_1.file.storage, 'properties', create=True) as properties:
+            self.assertEqual("my submission.zip", self.submission_1.get_filename())
+        self.assertFalse(properties.called)
+
+    def test_filename_falls_back_to_stored_name(self):
+        self.submission_1.file.name = "competition/1/submission/2/abc.zip"
+        with mock.patch.object(self.submission_1.file.storage, 'properties', create=True) as properties:
+            with self.assertNumQueries(0):
+                self.assertEqual("abc.zip", self.submission_1.get_filename())
+        self.assertFalse(properties.called)
+
+    def test_filename_recorded_by_command(self):
+        CompetitionSubmission.objects.filter(pk=self.submission_1.pk).update(
+            file="competition/1/submission/2/abc.zip", original_filename="")
+        with mock.patch('apps.web.management.commands.record_submission_filenames.BundleStorage') as storage:
+            storage.properties.return_value = {'x-ms-meta-name': 'old.zip'}
+            call_command('record_submission_filenames', stdout=StringIO())
+        storage.properties.assert_called_once_with("competition/1/submission/2/abc.zip")
+        self.assertEqual("old.zip", CompetitionSubmission.objects.get(pk=self.submission_1.pk).original_filename)
+
+    def test_filename_command_resumes_after_failures(self):
+        CompetitionSubmission.objects.filter(pk=self.submission_1.pk).update(
+            file="competition/1/submission/2/abc.zip", original_filename="")
+        second = CompetitionSubmission.objects.create(participant=self.participant_1, phase=self.phase_1)
+        CompetitionSubmission.objects.filter(pk=second.pk).update(
+            file="competition/1/submission/3/def.zip", original_filename="")
+        with mock.patch('apps.web.management.commands.record_submission_filenames.BundleStorage') as storage:
+            storage.properties.side_effect = [IOError("timeout"), {'x-ms-meta-name': 'second.zip'}]
+            call_command('record_submission_filenames', batch_size=1, stdout=StringIO())
+            self.assertEqual("", CompetitionSubmission.objects.get(pk=self.submission_1.pk).original_filename)
+            storage.properties.side_effect = None
+            storage.properties.return_value = {'x-ms-meta-name': 'first.zip'}
+            call_command('record_submission_filenames', stdout=StringIO())
+        self.assertEqual(["first.zip", "second.zip"], [CompetitionSubmission.objects.get(pk=s.pk).original_filename
+                                                       for s in (self.submission_1, second)])
@@ -0,0 +1,178 @@
+import calendar
+import datetime
+import json
+
+import mock
+from django.db import IntegrityError
+from django.test.utils import override_settings
+from pytz import utc
+
+from apps.web import leaderboard_cache
+from apps.web.leaderboard import get_schema
+from apps.jobs.models import Job
+from apps.web.models import (Competition,
+                             CompetitionPhase,
+                             LeaderboardManagementMode,
+                             PhaseLeaderBoardEntry,
+                             SubmissionScore,
+                             SubmissionScoreDef)
+from apps.web.tasks import (_parse_scores,
+                             _save_submission_scores,
+                             announce_phase_assets_task,
+                             phase_asset_names,
+                             update_submission_task)
+from apps.web.tests.test_leaderboard import LeaderboardTestCase
+
+
+class ScoreIngestionTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(ScoreIngestionTests, self).setUp()
+        self.submission = self.add_submission("participant", {})
+
+    def test_parse_scores(self):
+        self.assertEqual([("accuracy", 0.5), ("error", 0.25)],
+                         _parse_scores("accuracy: 0.5\nerror:0.25\n\n"))
+
+    def test_scores_saved_in_one_insert(self):
+        scores = [("accuracy", 0.5), ("error", 0.25), ("unknown", 1.0)]
+        # The score definitions, then the insert.
+        with self.assertNumQueries(2):
+            self.assertEqual(2, _save_submission_scores(self.submission, scores))
+        saved = dict(SubmissionScore.objects.filter(result=self.submission).values_list('scoredef__key', 'value'))
+        self.assertEqual({"accuracy": 0.5, "error": 0.25}, dict((k, float(v)) for k, v in saved.items()))
+
+    def test_repeated_key_keeps_last_value(self):
+        _save_submission_scores(self.submission, [("accuracy", 0.5), ("accuracy", 0.75)])
+        self.assertEqual([0.75], [float(v) for v in
+                                  SubmissionScore.objects.filter(result=self.submission).values_list('value', flat=True)])
+
+    def test_key_missing_from_cached_schema(self):
+        get_schema(self.competition.pk)
+        # Added by another process: the cached schema is not invalidated here.
+        SubmissionScoreDef.objects.bulk_create([SubmissionScoreDef(competition=self.competition, key="recall",
+                                                                   label="Recall")])
+        self.assertEqual(1, _save_submission_scores(self.submission, [("recall", 0.5)]))
+
+    def test_computed_score_rejected(self):
+        with self.assertRaises(IntegrityError):
+            _save_submission_scores(self.submission, [("accuracy", 0.5), ("avg", 1.0)])
+        self.assertFalse(SubmissionScore.objects.filter(result=self.submission).exists())
+
+    def test_leaderboard_cache_evicted(self):
+        self.add_entry(self.submission)
+        self.phase.scores()
+        _save_submission_scores(self.submission, [("accuracy", 0.5)])
+        key = leaderboard_cache.cache_key(self.phase.pk, self.phase.leaderboard_management_mode)
+        self.assertIsNone(leaderboard_cache.get_leaderboard_cache().get(key))
+
+
+class UpdateSubmissionTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(UpdateSubmissionTests, self).setUp()
+        self.submission = self.add_submission("participant", {})
+        self.submission.execution_key = json.dumps({'score': 'job'})
+        self.submission.save()
+        self.job = Job.objects.create_job('evaluate_submission', {'submission_id': self.submission.pk})
+        patcher = mock.patch('apps.web.tasks._read_zip_member', return_value="accuracy: 0.5\nerror: 0.25\n")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def finish(self):
+        update = mock.Mock()
+        with mock.patch('apps.web.models.update_leaderboard_snapshot', update):
+            with mock.patch('apps.web.tasks.update_leaderboard_snapshot', update):
+                update_submission_task(self.job.pk, {'status': 'finished'})
+        self.assertEqual(Job.FINISHED, Job.objects.get(pk=self.job.pk).status)
+        return update
+
+    def test_rescored_entry_updates_snapshot(self):
+        self.add_entry(self.submission)
+        self.assertEqual(1, self.finish().call_count)
+
+    def test_blind_phase_updates_snapshot_once(self):
+        self.add_entry(self.submission)
+        CompetitionPhase.objects.filter(pk=self.phase.pk).update(
+            leaderboard_management_mode=LeaderboardManagementMode.HIDE_RESULTS)
+        Competition.objects.filter(pk=self.competition.pk).update(force_submission_to_leaderboard=True)
+        self.assertEqual(1, self.finish().call_count)
+        self.assertTrue(PhaseLeaderBoardEntry.objects.filter(result=self.submission).exists())
+
+
+@override_settings(SBS_PHASE_ASSETS_TOPIC='phaseassets', BUNDLE_AZURE_CONTAINER='bundles')
+class PhaseAssetsTests(LeaderboardTestCase):
+
+    def setUp(self):
+        super(PhaseAssetsTests, self).setUp()
+        patcher = mock.patch('apps.web.tasks.getTopic')
+        self.getTopic = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('apps.jobs.models.getQueue')
+        self.getQueue = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.next_start = datetime.datetime(2030, 1, 1, tzinfo=utc)
+        CompetitionPhase.objects.create(competition=self.competition, phasenumber=2, start_date=self.next_start)
+        self.phase = CompetitionPhase.objects.get(pk=self.phase.pk)
+
+    def run_jobs(self):
+        """ Runs the jobs queued for the site worker and returns their task types. """
+        task_types = []
+        for call in self.getQueue.return_value.send_message.call_args_list:
+            message = json.loads(call[0][0])
+            self.assertEqual('announce_phase_assets', message['task_type'])
+            announce_phase_assets_task(message['id'], message['task_args'])
+            task_types.append(message['task_type'])
+        self.getQueue.reset_mock()
+        return task_types
+
+    def sent_messages(self):
+        self.run_jobs()
+        return [json.loads(call[0][0]) for call in self.getTopic.return_value.send_message.call_args_list]
+
+    def test_assets_announced_on_change(self):
+        self.phase.scoring_program = 'competition/1/1/scoring_program.zip'
+        self.phase.reference_data = 'competition/1/1/reference_data.zip'
+        self.phase.save()
+        self.assertFalse(self.getTopic.return_value.send_message.called)
+        messages = self.sent_messages()
+        self.getTopic.assert_called_with('phaseassets')
+        self.assertEqual(1, len(messages))
+        self.assertEqual('prestage', messages[0]['task_type'])
+        self.assertEqual({'phase_id': self.phase.pk,
+                          'container_name': 'bundles',
+                          'bundles': ['competition/1/1/scoring_program.zip', 'competition/1/1/reference_data.zip'],
+                          'keep_until': calendar.timegm(self.next_start.utctimetuple())}, messages[0]['task_args'])
+
+    def test_unchanged_assets_not_announced(self):
+        self.phase.scoring_program = 'competition/1/1/scoring_program.zip'
+        self.phase.save()
+        self.assertEqual(['announce_phase_assets'], self.run_jobs())
+        self.phase.label = "Renamed"
+        self.phase.save()
+        CompetitionPhase.objects.get(pk=self.phase.pk).save()
+        self.assertEqual([], self.run_jobs())
+
+    def test_phase_created_with_assets_announced(self):
+        phase = CompetitionPhase.objects.create(competition=self.competition, phasenumber=3,
+                                                start_date=self.next_start,
+                                                scoring_program='competition/1/3/scoring_program.zip')
+        self.assertEqual([phase.pk], [m['task_args']['phase_id'] for m in self.sent_messages()])
+
+    def test_phase_without_assets_not_announced(self):
+        self.phase.save()
+        self.assertEqual([], self.run_jobs())
+        self.assertEqual([], self.sent_messages())
+
+    def test_past_phase_not_announced(self):
+        self.phase.start_date = datetime.datetime(2000, 1, 1, tzinfo=utc)
+        self.phase.scoring_program = 'competition/1/1/scoring_program.zip'
+        CompetitionPhase.objects.filter(phasenumber=2).update(start_date=datetime.datetime(2001, 1, 1, tzinfo=utc))
+        self.phase.save()
+        self.assertEqual([], self.sent_messages())
+
+    def test_asset_names(self):
+        self.phase.scoring_program = 'competition/1/1/scoring_program.zip'
+        self.phase.input_data = 'competition/1/1/input_data.zip'
+        self.assertEqual(['competition/1/1/scoring_program.zip', 'competition/1/1/input_data.zip'],
+                         phase_asset_names(self.phase))
@@ -1,5 +1,4 @@
 import datetime
-import StringIO
 import csv
 import json
 
@@ -9,7 +8,7 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import PermissionDenied
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.views.generic import View, TemplateView, DetailView, ListView, FormView, UpdateView, CreateView, DeleteView
 from django.views.generic.edit import FormMixin
 from django.views.generic.detail import SingleObjectMixin
@@ -26,6 +25,7 @@ from apps.web import models
 from apps.web import forms
 from apps.web import tasks
 from apps.web.bundles import BundleService
+from apps.web.leaderboard import invalidate_schema
 
 from extra_views import CreateWithInlinesView, UpdateWithInlinesView, InlineFormSet, NamedFormsetsMixin
 from extra_views import generic
@@ -112,6 +112,7 @@ class CompetitionEdit(LoginRequiredMixin, NamedFormsetsMixin, UpdateWithInlinesV
 
             phase_form.instance.save()
 
+        invalidate_schema(form.instance.pk)
         return save_result
 
     def get_context_data(self, **kwargs):
@@ -342,52 +343,85 @@ class CompetitionCheckMigrations(View):
 
         return HttpResponse()
 
+class _EchoBuffer(object):
+    """ File-like object returning what is written to it, so csv rows can be streamed. """
+    def write(self, value):
+        return value
+
+def _utf8(value):
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def _leaderboard_csv_rows(groups):
+    """ Yields the leaderboard of a phase as CSV lines, one result group after the other. """
+    csvwriter = csv.writer(_EchoBuffer())
+    for snapshot, entries in groups:
+        yield csvwriter.writerow([_utf8(snapshot.label)])
+        yield csvwriter.writerow([])
+
+        headers = ["User"]
+        sub_headers = [""]
+        for header in snapshot.headers:
+            subs = header['subs']
+            if subs:
+                for sub in subs:
+                    headers.append(_utf8(header['label']))
+                    sub_headers.append(_utf8(sub['label']))
+            else:
+                headers.append(_utf8(header['label']))
+        yield csvwriter.writerow(headers)
+        yield csvwriter.writerow(sub_headers)
+
+        empty = True
+        for rank, scores in entries:
+            empty = False
+            row = [_utf8(scores['username'])]
+            for v in scores['values']:
+                if 'rnk' in v:
+                    row.append("%s (%s)" % (v['val'], v['rnk']))
+                else:
+                    row.append("%s (%s)" % (v['val'], v['hidden_rnk']))
+            yield csvwriter.writerow(row)
+        if empty:
+            yield csvwriter.writerow(["No data available"])
+
+        yield csvwriter.writerow([])
+        yield csvwriter.writerow([])
+
+def _leaderboard_ndjson_rows(groups):
+    """ Yields the leaderboard of a phase as newline delimited JSON, one object per entry. """
+    for snapshot, entries in groups:
+        for rank, scores in entries:
+            yield json.dumps({
+                'group': snapshot.label,
+                'rank': rank,
+                'submission_id': scores['id'],
+                'username': scores['username'],
+                'scores': [{'name': v['name'], 'value': v['val'], 'rank': v.get('rnk', v.get('hidden_rnk'))}
+                           for v in scores['values']],
+            }) + "\n"
+
 class CompetitionResultsDownload(View):
+    # Streams the leaderboards of a phase as CSV, or as NDJSON with ?format=ndjson. Rows are
+    # read from the leaderboard snapshot in chunks, the first one before the response is
+    # returned (see PhaseLeaderBoardSnapshot.iter_groups).
+    formats = {
+        'csv': (_leaderboard_csv_rows, "text/csv"),
+        'ndjson': (_leaderboard_ndjson_rows, "application/x-ndjson"),
+    }
 
     def get(self, request, *args, **kwargs):
         competition = models.Competition.objects.get(pk=self.kwargs['id'])
         phase = competition.phases.get(pk=self.kwargs['phase'])
         if phase.is_blind:
             return HttpResponse(status=403)
-        groups = phase.scores()
-
-        csvfile = StringIO.StringIO()
-        csvwriter = csv.writer(csvfile)
-
-        for group in groups:
-            csvwriter.writerow([group['label']])
-            csvwriter.writerow([])
-
-            headers = ["User"]
-            sub_headers = [""]
-            for header in group['headers']:
-                subs = header['subs']
-                if subs:
-                    for sub in subs:
-                        headers.append(header['label'])
-                        sub_headers.append(sub['label'])
-                else:
-                    headers.append(header['label'])
-            csvwriter.writerow(headers)
-            csvwriter.writerow(sub_headers)
-
-            if len(group['scores']) <= 0:
-                csvwriter.writerow(["No data available"])
-            else:
-                for pk, scores in group['scores']:
-                    row = [scores['username']]
-                    for v in scores['values']:
-                        if 'rnk' in v:
-                            row.append("%s (%s)" % (v['val'], v['rnk']))
-                        else:
-                            row.append("%s (%s)" % (v['val'], v['hidden_rnk']))
-                    csvwriter.writerow(row)
-
-            csvwriter.writerow([])
-            csvwriter.writerow([])
+        format = request.GET.get('format', 'csv')
+        if format not in self.formats:
+            return HttpResponseBadRequest("Unknown format: %s" % format)
+        rows, content_type = self.formats[format]
 
-        response = HttpResponse(csvfile.getvalue(), status=200, content_type="text/csv")
-        response["Content-Disposition"] = "attachment; filename=test.csv"
+        groups = models.PhaseLeaderBoardSnapshot.iter_groups(phase.leaderboard_snapshot())
+        response = StreamingHttpResponse(rows(groups), status=200, content_type=content_type)
+        response["Content-Disposition"] = "attachment; filename=test.%s" % format
 
         return response
 
@@ -787,6 +821,14 @@ class SubmissionDelete(LoginRequiredMixin, DeleteView):
 
         return obj
 
+    def delete(self, request, *args, **kwargs):
+        submission = self.get_object()
+        was_in_leaderboard = models.PhaseLeaderBoardEntry.objects.filter(result=submission).exists()
+        response = super(SubmissionDelete, self).delete(request, *args, **kwargs)
+        if was_in_leaderboard:
+            models.update_leaderboard_snapshot(submission.phase)
+        return response
+
 
 @login_required
 def user_settings(request):
@@ -3,12 +3,17 @@ Common utilities to interact with Azure Storage.
 """
 
 import datetime
+import hashlib
 import os.path
 import re, itertools
+from collections import OrderedDict
 from django.core.files.base import File
+from django.core.cache import get_cache
 from django.core.files.storage import Storage
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import smart_str
 from io import RawIOBase, BufferedRWPair, BufferedWriter
+from zipfile import ZipFile
 
 #keep consistent path separators
 pathjoin = lambda *args: os.path.join(*args).replace("\\", "/")
@@ -20,8 +25,6 @@ try:
     from azure.storage import (
         AccessPolicy,
         BlobService,
-        SharedAccessPolicy,
-        SharedAccessSignature,
         StorageServiceProperties,
     )
     from azure.storage.sharedaccesssignature import (
@@ -40,6 +43,7 @@ except ImportError:
         "See https://github.com/WindowsAzure/azure-sdk-for-python")
 
 from storages.utils import setting
+from codalabtools.azure_extensions import BlobUploader
 
 
 def clean_name(name):
@@ -47,12 +51,29 @@ def clean_name(name):
 
 
 class AzureStorage(Storage):
-    chunk_size = 65536
+    # Defaults of the block uploads of _save.
+    upload_block_size = 4 * 1024 * 1024
+    upload_threads = 4
+    upload_max_retries = 3
+    upload_retry_wait = 1.0
+    # Seconds Blob properties stay in the cache named by AZURE_PROPERTIES_CACHE; 0 disables
+    # the cache. Properties are evicted when the Blob is stored or deleted through the storage.
+    # exists() does not use the cache.
+    properties_cache_ttl = 300
+    # Block size used to read zip Blobs: the end of central directory of most archives and
+    # their small members fit in a block.
+    zip_block_size = 65536
 
     def __init__(self, *args, **kwargs):
         self.account_name = kwargs.pop('account_name', setting("AZURE_ACCOUNT_NAME"))
         self.account_key = kwargs.pop('account_key', setting("AZURE_ACCOUNT_KEY"))
         self.azure_container = kwargs.pop('azure_container', setting("AZURE_CONTAINER"))
+        self.read_block_size = kwargs.pop('read_block_size', setting("AZURE_READ_BLOCK_SIZE"))
+        self.upload_block_size = kwargs.pop('upload_block_size',
+                                            setting("AZURE_UPLOAD_BLOCK_SIZE", self.upload_block_size))
+        self.upload_threads = kwargs.pop('upload_threads', setting("AZURE_UPLOAD_THREADS", self.upload_threads))
+        self.properties_cache_ttl = kwargs.pop('properties_cache_ttl',
+                                               setting("AZURE_PROPERTIES_CACHE_TTL", self.properties_cache_ttl))
         super(AzureStorage, self).__init__(*args, **kwargs)
         self._connection = None
 
@@ -64,11 +85,16 @@ class AzureStorage(Storage):
         return self._connection
 
     def _open(self, name, mode="rb"):
-        return AzureBlockBlobFile(self.connection, self.azure_container, name, mode)
+        if 'w' in mode:
+            self.invalidate_properties(name)
+        return AzureBlockBlobFile(self.connection, self.azure_container, name, mode,
+                                  block_size=self.read_block_size)
 
     def exists(self, name):
+        # Not served from the properties cache: Blobs are also written and deleted by compute
+        # workers and by browsers through SAS URLs, which do not evict cached properties.
         try:
-            p = self.properties(name)
+            self.connection.get_blob_properties(self.azure_container, name)
         except azure.WindowsAzureMissingResourceError:
             return False
         else:
@@ -76,27 +102,94 @@ class AzureStorage(Storage):
 
     def delete(self, name):
         self.connection.delete_blob(self.azure_container, name)
+        self.invalidate_properties(name)
 
     def _save(self, name, content):
-        f = self._open(name, 'wb')
-        cur = 0
-        while True:
-            data = content.read(self.chunk_size)
-            if not len(data): break
-            f.write(data)
-        f.close()
+        # Blocks are uploaded by a bounded pool of threads while the content is read, each
+        # block being retried on its own, then committed with a single put_block_list.
+        uploader = BlobUploader(self.connection, self.azure_container, block_size=self.upload_block_size,
+                                max_threads=self.upload_threads, max_retries=self.upload_max_retries,
+                                retry_wait=self.upload_retry_wait)
+        try:
+            writer = uploader.open(name)
+            for data in iter(lambda: content.read(self.upload_block_size), ''):
+                writer.write(data)
+        except:
+            uploader.close()
+            raise
+        uploader.commit()
+        self.invalidate_properties(name)
         return name
 
     def url(self, name):
         return "https://%s%s/%s/%s" % (self.account_name, azure.BLOB_SERVICE_HOST_BASE, self.azure_container, name)
 
+    def upload_url(self, name, duration=16):
+        """
+        Returns a SAS URL which a client can use to upload the Blob with the given name.
+
+        duration: Validity of the URL in minutes.
+        """
+        return make_blob_sas_url(self.account_name, self.account_key, self.azure_container, name, duration)
+
+    def _properties_cache(self):
+        return get_cache(setting("AZURE_PROPERTIES_CACHE", 'default'))
+
+    def _properties_key(self, name):
+        blob = "%s/%s/%s" % (self.account_name, self.azure_container, clean_name(name))
+        return 'azure-properties:%s' % hashlib.md5(smart_str(blob)).hexdigest()
+
     def properties(self, name):
-        return self.connection.get_blob_properties(
-            self.azure_container, name)
+        """
+        Returns the properties of a Blob, including its x-ms-meta-* metadata. Served from the
+        cache when possible. Missing Blobs are not cached.
+        """
+        if self.properties_cache_ttl <= 0:
+            return self.connection.get_blob_properties(self.azure_container, name)
+        key = self._properties_key(name)
+        properties = self._properties_cache().get(key)
+        if properties is None:
+            properties = self.connection.get_blob_properties(self.azure_container, name)
+            self._properties_cache().set(key, properties, self.properties_cache_ttl)
+        return properties
+
+    def invalidate_properties(self, name):
+        """Evicts the cached properties of a Blob."""
+        if self.properties_cache_ttl > 0:
+            self._properties_cache().delete(self._properties_key(name))
 
     def size(self, name):
         return self.properties(name)["content-length"]
 
+    def _open_zip(self, name):
+        f = AzureBlockBlobFile(self.connection, self.azure_container, name, 'rb', block_size=self.zip_block_size)
+        return f, ZipFile(f)
+
+    def list_zip_members(self, name):
+        """
+        Returns the ZipInfo of the members of a zip Blob. Only the end of the Blob, which holds
+        the central directory, is fetched.
+        """
+        return self._open_zip(name)[1].infolist()
+
+    def read_zip_member(self, name, member):
+        """
+        Returns the content of a member of a zip Blob. Only the central directory and the
+        range of the member are fetched.
+
+        name: Name of the Blob.
+        member: Name of the member in the archive.
+        """
+        f, zf = self._open_zip(name)
+        info = zf.getinfo(member)
+        # Fetch the local header and the data with a single request and keep them cached while
+        # ZipFile reads them. The local extra field is assumed to match the central one.
+        length = 30 + len(info.filename) + len(info.extra) + info.compress_size
+        f.cache_blocks = max(f.cache_blocks, length // f.block_size + 2)
+        f.seek(info.header_offset)
+        f.read(length)
+        return zf.read(info)
+
     def get_available_name(self, name):
         dir_path, file_name = os.path.split(name)
         name = clean_name(name)
@@ -113,13 +206,33 @@ class AzureStorage(Storage):
 
 
 class AzureBlockBlobFile(RawIOBase):
+    """
+    File-like object over a block Blob.
+
+    Reads go through a buffer of aligned blocks of block_size bytes, kept in an LRU of
+    cache_blocks entries, so small reads at nearby offsets (e.g. ZipFile walking a central
+    directory) are served without new requests. Missing blocks are fetched with a single
+    ranged request. When reads are sequential, the request also fetches the read_ahead
+    following blocks.
+
+    Writes upload one block per call and are committed by flush or close.
+    """
+    block_size = 1024 * 1024
+    read_ahead = 2
+    cache_blocks = 8
 
-    def __init__(self, connection, container, name, mode):
+    def __init__(self, connection, container, name, mode, block_size=None, read_ahead=None, cache_blocks=None):
         name = clean_name(name)
         self.connection = connection
         self.name = name
         self.container = container
         self.mode = mode
+        if block_size is not None:
+            self.block_size = block_size
+        if read_ahead is not None:
+            self.read_ahead = read_ahead
+        if cache_blocks is not None:
+            self.cache_blocks = cache_blocks
         self._properties = None
         if 'w' in mode:
             try:
@@ -129,7 +242,8 @@ class AzureBlockBlobFile(RawIOBase):
             except azure.WindowsAzureMissingResourceError as e:
                 res = self.connection.put_blob(self.container, self.name, '', "BlockBlob")
         self._cur = 0
-        self._end = (int(self.properties['content-length']) - 1) if int(self.properties['content-length']) > 0 else 0
+        self._blocks = OrderedDict()
+        self._last_block = None
         self._block_list = []
 
     @property
@@ -142,37 +256,84 @@ class AzureBlockBlobFile(RawIOBase):
     def size(self):
         return int(self.properties.get('content-length'))
 
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
     def seek(self, offset, from_what=0):
         if from_what == 2:
-            pos = int(offset) + (self.size - 1)
+            pos = self.size + int(offset)
         elif from_what == 1:
             pos = self._cur + int(offset)
         else:
             pos = int(offset)
+        if pos < 0:
+            raise IOError("Cannot seek before the start of the file")
         self.flush()
-        if pos > self._end:
-            raise Exception("Cannot seek past end of file")
         self._cur = pos
+        return pos
 
     def tell(self):
         return self._cur
 
-    def read(self, num_bytes=None):
-        start = self._cur
-        if not num_bytes:
-            end = self.size -1
-        else:
-            end = self._cur+num_bytes-1
-        if self._cur > self._end:
-            raise Exception("Something odd happened.")
-        if self._cur == self._end and not num_bytes:
-            return None
-        if self._end < end:
-            end = self._end
+    def _fetch(self, first, last):
+        """
+        Fetches blocks first to last (included) with a single request. Returns their content
+        and keeps them in the cache.
+        """
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size) - 1
         content = self.connection.get_blob(self.container,
                                            self.name,
                                            x_ms_range='bytes=%d-%d' % (start, end))
-        self._cur = self._cur + len(content) if self._cur < self._end else self._end
+        blocks = [content[i:i + self.block_size] for i in range(0, len(content), self.block_size)]
+        for (index, block) in enumerate(blocks, first):
+            self._blocks[index] = block
+        while len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+        return blocks
+
+    def read(self, num_bytes=-1):
+        size = self.size
+        if num_bytes is None or num_bytes < 0:
+            num_bytes = size - self._cur
+        end = min(self._cur + num_bytes, size)
+        if self._cur >= end:
+            return ''
+        first = self._cur // self.block_size
+        last = (end - 1) // self.block_size
+        sequential = self._last_block is not None and self._last_block <= first <= self._last_block + 1
+        blocks = []
+        index = first
+        while index <= last:
+            if index in self._blocks:
+                # Most recently used blocks are kept at the end.
+                self._blocks[index] = self._blocks.pop(index)
+                blocks.append(self._blocks[index])
+                index += 1
+                continue
+            # Fetch the run of missing blocks with one request.
+            run_last = index
+            while run_last < last and run_last + 1 not in self._blocks:
+                run_last += 1
+            fetch_last = run_last
+            if run_last == last and sequential:
+                fetch_last = min(last + self.read_ahead, (size - 1) // self.block_size)
+                for following in range(last + 1, fetch_last + 1):
+                    if following in self._blocks:
+                        fetch_last = following - 1
+                        break
+            fetched = self._fetch(index, fetch_last)
+            if len(fetched) < run_last - index + 1:
+                raise IOError("Blob %s is shorter than expected." % self.name)
+            blocks.extend(fetched[:run_last - index + 1])
+            index = run_last + 1
+        self._last_block = last
+        offset = self._cur - first * self.block_size
+        content = ''.join(blocks)[offset:offset + end - self._cur]
+        self._cur += len(content)
         return content
 
     def write(self, data):
@@ -187,7 +348,9 @@ class AzureBlockBlobFile(RawIOBase):
     def flush(self):
         if self._block_list:
             self.connection.put_block_list(self.container, self.name, [b[0] for b in self._block_list])
-            self._end = sum([b[1] for b in self._block_list]) - 1
+            self._properties = None
+            self._blocks.clear()
+            self._last_block = None
             self._cur = 0
             self._block_list = []
 
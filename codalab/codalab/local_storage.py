@@ -0,0 +1,170 @@
+"""
+Storage backend keeping files in a local directory with the semantics of Azure Storage.
+
+LocalStorage is a drop-in replacement for AzureStorage backed by a LocalBlobService, for
+single node deployments and tests. Set DEFAULT_FILE_STORAGE to
+'codalab.local_storage.LocalStorage' and LOCAL_STORAGE_ROOT to the directory holding the
+Blobs; compute workers given the same directory in their 'local-storage' configuration
+section see the same Blobs.
+
+Blobs are served by blob_view, which mimics the Blob REST API used by the browser: GET with
+an optional Range header, and PUT of a Blob, of a block (comp=block) or of a block list
+(comp=blocklist) with x-ms-meta-* headers. Writes require an upload URL signed by
+LocalStorage.upload_url, the counterpart of a SAS URL. Reads are open for the public
+container (AZURE_CONTAINER) and require a signed URL otherwise.
+"""
+import base64
+import re
+import time
+import urllib
+from xml.etree import ElementTree
+
+import azure
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.views.decorators.csrf import csrf_exempt
+from storages.utils import setting
+
+from codalab.azure_storage import AzureStorage
+from codalabtools.local_storage import LocalBlobService
+
+_SIGNATURE_SALT = 'codalab.local_storage'
+
+def _signature(container_name, blob_name, permission, expiry):
+    value = "%s/%s\n%s\n%d" % (container_name, blob_name, permission, expiry)
+    return salted_hmac(_SIGNATURE_SALT, value).hexdigest()
+
+def make_local_blob_url(container_name, blob_name, permission=None, duration=16):
+    """
+    Returns the URL of a Blob served by blob_view.
+
+    container_name: Name of the container.
+    blob_name: Name of the Blob.
+    permission: None for a plain URL, 'r' or 'w' for a URL signed to read or write the Blob.
+    duration: Validity of a signed URL in minutes.
+    """
+    url = reverse('local_storage_blob', kwargs={'container_name': container_name, 'blob_name': blob_name})
+    if permission is None:
+        return url
+    expiry = int(time.time() + duration * 60)
+    query = urllib.urlencode([('se', expiry),
+                              ('sp', permission),
+                              ('sig', _signature(container_name, blob_name, permission, expiry))])
+    return "%s?%s" % (url, query)
+
+def _get_blob_service():
+    root_path = getattr(settings, 'LOCAL_STORAGE_ROOT', None)
+    if root_path is None:
+        raise Http404
+    return LocalBlobService(root_path)
+
+class LocalStorage(AzureStorage):
+    """
+    AzureStorage keeping its Blobs in the directory given by LOCAL_STORAGE_ROOT.
+    """
+    def __init__(self, *args, **kwargs):
+        self.root_path = kwargs.pop('root_path', setting("LOCAL_STORAGE_ROOT"))
+        if self.root_path is None:
+            raise ImproperlyConfigured("LOCAL_STORAGE_ROOT must be set to use LocalStorage.")
+        super(LocalStorage, self).__init__(*args, **kwargs)
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = LocalBlobService(self.root_path)
+        return self._connection
+
+    def url(self, name):
+        return make_local_blob_url(self.azure_container, name)
+
+    def upload_url(self, name, duration=16):
+        return make_local_blob_url(self.azure_container, name, 'w', duration)
+
+def _is_authorized(request, container_name, blob_name, permission):
+    try:
+        expiry = int(request.GET.get('se', ''))
+    except ValueError:
+        return False
+    if expiry < time.time() or request.GET.get('sp') != permission:
+        return False
+    return constant_time_compare(request.GET.get('sig', ''),
+                                 _signature(container_name, blob_name, permission, expiry))
+
+def _metadata(request):
+    """Returns the x-ms-meta-* headers of a request as a dictionary."""
+    metadata = {}
+    for (key, value) in request.META.items():
+        if key.startswith('HTTP_X_MS_META_'):
+            metadata[key[len('HTTP_X_MS_META_'):].lower()] = value
+    return metadata
+
+def _serve(request, service, container_name, blob_name):
+    properties = service.get_blob_properties(container_name, blob_name)
+    size = int(properties['content-length'])
+    x_ms_range = request.META.get('HTTP_RANGE') or request.META.get('HTTP_X_MS_RANGE')
+    if x_ms_range is not None and size > 0:
+        match = re.match(r'^bytes=(\d+)-(\d*)$', x_ms_range)
+        if match is None or int(match.group(1)) >= size:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        data = service.get_blob(container_name, blob_name, x_ms_range=x_ms_range)
+        first = int(match.group(1))
+        response = HttpResponse(data, status=206, content_type=properties['content-type'])
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, first + len(data) - 1, size)
+    else:
+        data = '' if request.method == 'HEAD' else service.get_blob(container_name, blob_name)
+        response = HttpResponse(data, content_type=properties['content-type'])
+    response['Accept-Ranges'] = 'bytes'
+    for (name, value) in properties.items():
+        if name in ('etag', 'last-modified', 'content-md5', 'x-ms-blob-type') or name.startswith('x-ms-meta-'):
+            response[name] = value
+    if request.method == 'HEAD':
+        response['Content-Length'] = str(size)
+    return response
+
+def _store(request, service, container_name, blob_name):
+    comp = request.GET.get('comp')
+    if comp == 'block':
+        service.put_block(container_name, blob_name, request.body, base64.b64decode(request.GET['blockid']))
+    elif comp == 'blocklist':
+        block_list = [base64.b64decode(element.text.strip())
+                      for element in ElementTree.fromstring(request.body)]
+        service.put_block_list(container_name, blob_name, block_list,
+                               x_ms_blob_content_type=request.META.get('HTTP_X_MS_BLOB_CONTENT_TYPE'),
+                               x_ms_blob_content_md5=request.META.get('HTTP_X_MS_BLOB_CONTENT_MD5'),
+                               x_ms_meta_name_values=_metadata(request))
+    else:
+        service.put_blob(container_name, blob_name, request.body,
+                         request.META.get('HTTP_X_MS_BLOB_TYPE', 'BlockBlob'),
+                         x_ms_blob_content_type=request.META.get('HTTP_X_MS_BLOB_CONTENT_TYPE'),
+                         content_md5=request.META.get('HTTP_CONTENT_MD5'),
+                         x_ms_meta_name_values=_metadata(request))
+    return HttpResponse(status=201)
+
+@csrf_exempt
+def blob_view(request, container_name, blob_name):
+    """
+    Serves and stores the Blobs of LocalStorage.
+    """
+    service = _get_blob_service()
+    try:
+        if request.method in ('GET', 'HEAD'):
+            public = container_name == getattr(settings, 'AZURE_CONTAINER', None)
+            if not public and not _is_authorized(request, container_name, blob_name, 'r'):
+                return HttpResponseForbidden()
+            return _serve(request, service, container_name, blob_name)
+        if request.method == 'PUT':
+            if not _is_authorized(request, container_name, blob_name, 'w'):
+                return HttpResponseForbidden()
+            return _store(request, service, container_name, blob_name)
+    except azure.WindowsAzureMissingResourceError:
+        raise Http404
+    except azure.WindowsAzureError as e:
+        return HttpResponse(str(e), status=400, content_type='text/plain')
+    response = HttpResponse(status=405)
+    response['Allow'] = 'GET, HEAD, PUT'
+    return response
@@ -282,6 +282,32 @@ class Base(Settings):
 
     BUNDLE_SERVICE_URL = ""
 
+    # Caches. Computed leaderboards are kept in the cache named by LEADERBOARD_CACHE. Scores are
+    # stored by the site worker, a separate process, so the cache must be shared by all the
+    # processes which serve or change leaderboards: a local memory cache is private to each
+    # process. The default file cache is shared by the processes of one machine; when the site
+    # and the site worker run on several machines, use a database cache or memcached instead
+    # (see local_sample.py).
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'leaderboard': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(PROJECT_DIR, 'var', 'leaderboard_cache'),
+            'TIMEOUT': 3600,
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+    LEADERBOARD_CACHE = 'leaderboard'
+    # Compiled leaderboard schemas (columns, groups, computed scores) are cached in each process
+    # and recompiled when their version stamp, kept in LEADERBOARD_CACHE, changes.
+    LEADERBOARD_SCHEMA_CACHE_SIZE = 128
+    LEADERBOARD_SCHEMA_CACHE_TIMEOUT = 300
+    # Number of phases whose rank index (used to answer single-submission rank queries) is
+    # kept in each process.
+    LEADERBOARD_RANK_INDEX_CACHE_SIZE = 32
+
     # Currently the search bar is hidden using this flag
     SHOW_BETA_FEATURES = False
 
@@ -22,6 +22,15 @@ class Dev(DevBase):
     BUNDLE_AZURE_ACCOUNT_NAME = AZURE_ACCOUNT_NAME
     BUNDLE_AZURE_ACCOUNT_KEY = AZURE_ACCOUNT_KEY
     BUNDLE_AZURE_CONTAINER = 'name_of_your_private_container_for_bundles'
+    AZURE_READ_BLOCK_SIZE = 1024 * 1024  # bytes fetched per block when reading Blobs
+    AZURE_UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024  # bytes per block when storing files
+    AZURE_UPLOAD_THREADS = 4  # blocks uploaded at the same time when storing files
+    AZURE_PROPERTIES_CACHE_TTL = 300  # seconds Blob properties are cached; 0 to disable
+
+    # Local storage replacing Azure storage on a single node (optional): uncomment to keep
+    # Blobs under LOCAL_STORAGE_ROOT. Compute workers need the same path in 'local-storage'.
+    # DEFAULT_FILE_STORAGE = 'codalab.local_storage.LocalStorage'
+    # LOCAL_STORAGE_ROOT = join(dirname(abspath(__file__)), '..', '..', 'blobs')
 
     # Bundle service: leave this URL blank to by-pass this functionality
     BUNDLE_SERVICE_URL = "http://localhost:2800"
@@ -45,6 +54,9 @@ class Dev(DevBase):
     SBS_ACCOUNT_KEY = '<enter key>'
     SBS_RESPONSE_QUEUE = '<enter queue name>' # incoming queue for site worker
     SBS_COMPUTE_QUEUE = '<enter queue name>'  # incoming queue for Windows compute worker
+    SBS_PHASE_ASSETS_TOPIC = None  # topic announcing phase assets to warm compute workers (optional)
+    SBS_RECEIVE_BATCH_SIZE = 10  # messages received at once by the site worker
+    SBS_LOCAL_QUEUE_PATH = None  # SQLite database replacing Service Bus on a single node (optional)
 
     DATABASES = {
         'default': {
@@ -57,3 +69,19 @@ class Dev(DevBase):
             'PORT': '',           # Set to empty string for default.
         }
     }
+
+    # Leaderboard cache shared by several machines running the site or the site worker. With
+    # the database cache, create the table with 'python manage.py createcachetable leaderboard_cache'.
+    # CACHES = {
+    #     'default': {
+    #         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    #     },
+    #     'leaderboard': {
+    #         'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+    #         'LOCATION': 'leaderboard_cache',
+    #         # or a directory shared by the machines:
+    #         # 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    #         # 'LOCATION': '/var/tmp/codalab_leaderboard_cache',
+    #         'TIMEOUT': 3600,
+    #     },
+    # }
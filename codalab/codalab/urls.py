@@ -28,6 +28,10 @@ urlpatterns = patterns('',
     url(r'^media/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root': settings.MEDIA_ROOT}),
 
+    # Blobs of the local storage backend (codalab.local_storage)
+    url(r'^local-storage/(?P<container_name>[a-z0-9-]+)/(?P<blob_name>.+)$', 'codalab.local_storage.blob_view',
+        name='local_storage_blob'),
+
     # JS Reverse for saner AJAX calls
     url(r'^jsreverse/$', 'django_js_reverse.views.urls_js', name='js_reverse')
 )
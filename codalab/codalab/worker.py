@@ -18,6 +18,7 @@ from configurations import importer
 importer.install()
 
 from codalabtools import BaseWorker
+from django.conf import settings
 from apps.jobs.models import (update_job_status_task,
                               getQueue,
                               Job)
@@ -25,7 +26,8 @@ from apps.web.tasks import (echo_task,
                             create_competition_task,
                             evaluate_submission_task,
                             update_submission_task,
-                            send_mass_email_task)
+                            send_mass_email_task,
+                            announce_phase_assets_task)
 
 logger = logging.getLogger('codalab')
 
@@ -40,9 +42,11 @@ def start_worker():
         'create_competition': create_competition_task,
         'evaluate_submission': evaluate_submission_task,
         'run_update': update_submission_task,
-        'send_mass_email': send_mass_email_task
+        'send_mass_email': send_mass_email_task,
+        'announce_phase_assets': announce_phase_assets_task
     }
-    worker = BaseWorker(queue, vtable, logger)
+    # Status updates are small and frequent: take several per round of receives.
+    worker = BaseWorker(queue, vtable, logger, batch_size=getattr(settings, 'SBS_RECEIVE_BATCH_SIZE', 10))
     logger.info("Starting site worker.")
     worker.start()
 
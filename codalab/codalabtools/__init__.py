@@ -5,6 +5,8 @@ Package containing the CodaLab client tools.
 import json
 import logging
 import os
+import threading
+import time
 import yaml
 
 class BaseConfig(object):
@@ -49,6 +51,16 @@ class Queue(object):
         """
         raise NotImplementedError()
 
+    def receive_messages(self, max_count):
+        """
+        Gets up to max_count messages from the queue. Waits like receive_message for the
+        first message only.
+
+        Returns a list of QueueMessage instances, empty if no message was received.
+        """
+        msg = self.receive_message()
+        return [] if msg is None else [msg]
+
     def send_message(self, body):
         """
         Sends a message to the queue.
@@ -60,6 +72,11 @@ class Queue(object):
 class QueueMessage(object):
     """
     Provides an abstract definition for a message exchanged through a queue.
+
+    A queue may hand out messages under a lease: the message stays in the queue, hidden from
+    other receivers, until it is completed or its lease expires, in which case it is
+    delivered again. The lease methods do nothing for messages which are removed from the
+    queue when received.
     """
     def get_body(self):
         """Gets a string representing the body of the message."""
@@ -67,6 +84,15 @@ class QueueMessage(object):
     def get_queue(self):
         """Gets the Queue instance from which the message was retrieved."""
         raise NotImplementedError()
+    def complete(self):
+        """Removes the message from the queue once it has been handled."""
+        pass
+    def abandon(self):
+        """Releases the lease of the message so that it is delivered again."""
+        pass
+    def renew_lease(self):
+        """Extends the lease of the message while it is being handled."""
+        pass
 
 class QueueMessageError(Exception):
     """Indicates that the body of a queue message cannot be decoded or is invalid."""
@@ -96,46 +122,196 @@ def decode_message_body(message):
         raise QueueMessageError("Missing key: task_type.")
     return data
 
+class _LeaseRenewer(object):
+    """
+    Renews the leases of the messages held by a worker from a background thread.
+    """
+    def __init__(self, interval, logger):
+        """
+        interval: Number of seconds between two renewals of a lease.
+        logger: The logging.Logger object to use.
+        """
+        self.interval = interval
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._held = set()
+        self._thread = None
+
+    def hold(self, msg):
+        """Starts renewing the lease of a message."""
+        with self._lock:
+            self._held.add(msg)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def release(self, msg):
+        """Stops renewing the lease of a message."""
+        with self._lock:
+            self._held.discard(msg)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if len(self._held) == 0:
+                    # Started again by the next hold.
+                    self._thread = None
+                    return
+                held = list(self._held)
+            for msg in held:
+                try:
+                    msg.renew_lease()
+                except Exception:
+                    self.logger.exception("Failed to renew the lease of a message.")
+
 class BaseWorker(object):
     """
     Defines the base implementation for a worker process which listens to a queue for
     messages. Each message defines a task. When the worker receives a message, it performs
     the task then goes back to listening mode.
+
+    A worker can run several tasks at once, each on its own thread (an execution slot). A
+    message is only taken from the queue when a slot is free, so that messages wait in the
+    queue, where another worker may pick them up, rather than in the worker.
+
+    When the queue hands out messages under a lease (its lease_renewal_interval attribute is
+    set), the leases of the messages held by the worker are renewed until the messages are
+    handled, then the messages are completed. A message held by a worker which dies is
+    delivered again once its lease expires.
     """
 
-    def __init__(self, queue, vtable, logger):
+    def __init__(self, queue, vtable, logger, slots=1, batch_size=1):
         """
         queue: The Queue object to listen to.
         vtable: A map from a task type to a function which contructs a runnable task. Given a
             message with an identifier I, a task type T and task arguments A, the function
             constructed to run the task is: F = vtable[T](I, A). And F() runs the task.
+            With more than one slot, the functions must be safe to call concurrently.
         logger: The logging.Logger object to use.
+        slots: The number of tasks which can run at the same time. With a single slot, tasks
+            run on the thread which called start().
+        batch_size: The maximum number of messages received at once. With more than one slot,
+            no more messages are received than there are free slots; with a single slot, the
+            messages of a batch run one after the other.
         """
         self.queue = queue
         self.logger = logger
         self.vtable = vtable
+        self.slots = max(1, slots)
+        self.batch_size = max(1, batch_size)
+        self._running = False
+        self._renewer = None
+        interval = getattr(queue, 'lease_renewal_interval', None)
+        if interval is not None:
+            self._renewer = _LeaseRenewer(interval, logger)
+
+    def _handle_message(self, msg):
+        """Decodes a message and runs the task it defines."""
+        self.logger.debug("Received message: %s", msg.get_body())
+        data = decode_message_body(msg)
+        task_id = data['id']
+        task_type = data['task_type']
+        task_args = data['task_args'] if 'task_args' in data else None
+        if task_type in self.vtable:
+            self.logger.info("Running task: id=%s task_type=%s", task_id, task_type)
+            self.vtable[task_type](task_id, task_args)
+            self.logger.info("Task complete: id=%s task_type=%s", task_id, task_type)
+        else:
+            self.logger.warning("Unknown task_type=%s for task with id=%s", task_type, task_id)
+
+    def _process(self, msg):
+        """
+        Runs the task of a message then completes the message. A message whose task fails is
+        completed as well: it would most likely fail again.
+        """
+        try:
+            self._handle_message(msg)
+        finally:
+            if self._renewer is not None:
+                self._renewer.release(msg)
+            try:
+                msg.complete()
+            except Exception:
+                self.logger.exception("Failed to complete message.")
+
+    def _run_slot(self, msg, free_slots):
+        """Runs the task of a message on a slot thread and frees the slot."""
+        try:
+            self._process(msg)
+        # catch all non-"system exiting" exceptions
+        except Exception:
+            self.logger.exception("An error has occurred.")
+        finally:
+            free_slots.release()
+
+    def _receive(self, count):
+        """Receives up to count messages."""
+        if count == 1:
+            msg = self.queue.receive_message()
+            return [] if msg is None else [msg]
+        return self.queue.receive_messages(count)
 
     def start(self):
         """
         Starts the worker loop on the current thread.
         """
-        self.logger.debug("BaseWorker entering worker loop.")
-        while True:
+        self.logger.debug("BaseWorker entering worker loop with %d slot(s).", self.slots)
+        self._running = True
+        free_slots = threading.Semaphore(self.slots) if self.slots > 1 else None
+        while self._running:
             try:
+                count = self.batch_size
+                if free_slots is not None:
+                    free_slots.acquire()
+                    count = 1
+                    while count < self.batch_size and free_slots.acquire(False):
+                        count += 1
                 self.logger.debug("Waiting for message.")
-                msg = self.queue.receive_message()
-                if msg is not None:
-                    self.logger.debug("Received message: %s", msg.get_body())
-                    data = decode_message_body(msg)
-                    task_id = data['id']
-                    task_type = data['task_type']
-                    task_args = data['task_args'] if 'task_args' in data else None
-                    if task_type in self.vtable:
-                        self.logger.info("Running task: id=%s task_type=%s", task_id, task_type)
-                        self.vtable[task_type](task_id, task_args)
-                        self.logger.info("Task complete: id=%s task_type=%s", task_id, task_type)
+                try:
+                    msgs = self._receive(count)
+                except Exception:
+                    if free_slots is not None:
+                        for _ in range(count):
+                            free_slots.release()
+                    raise
+                if free_slots is not None:
+                    for _ in range(count - len(msgs)):
+                        free_slots.release()
+                if self._renewer is not None:
+                    for msg in msgs:
+                        self._renewer.hold(msg)
+                for (i, msg) in enumerate(msgs):
+                    if free_slots is None:
+                        if not self._running:
+                            # Hand the rest of the batch back to the queue.
+                            self._abandon(msgs[i:])
+                            break
+                        try:
+                            self._process(msg)
+                        except Exception:
+                            self.logger.exception("An error has occurred.")
                     else:
-                        self.logger.warning("Unknown task_type=%s for task with id=%s", task_type, task_id)
+                        slot = threading.Thread(target=self._run_slot, args=(msg, free_slots))
+                        slot.daemon = True
+                        slot.start()
             # catch all non-"system exiting" exceptions
             except Exception:
                 self.logger.exception("An error has occurred.")
+
+    def _abandon(self, msgs):
+        for msg in msgs:
+            if self._renewer is not None:
+                self._renewer.release(msg)
+            try:
+                msg.abandon()
+            except Exception:
+                self.logger.exception("Failed to abandon message.")
+
+    def stop(self):
+        """
+        Makes the worker loop exit once it is done waiting for a message. Tasks which are
+        running are not interrupted.
+        """
+        self._running = False
@@ -1,13 +1,21 @@
 """
 This module defines Windows Azure extensions for CodaLab.
 """
+import base64
+import hashlib
+import httplib
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 from time import sleep
+from urlparse import urlparse
 
 from azure import (
     WindowsAzureData,
-    WindowsAzureError
+    WindowsAzureError,
+    _update_request_uri_query
 )
+from azure.http import HTTPRequest
 
 from azure.storage import (
     _sign_storage_blob_request,
@@ -24,9 +32,23 @@ from codalabtools import (
 
 logger = logging.getLogger('codalabtools')
 
+def _renew_message_lock(service, message):
+    """
+    Renews the lock of a peek-locked message. The Service Bus REST API renews a lock with a
+    POST to the lock URI of the message, which this version of the SDK does not expose.
+    """
+    request = HTTPRequest()
+    request.method = 'POST'
+    request.host = service._get_host()
+    request.path = urlparse(message.location).path
+    request.path, request.query = _update_request_uri_query(request)
+    request.headers = service._update_service_bus_header(request)
+    service._perform_request(request)
+
 class AzureServiceBusQueueMessage(QueueMessage):
     """
-    Implements a QueueMessage backed by a Windows Azure Service Bus Queue Message.
+    Implements a QueueMessage backed by a Windows Azure Service Bus Queue Message. Messages
+    received with a peek-lock are completed by deleting them and abandoned by unlocking them.
     """
     def __init__(self, queue, message):
         self.queue = queue
@@ -34,53 +56,341 @@ class AzureServiceBusQueueMessage(QueueMessage):
     def get_body(self):
         return self.message.body
     def get_queue(self):
-        raise self.queue
+        return self.queue
+    def _is_locked(self):
+        return self.message.broker_properties is not None and 'LockToken' in self.message.broker_properties
+    def complete(self):
+        if self._is_locked():
+            self.queue._try_request(self.message.delete)
+    def abandon(self):
+        if self._is_locked():
+            self.queue._try_request(self.message.unlock)
+    def renew_lease(self):
+        if self._is_locked():
+            self.queue._try_request(lambda: _renew_message_lock(self.queue.service, self.message))
 
 class AzureServiceBusQueue(Queue):
     """
     Implements a Queue backed by a Windows Azure Service Bus Queue.
+
+    Messages are received with a peek-lock: they stay in the queue, hidden from other
+    receivers for the lock duration of the queue, until they are completed. A message held by
+    a receiver which dies is delivered again once its lock expires. The lock is renewed every
+    lease_renewal_interval seconds by BaseWorker, which must be shorter than the lock duration
+    of the queue (60 seconds by default).
     """
 
     # Timeout in seconds. receive_message is blocking and returns as soon as one of two
     # conditions occurs: a message is received or the timeout period has elapsed.
     polling_timeout = 60
+    # Timeout in seconds of the requests receiving the rest of a batch.
+    batch_timeout = 1
+    lease_renewal_interval = 20
 
-    def __init__(self, namespace, key, issuer, name):
+    def __init__(self, namespace, key, issuer, name, peek_lock=True):
+        """
+        peek_lock: False to remove messages from the queue as soon as they are received.
+        """
         self.service = ServiceBusService(service_namespace=namespace, account_key=key, issuer=issuer)
         self.name = name
+        self.peek_lock = peek_lock
+        if not peek_lock:
+            self.lease_renewal_interval = None
         self.max_retries = 3
         self.wait = lambda count: 1.0*(2**count)
 
-    def _try_request(self, fn, retry_count=0, fail=None):
+    def _try_request(self, fn, fail=None):
         '''Helper to retry request for sending and receiving messages.'''
-        try:
-            return fn()
-        except (WindowsAzureError) as e:
-            if retry_count < self.max_retries:
+        retry_count = 0
+        while True:
+            try:
+                return fn()
+            except (WindowsAzureError) as e:
+                if retry_count >= self.max_retries:
+                    if fail is not None:
+                        fail()
+                    raise e
                 logger.error("Retrying request after error occurred. Attempt %s of %s.",
                              retry_count+1, self.max_retries)
                 wait_interval = self.wait(retry_count)
                 if wait_interval > 0.0:
                     sleep(wait_interval)
-                return self._try_request(fn, retry_count=retry_count+1, fail=fail)
-            else:
-                if fail is not None:
-                    fail()
-                raise e
+                retry_count += 1
+
+    def _receive(self, timeout):
+        return self.service.receive_queue_message(self.name, peek_lock=self.peek_lock, timeout=timeout)
 
     def receive_message(self):
-        op = lambda: self.service.receive_queue_message(self.name,
-                                                        peek_lock=False,
-                                                        timeout=self.polling_timeout)
-        msg = self._try_request(op)
+        msg = self._try_request(lambda: self._receive(self.polling_timeout))
         return None if msg.body is None else AzureServiceBusQueueMessage(self, msg)
 
+    def receive_messages(self, max_count):
+        # The REST API hands out one message per request: once the first message arrives,
+        # the rest of the batch is taken with short requests until the queue is empty.
+        msgs = []
+        timeout = self.polling_timeout
+        while len(msgs) < max_count:
+            msg = self._try_request(lambda: self._receive(timeout))
+            if msg.body is None:
+                break
+            msgs.append(AzureServiceBusQueueMessage(self, msg))
+            timeout = self.batch_timeout
+        return msgs
+
     def send_message(self, body):
         op = lambda: self.service.send_queue_message(self.name, Message(body))
         fail = lambda: logger.error("Failed to send message. Message body is:\n%s", body)
         self._try_request(op, fail=fail)
 
 
+class AzureServiceBusTopic(AzureServiceBusQueue):
+    """
+    Implements a Queue backed by a Windows Azure Service Bus Topic. Messages are sent to the
+    topic and received from one of its subscriptions, so that every subscriber receives its
+    own copy of each message.
+    """
+    def __init__(self, namespace, key, issuer, topic, subscription=None, peek_lock=True):
+        """
+        topic: Name of the topic.
+        subscription: Name of the subscription messages are received from. Only needed to
+            receive messages.
+        """
+        super(AzureServiceBusTopic, self).__init__(namespace, key, issuer, topic, peek_lock)
+        self.subscription = subscription
+
+    def _receive(self, timeout):
+        return self.service.receive_subscription_message(self.name,
+                                                         self.subscription,
+                                                         peek_lock=self.peek_lock,
+                                                         timeout=timeout)
+
+    def send_message(self, body):
+        op = lambda: self.service.send_topic_message(self.name, Message(body))
+        fail = lambda: logger.error("Failed to send message to topic. Message body is:\n%s", body)
+        self._try_request(op, fail=fail)
+
+
+class BlobChecksumError(Exception):
+    """Indicates that the content downloaded from a Blob does not match its Content-MD5."""
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+def download_blob_to_file(blob_service, container_name, blob_name, file_path,
+                          chunk_size=4 * 1024 * 1024, verify_md5=True, properties=None):
+    """
+    Downloads a Blob to a local file with ranged requests, so that at most one chunk of the
+    Blob is held in memory. The MD5 of the content is computed as it streams and checked
+    against the Content-MD5 property of the Blob, when the Blob has one.
+
+    blob_service: A BlobService object.
+    container_name: Name of the container holding the Blob.
+    blob_name: Name of the Blob relative to the container.
+    file_path: Path of the local file to write.
+    chunk_size: Number of bytes requested at a time.
+    verify_md5: False to skip the checksum verification.
+    properties: Properties of the Blob, as returned by BlobService.get_blob_properties, if
+        they are already known.
+
+    Returns the properties of the Blob.
+    """
+    if properties is None:
+        properties = blob_service.get_blob_properties(container_name, blob_name)
+    size = int(properties.get('content-length', 0))
+    md5 = hashlib.md5()
+    offset = 0
+    with open(file_path, 'wb') as f:
+        while offset < size:
+            last = min(offset + chunk_size, size) - 1
+            chunk = blob_service.get_blob(container_name, blob_name, x_ms_range='bytes=%d-%d' % (offset, last))
+            if len(chunk) == 0:
+                raise BlobChecksumError("Blob %s ended at %d bytes instead of %d." % (blob_name, offset, size))
+            f.write(chunk)
+            md5.update(chunk)
+            offset += len(chunk)
+    expected_md5 = properties.get('content-md5')
+    if verify_md5 and expected_md5 and base64.b64encode(md5.digest()) != expected_md5:
+        raise BlobChecksumError("Content-MD5 mismatch for Blob %s." % blob_name)
+    return properties
+
+# Errors after which a Blob request is worth retrying: errors reported by the service and
+# network errors (socket.error is an IOError).
+RETRYABLE_BLOB_ERRORS = (WindowsAzureError, IOError, httplib.HTTPException)
+
+def _retry_blob_request(fn, description, max_retries=3, retry_wait=1.0):
+    """
+    Calls fn and returns its result, retrying with exponential backoff when it fails with
+    one of RETRYABLE_BLOB_ERRORS.
+    """
+    retry_count = 0
+    while True:
+        try:
+            return fn()
+        except RETRYABLE_BLOB_ERRORS:
+            if retry_count >= max_retries:
+                raise
+            retry_count += 1
+            logger.warning("Retrying %s after error occurred. Attempt %s of %s.",
+                           description, retry_count, max_retries, exc_info=True)
+            sleep(retry_wait * (2 ** (retry_count - 1)))
+
+def block_id(index):
+    """Returns the ID of the block at the given index. IDs of a Blob must have the same length."""
+    return "%06d" % index
+
+class BlockBlobWriter(object):
+    """
+    File-like object writing a BlockBlob. Data is cut into blocks which are uploaded in the
+    background by the BlobUploader which created the writer. The Blob is committed by
+    BlobUploader.commit.
+    """
+    def __init__(self, uploader, blob_name):
+        self.uploader = uploader
+        self.blob_name = blob_name
+        self.block_ids = []
+        self.md5 = hashlib.md5()
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self.md5.update(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        block_size = self.uploader.block_size
+        if self._buffered >= block_size:
+            data = ''.join(self._buffer)
+            offset = 0
+            while len(data) - offset >= block_size:
+                self._put_block(data[offset:offset + block_size])
+                offset += block_size
+            rest = data[offset:]
+            self._buffer = [rest] if len(rest) > 0 else []
+            self._buffered = len(rest)
+
+    def flush(self):
+        """Uploads the buffered data as a block."""
+        if self._buffered > 0:
+            self._put_block(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _put_block(self, data):
+        index = len(self.block_ids)
+        self.block_ids.append(block_id(index))
+        self.uploader._put_block(self.blob_name, index, data)
+
+class BlobUploader(object):
+    """
+    Uploads BlockBlobs in blocks with a pool of threads, the blocks of all the Blobs being
+    uploaded concurrently. A failed block is retried on its own with exponential backoff.
+    At most twice max_threads blocks are held in memory at a time: writing blocks until
+    earlier blocks are uploaded. Blobs are committed with put_block_list by commit, with the
+    MD5 of their content as Content-MD5.
+    """
+    def __init__(self, blob_service, container_name, block_size=4 * 1024 * 1024, max_threads=4,
+                 max_retries=3, retry_wait=1.0):
+        """
+        blob_service: A BlobService object.
+        container_name: Name of the container receiving the Blobs.
+        block_size: Size in bytes of the blocks.
+        max_threads: Number of blocks uploaded at the same time.
+        max_retries: Number of retries of a failed request.
+        retry_wait: Wait in seconds before the first retry, doubled at each retry.
+        """
+        self.blob_service = blob_service
+        self.container_name = container_name
+        self.block_size = block_size
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.writers = []
+        self._max_pending = 2 * max(1, max_threads)
+        self._pending = threading.BoundedSemaphore(self._max_pending)
+        self._errors = []
+        self._pool = ThreadPool(max(1, max_threads))
+
+    def _raise_error(self):
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+    def _put_block(self, blob_name, index, data):
+        self._raise_error()
+        content_md5 = base64.b64encode(hashlib.md5(data).digest())
+        def put_block():
+            try:
+                op = lambda: self.blob_service.put_block(self.container_name, blob_name, data, block_id(index),
+                                                         content_md5=content_md5)
+                _retry_blob_request(op, "upload of block %d of Blob %s" % (index, blob_name),
+                                    self.max_retries, self.retry_wait)
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                self._pending.release()
+        self._pending.acquire()
+        self._pool.apply_async(put_block)
+
+    def open(self, blob_name):
+        """Returns a BlockBlobWriter for a new Blob."""
+        writer = BlockBlobWriter(self, blob_name)
+        self.writers.append(writer)
+        return writer
+
+    def upload_file(self, blob_name, file_path):
+        """Uploads a local file to a new Blob."""
+        writer = self.open(blob_name)
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.block_size), ''):
+                writer.write(chunk)
+
+    def commit(self):
+        """Waits for the blocks to be uploaded and commits the Blobs."""
+        try:
+            for writer in self.writers:
+                writer.flush()
+            for _ in range(self._max_pending):
+                self._pending.acquire()
+            for _ in range(self._max_pending):
+                self._pending.release()
+            self._raise_error()
+
+            def commit(writer):
+                content_md5 = base64.b64encode(writer.md5.digest())
+                op = lambda: self.blob_service.put_block_list(self.container_name, writer.blob_name,
+                                                              writer.block_ids,
+                                                              x_ms_blob_content_md5=content_md5)
+                _retry_blob_request(op, "commit of Blob %s" % writer.blob_name, self.max_retries, self.retry_wait)
+            # A timeout keeps the wait interruptible.
+            self._pool.map_async(commit, self.writers).get(2 ** 31)
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the threads. Blobs which are not committed are discarded by the service."""
+        self._pool.terminate()
+
+def upload_files_to_blobs(blob_service, container_name, files, block_size=4 * 1024 * 1024,
+                          max_threads=4, max_retries=3, retry_wait=1.0):
+    """
+    Uploads local files as BlockBlobs with a BlobUploader: the files are uploaded
+    concurrently, in blocks.
+
+    blob_service: A BlobService object.
+    container_name: Name of the container receiving the Blobs.
+    files: List of (blob_name, file_path) pairs.
+    block_size: Size in bytes of the blocks.
+    max_threads: Number of blocks uploaded at the same time.
+    max_retries: Number of retries of a failed request.
+    retry_wait: Wait in seconds before the first retry, doubled at each retry.
+    """
+    uploader = BlobUploader(blob_service, container_name, block_size, max_threads, max_retries, retry_wait)
+    try:
+        for (blob_name, file_path) in files:
+            uploader.upload_file(blob_name, file_path)
+    except:
+        uploader.close()
+        raise
+    uploader.commit()
+
 class CorsRule(WindowsAzureData):
     '''CORS Rule for Windows Azure storage service.'''
 
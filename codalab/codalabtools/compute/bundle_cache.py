@@ -0,0 +1,247 @@
+"""
+Defines a persistent on-disk cache of staged bundles for compute workers.
+
+A bundle is cached under a key derived from the name of its Blob and from the content
+fingerprint reported by Azure storage (Content-MD5 when available, ETag otherwise), so a
+Blob which is overwritten gets a new entry. Cached bundles are kept in their staged form
+(extracted) and are copied into a run directory. Runs never share files with the cache:
+programs run in the run directory, and with the same user as the worker they could change
+the permissions of a shared file and rewrite it for the runs which follow. Cached files are
+also made read-only to guard against accidental writes by the worker itself.
+
+Only competition assets (scoring programs, reference and input data) are meant to be cached:
+they are shared by all the submissions of a phase, unlike the bundles of participants.
+
+The cache has a size budget. When adding an entry takes the cache over budget, the least
+recently used entries are evicted. Recency is stored as the modification time of a marker
+file in each entry so that it survives worker restarts. Entries can be pinned until a given
+time, e.g. the end of the phase using them, in which case they are not evicted before then.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from os.path import join
+
+logger = logging.getLogger('codalabtools')
+
+def bundle_cache_key(blob_name, properties):
+    """
+    Returns the cache key of a Blob or None if the Blob cannot be cached.
+
+    blob_name: Name of the Blob relative to its container.
+    properties: Dictionary of the Blob properties as returned by BlobService.get_blob_properties.
+    """
+    fingerprint = properties.get('content-md5') or properties.get('etag')
+    if not fingerprint:
+        return None
+    return hashlib.sha1("%s\n%s" % (blob_name, fingerprint)).hexdigest()
+
+def _tree_size(path):
+    """Returns the total size in bytes of the files under the given directory."""
+    size = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(join(dirpath, filename))
+    return size
+
+def _make_read_only(path):
+    """Removes write permissions from the files under the given directory."""
+    mask = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            filepath = join(dirpath, filename)
+            os.chmod(filepath, os.stat(filepath).st_mode & mask)
+
+def _make_writable(path):
+    """Restores write permission on the files under the given directory so it can be deleted."""
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            filepath = join(dirpath, filename)
+            os.chmod(filepath, os.stat(filepath).st_mode | stat.S_IWUSR)
+
+def copy_tree(src_path, dest_path):
+    """
+    Copies the tree of files under src_path into dest_path, merging with existing
+    directories. Copies are writable and share nothing with the source files.
+
+    src_path: Path of the directory to copy.
+    dest_path: Path of the destination directory.
+    """
+    for (dirpath, dirnames, filenames) in os.walk(src_path):
+        rel_path = os.path.relpath(dirpath, src_path)
+        target_dir = dest_path if rel_path == '.' else join(dest_path, rel_path)
+        if not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for filename in filenames:
+            shutil.copyfile(join(dirpath, filename), join(target_dir, filename))
+
+class BundleCache(object):
+    """
+    Persistent cache of staged bundles with a size budget and LRU eviction. Safe to use from
+    several threads of the same process.
+    """
+    ACCESS_MARKER = '.access'
+    PIN_MARKER = '.pinned'
+    CONTENT_DIR = 'content'
+
+    def __init__(self, root_path, max_size):
+        """
+        root_path: Path of the directory holding the cache. Created if it does not exist.
+        max_size: Size budget of the cache in bytes.
+        """
+        self.root_path = root_path
+        self.max_size = max_size
+        self.entries_path = join(root_path, 'entries')
+        self.staging_path = join(root_path, 'staging')
+        for path in (self.entries_path, self.staging_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._sizes = {}
+        self._pins = {}
+        self._scan()
+
+    def _scan(self):
+        """Reads the entries left by a previous process and drops incomplete staging areas."""
+        for name in os.listdir(self.staging_path):
+            self._remove_tree(join(self.staging_path, name))
+        for key in os.listdir(self.entries_path):
+            entry_path = join(self.entries_path, key)
+            if os.path.exists(join(entry_path, self.ACCESS_MARKER)):
+                self._sizes[key] = _tree_size(join(entry_path, self.CONTENT_DIR))
+                try:
+                    with open(join(entry_path, self.PIN_MARKER)) as f:
+                        self._pins[key] = float(f.read())
+                except (IOError, ValueError):
+                    pass
+            else:
+                self._remove_tree(entry_path)
+
+    def _remove_tree(self, path):
+        try:
+            _make_writable(path)
+            shutil.rmtree(path)
+        except OSError:
+            logger.exception("Unable to remove bundle cache directory %s", path)
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def _touch(self, key):
+        marker = join(self.entries_path, key, self.ACCESS_MARKER)
+        with open(marker, 'a'):
+            pass
+        now = time.time()
+        os.utime(marker, (now, now))
+
+    def size(self):
+        """Returns the total size in bytes of the cached bundles."""
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._sizes
+
+    def pin(self, key, until):
+        """
+        Keeps a cached bundle from being evicted until the given time. A later pin replaces
+        an earlier one.
+
+        key: Cache key of a cached bundle.
+        until: Time as a number of seconds since the epoch.
+        """
+        with self._key_lock(key):
+            with self._lock:
+                if key not in self._sizes:
+                    return
+                self._pins[key] = until
+            with open(join(self.entries_path, key, self.PIN_MARKER), 'w') as f:
+                f.write(repr(float(until)))
+
+    def is_pinned(self, key):
+        """Returns True if the bundle with the given key is pinned."""
+        with self._lock:
+            return self._pins.get(key, 0) > time.time()
+
+    def stage(self, key, stage, dest_path=None):
+        """
+        Copies the bundle with the given key into dest_path. On a miss, the bundle is
+        first produced by calling stage(path), where path is an empty directory to fill, and
+        added to the cache. Concurrent calls for the same key stage the bundle once.
+
+        key: Cache key as returned by bundle_cache_key.
+        stage: Function filling a directory with the staged bundle.
+        dest_path: Path of the directory receiving the bundle. Merged with existing content.
+            None to only add the bundle to the cache.
+
+        Returns True if the bundle was found in the cache.
+        """
+        with self._key_lock(key):
+            entry_path = join(self.entries_path, key)
+            content_path = join(entry_path, self.CONTENT_DIR)
+            with self._lock:
+                hit = key in self._sizes
+            if hit:
+                logger.debug("Bundle cache hit (key=%s)", key)
+            else:
+                logger.debug("Bundle cache miss (key=%s)", key)
+                staging = tempfile.mkdtemp(dir=self.staging_path)
+                try:
+                    staged_path = join(staging, self.CONTENT_DIR)
+                    os.mkdir(staged_path)
+                    stage(staged_path)
+                    _make_read_only(staged_path)
+                    size = _tree_size(staged_path)
+                    os.rename(staging, entry_path)
+                except:
+                    self._remove_tree(staging)
+                    raise
+                with self._lock:
+                    self._sizes[key] = size
+            self._touch(key)
+            if dest_path is not None:
+                copy_tree(content_path, dest_path)
+        self._evict()
+        return hit
+
+    def _evict(self):
+        """
+        Evicts least recently used entries until the cache fits its budget. Entries being
+        staged or materialized and pinned entries are skipped.
+        """
+        def last_access(key):
+            try:
+                return os.path.getmtime(join(self.entries_path, key, self.ACCESS_MARKER))
+            except OSError:
+                return 0
+        with self._lock:
+            if sum(self._sizes.values()) <= self.max_size:
+                return
+            candidates = sorted(self._sizes.keys(), key=last_access)
+        for key in candidates:
+            key_lock = self._key_lock(key)
+            if not key_lock.acquire(False):
+                continue
+            try:
+                with self._lock:
+                    if sum(self._sizes.values()) <= self.max_size:
+                        return
+                    if key not in self._sizes or self._pins.get(key, 0) > time.time():
+                        continue
+                    del self._sizes[key]
+                    self._pins.pop(key, None)
+                logger.debug("Evicting bundle from cache (key=%s)", key)
+                # Runs hold copies, not references to the entry.
+                self._remove_tree(join(self.entries_path, key))
+            finally:
+                key_lock.release()
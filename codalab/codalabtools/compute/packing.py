@@ -0,0 +1,156 @@
+"""
+Defines the packing of run outputs into zip archives streamed to Blob storage.
+
+The archives are written sequentially: the CRC and sizes of each member are stored in a
+data descriptor following its data instead of in its local header, so the archive can be
+written to a stream which cannot seek, like a BlockBlobWriter. A file belonging to several
+archives is read and compressed once, and its compressed data is written to each of them.
+"""
+import os
+import stat
+import struct
+import time
+import zlib
+from os.path import join
+from zipfile import LargeZipFile, ZIP_DEFLATED, ZIP_STORED
+
+# Bit 3 of the flags: CRC and sizes are in the data descriptor.
+_FLAG_DATA_DESCRIPTOR = 0x08
+_VERSION = 20
+_ZIP_MAX = 0xFFFFFFFF
+_ZIP_MAX_ENTRIES = 0xFFFF
+
+def _dos_date_time(timestamp):
+    """Returns the (date, time) pair of a timestamp in MS-DOS format."""
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return (((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2))
+
+class _Member(object):
+    """Member of a StreamingZipWriter."""
+    def __init__(self, arcname, timestamp, mode, compress_type):
+        self.arcname = arcname
+        self.date, self.time = _dos_date_time(timestamp)
+        self.mode = mode
+        self.compress_type = compress_type
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+        self.header_offset = 0
+
+class StreamingZipWriter(object):
+    """
+    Writes a zip archive to a stream which only needs a write method. Archives larger than
+    4 GB are not supported, as with zipfile.ZipFile when allowZip64 is False.
+    """
+    def __init__(self, stream):
+        """
+        stream: File-like object receiving the archive.
+        """
+        self.stream = stream
+        self.members = []
+        self.offset = 0
+
+    def _write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def begin(self, arcname, timestamp, mode, compress_type):
+        """
+        Writes the local header of a new member. Its data is written next with write_data.
+
+        arcname: Name of the member.
+        timestamp: Modification time of the member.
+        mode: Unix mode of the member.
+        compress_type: ZIP_STORED or ZIP_DEFLATED.
+        """
+        if len(self.members) >= _ZIP_MAX_ENTRIES:
+            raise LargeZipFile("Zip archive would have too many members")
+        member = _Member(arcname, timestamp, mode, compress_type)
+        member.header_offset = self.offset
+        self.members.append(member)
+        self._write(struct.pack("<4s2B4HL2L2H", "PK\003\004", _VERSION, 0, _FLAG_DATA_DESCRIPTOR,
+                                member.compress_type, member.time, member.date, 0, 0, 0,
+                                len(member.arcname), 0))
+        self._write(member.arcname)
+
+    def write_data(self, data):
+        """Writes (compressed) data of the current member."""
+        self._write(data)
+
+    def end(self, crc, compress_size, file_size):
+        """Writes the data descriptor of the current member once its CRC and sizes are known."""
+        member = self.members[-1]
+        member.crc = crc
+        member.compress_size = compress_size
+        member.file_size = file_size
+        if member.compress_size > _ZIP_MAX or member.file_size > _ZIP_MAX or self.offset > _ZIP_MAX:
+            raise LargeZipFile("Zip archive would exceed the zip size limit")
+        self._write(struct.pack("<4s3L", "PK\007\010", member.crc, member.compress_size, member.file_size))
+
+    def close(self):
+        """Writes the central directory. The stream is left open."""
+        start = self.offset
+        for member in self.members:
+            self._write(struct.pack("<4s4B4HL2L5H2L", "PK\001\002", _VERSION, 3, _VERSION, 0,
+                                    _FLAG_DATA_DESCRIPTOR, member.compress_type, member.time, member.date,
+                                    member.crc, member.compress_size, member.file_size,
+                                    len(member.arcname), 0, 0, 0, 0, (member.mode & 0xFFFF) << 16,
+                                    member.header_offset))
+            self._write(member.arcname)
+        if self.offset > _ZIP_MAX:
+            raise LargeZipFile("Zip archive would exceed the zip size limit")
+        self._write(struct.pack("<4s4H2LH", "PK\005\006", 0, 0, len(self.members), len(self.members),
+                                self.offset - start, start, 0))
+
+def pack_tree(root_path, archives, compression_level=6, chunk_size=1024 * 1024):
+    """
+    Packs the files under a directory into zip archives in a single pass. Members are named
+    after their path relative to the directory; directories get no member of their own, as
+    with shutil.make_archive.
+
+    root_path: Path of the directory to pack.
+    archives: List of (stream, include) pairs where stream is the file-like object receiving
+        an archive and include(rel_path) tells whether a file belongs to the archive.
+    compression_level: zlib compression level from 1 (fastest) to 9 (smallest), or 0 to
+        store the files without compression.
+    chunk_size: Number of bytes read from a file at a time.
+    """
+    writers = [(StreamingZipWriter(stream), include) for (stream, include) in archives]
+    compress_type = ZIP_DEFLATED if compression_level > 0 else ZIP_STORED
+    for (dirpath, dirnames, filenames) in os.walk(root_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = join(dirpath, filename)
+            rel_path = os.path.relpath(path, root_path)
+            targets = [writer for (writer, include) in writers if include(rel_path)]
+            if len(targets) == 0:
+                continue
+            st = os.stat(path)
+            for writer in targets:
+                writer.begin(rel_path.replace(os.sep, '/'), st.st_mtime, stat.S_IMODE(st.st_mode) | stat.S_IFREG,
+                             compress_type)
+            compressor = None
+            if compress_type == ZIP_DEFLATED:
+                compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+            crc, compress_size, file_size = 0, 0, 0
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), ''):
+                    crc = zlib.crc32(chunk, crc)
+                    file_size += len(chunk)
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                    if len(chunk) > 0:
+                        compress_size += len(chunk)
+                        for writer in targets:
+                            writer.write_data(chunk)
+            if compressor is not None:
+                chunk = compressor.flush()
+                compress_size += len(chunk)
+                for writer in targets:
+                    writer.write_data(chunk)
+            for writer in targets:
+                writer.end(crc & 0xFFFFFFFF, compress_size, file_size)
+    for (writer, include) in writers:
+        writer.close()
@@ -0,0 +1,207 @@
+"""
+Defines the supervision of the programs run by compute workers.
+
+On POSIX systems the program is started in its own process group with resource limits
+(CPU time, address space and file size) applied by the kernel. The session and the limits
+are set up by a small Python launcher which then execs the program: running Python code
+between fork and exec (Popen's preexec_fn) can deadlock in a multithreaded worker, since the
+child only inherits the thread which forked it. The worker blocks in
+os.wait4, which returns as soon as the program exits together with its resource usage. A
+watchdog thread blocks in select on a pipe: it wakes up either when the program exits or
+when the time limit is reached, in which case it kills the whole process group. No polling
+is involved.
+
+On other systems (Windows) the worker blocks in Popen.wait while a timer kills the process
+when the time limit is reached. Resource usage is not reported there.
+"""
+import errno
+import logging
+import os
+import select
+import signal
+import sys
+import threading
+import time
+from subprocess import Popen
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger('codalabtools')
+
+POSIX = resource is not None and hasattr(os, 'wait4') and hasattr(os, 'killpg')
+
+# Run as: python -c _LAUNCHER <cpu> <memory> <output size> <program> <args>...
+# Empty limits are not enforced. Python ignores SIGPIPE and SIGXFSZ and the setting is
+# inherited through exec, so they are restored first.
+_LAUNCHER = """
+import os, resource, signal, sys
+os.setsid()
+for signum in (signal.SIGPIPE, signal.SIGXFSZ):
+    signal.signal(signum, signal.SIG_DFL)
+cpu, memory, output = sys.argv[1:4]
+if cpu:
+    # SIGXCPU at the soft limit, SIGKILL at the hard limit.
+    resource.setrlimit(resource.RLIMIT_CPU, (int(cpu), int(cpu) + 1))
+if memory:
+    resource.setrlimit(resource.RLIMIT_AS, (int(memory), int(memory)))
+if output:
+    resource.setrlimit(resource.RLIMIT_FSIZE, (int(output), int(output)))
+try:
+    os.execvp(sys.argv[4], sys.argv[4:])
+except OSError as e:
+    sys.stderr.write("Unable to run %s: %s\\n" % (sys.argv[4], e.strerror))
+    os._exit(127)
+"""
+
+class RunLimits(object):
+    """
+    Limits enforced on a program. A limit set to None is not enforced.
+
+    time_limit: Wall clock time in seconds.
+    cpu_time_limit: CPU time in seconds.
+    memory_limit: Address space in bytes.
+    output_size_limit: Size in bytes of each file written by the program, including its
+        redirected standard output and error.
+    """
+    def __init__(self, time_limit=None, cpu_time_limit=None, memory_limit=None, output_size_limit=None):
+        self.time_limit = time_limit
+        self.cpu_time_limit = cpu_time_limit
+        self.memory_limit = memory_limit
+        self.output_size_limit = output_size_limit
+
+    def launcher_args(self):
+        """Returns the limits as the arguments of the launcher: the number or '' if not enforced."""
+        limits = (self.cpu_time_limit, self.memory_limit, self.output_size_limit)
+        return ['' if limit is None else str(int(limit)) for limit in limits]
+
+class RunResult(object):
+    """
+    Outcome of a supervised program.
+
+    exit_code: Exit code of the program, or minus the number of the signal which killed it.
+        Set to -1 when the program was killed for exceeding its time limit.
+    elapsed_time: Wall clock time in seconds.
+    cpu_time: User plus system CPU time in seconds, or None if not available.
+    max_rss: Peak resident set size in bytes, or None if not available.
+    limit_exceeded: None, or the limit which ended the program: 'time', 'cpu' or 'output'.
+    """
+    def __init__(self, exit_code, elapsed_time, cpu_time=None, max_rss=None, limit_exceeded=None):
+        self.exit_code = exit_code
+        self.elapsed_time = elapsed_time
+        self.cpu_time = cpu_time
+        self.max_rss = max_rss
+        self.limit_exceeded = limit_exceeded
+
+    @property
+    def timed_out(self):
+        return self.limit_exceeded == 'time'
+
+def _kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        # The group is already gone.
+        pass
+
+def _wait4(pid):
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+def _run_posix(args, cwd, stdout, stderr, limits):
+    launcher = [sys.executable, '-S', '-c', _LAUNCHER] + limits.launcher_args()
+    start = time.time()
+    process = Popen(launcher + list(args), cwd=cwd, stdout=stdout, stderr=stderr, close_fds=True)
+    exited_r, exited_w = os.pipe()
+    state = {'timed_out': False}
+
+    def watchdog():
+        ready = select.select([exited_r], [], [], limits.time_limit)[0]
+        if len(ready) == 0:
+            state['timed_out'] = True
+            logger.info("Killing process group %s for running too long.", process.pid)
+            _kill_group(process.pid)
+
+    watcher = None
+    if limits.time_limit is not None:
+        watcher = threading.Thread(target=watchdog)
+        watcher.daemon = True
+        watcher.start()
+    try:
+        _, status, usage = _wait4(process.pid)
+    finally:
+        os.write(exited_w, 'x')
+        if watcher is not None:
+            watcher.join()
+        os.close(exited_r)
+        os.close(exited_w)
+    elapsed = time.time() - start
+    # Processes left behind by the program would otherwise outlive the run.
+    _kill_group(process.pid)
+
+    if os.WIFSIGNALED(status):
+        exit_code = -os.WTERMSIG(status)
+    else:
+        exit_code = os.WEXITSTATUS(status)
+    process.returncode = exit_code
+    cpu_time = usage.ru_utime + usage.ru_stime
+    # ru_maxrss is in kilobytes on Linux.
+    max_rss = usage.ru_maxrss * 1024
+
+    limit_exceeded = None
+    if state['timed_out']:
+        limit_exceeded = 'time'
+        exit_code = -1
+    elif exit_code == -signal.SIGXCPU or (exit_code == -signal.SIGKILL and limits.cpu_time_limit is not None
+                                          and cpu_time >= limits.cpu_time_limit):
+        limit_exceeded = 'cpu'
+    elif exit_code == -signal.SIGXFSZ:
+        limit_exceeded = 'output'
+    # Allocations beyond RLIMIT_AS fail inside the program, which reports the error itself.
+    return RunResult(exit_code, elapsed, cpu_time, max_rss, limit_exceeded)
+
+def _run_portable(args, cwd, stdout, stderr, limits):
+    start = time.time()
+    process = Popen(args, cwd=cwd, stdout=stdout, stderr=stderr)
+    state = {'timed_out': False}
+
+    def kill():
+        state['timed_out'] = True
+        logger.info("Killing process %s for running too long.", process.pid)
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+    timer = None
+    if limits.time_limit is not None:
+        timer = threading.Timer(limits.time_limit, kill)
+        timer.daemon = True
+        timer.start()
+    exit_code = process.wait()
+    if timer is not None:
+        timer.cancel()
+    elapsed = time.time() - start
+    if state['timed_out']:
+        return RunResult(-1, elapsed, limit_exceeded='time')
+    return RunResult(exit_code, elapsed)
+
+def run_supervised(args, cwd, stdout, stderr, limits):
+    """
+    Runs a program until it exits or exceeds one of its limits and returns a RunResult.
+
+    args: The program and its arguments.
+    cwd: Working directory of the program.
+    stdout: File receiving the standard output of the program.
+    stderr: File receiving the standard error of the program.
+    limits: A RunLimits instance.
+    """
+    if POSIX:
+        return _run_posix(args, cwd, stdout, stderr, limits)
+    return _run_portable(args, cwd, stdout, stderr, limits)
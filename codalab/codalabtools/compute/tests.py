@@ -1,10 +1,36 @@
 """
 Defines unit tests for this package.
 """
+import azure
+import base64
+import hashlib
+import json
+import logging
 import os
-from unittest import TestCase
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from io import BytesIO
+from os.path import join
+from unittest import SkipTest, TestCase
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
-from codalabtools.compute.worker import WorkerConfig
+from codalabtools import BaseWorker, QueueMessage
+from azure.servicebus import Message
+from codalabtools.azure_extensions import (AzureServiceBusQueue,
+                                           BlobChecksumError,
+                                           download_blob_to_file,
+                                           upload_files_to_blobs)
+from codalabtools.compute.bundle_cache import BundleCache
+from codalabtools.compute.packing import pack_tree
+from codalabtools.compute.supervisor import POSIX, RunLimits, run_supervised
+from codalabtools.local_queue import SQLiteQueue
+from codalabtools.local_storage import LocalBlobService
+from codalabtools.compute.worker import WorkerConfig, _upload, getBundle, prestageBundles
 
 class ComputeConfigTests(TestCase):
     """Tests for WorkerConfig."""
@@ -29,6 +55,16 @@ class ComputeConfigTests(TestCase):
         self.assertEqual("your account key", cfg.getAzureStorageAccountKey())
         self.assertEqual("your account name", cfg.getAzureStorageAccountName())
         self.assertEqual("D:\\Temp", cfg.getLocalRoot())
+        self.assertEqual(4, cfg.getSlotCount())
+        self.assertEqual(4, cfg.getFetchThreadCount())
+        self.assertEqual("D:\\BundleCache", cfg.getBundleCachePath())
+        self.assertEqual(2048 * 1024 * 1024, cfg.getBundleCacheMaxSize())
+        self.assertEqual("name of topic", cfg.getPhaseAssetsTopic())
+        self.assertEqual("name of subscription", cfg.getPhaseAssetsSubscription())
+        self.assertEqual(48, cfg.getPhaseAssetsPinHours())
+        self.assertEqual({'cpu_time_limit': 3600,
+                          'memory_limit': 4096 * 1024 * 1024,
+                          'output_size_limit': 1024 * 1024 * 1024}, cfg.getRunLimits())
         log_cfg_expected = {
             'version': 1,
             'formatters': {
@@ -57,3 +93,855 @@ class ComputeConfigTests(TestCase):
             }
         }
         self.assertDictEqual(log_cfg_expected, cfg.getLoggerDictConfig())
+
+
+def make_zip(files):
+    """Returns the bytes of a zip file with the given {name: content} files."""
+    buf = BytesIO()
+    with ZipFile(buf, 'w') as z:
+        for (name, content) in files.items():
+            z.writestr(name, content)
+    return buf.getvalue()
+
+class FakeBlobService(object):
+    """In-memory stand-in for azure.storage.BlobService counting downloads."""
+    def __init__(self, delay=0):
+        self.blobs = {}
+        self.downloads = []
+        self.delay = delay
+        self.blocks = {}
+        self.uploads = []
+        # (name, blockid) -> number of times put_block fails before succeeding
+        self.failures = {}
+
+    def put(self, name, content, etag, content_md5=None):
+        self.blobs[name] = (content, etag, content_md5)
+
+    def get_blob(self, container, name, x_ms_range=None):
+        if name not in self.blobs:
+            raise azure.WindowsAzureMissingResourceError("missing")
+        self.downloads.append(name)
+        time.sleep(self.delay)
+        content = self.blobs[name][0]
+        if x_ms_range is not None:
+            first, last = [int(x) for x in x_ms_range[len('bytes='):].split('-')]
+            content = content[first:last + 1]
+        return content
+
+    def get_blob_properties(self, container, name):
+        if name not in self.blobs:
+            raise azure.WindowsAzureMissingResourceError("missing")
+        content, etag, content_md5 = self.blobs[name]
+        properties = {'etag': etag, 'content-length': str(len(content))}
+        if content_md5 is not None:
+            properties['content-md5'] = content_md5
+        return properties
+
+    def put_block(self, container, name, block, blockid, content_md5=None):
+        self.uploads.append((name, blockid))
+        if self.failures.get((name, blockid), 0) > 0:
+            self.failures[(name, blockid)] -= 1
+            raise azure.WindowsAzureError("transient")
+        if content_md5 is not None and base64.b64encode(hashlib.md5(block).digest()) != content_md5:
+            raise azure.WindowsAzureError("block checksum mismatch")
+        self.blocks[(name, blockid)] = block
+
+    def put_block_list(self, container, name, block_list, x_ms_blob_content_md5=None):
+        content = ''.join(self.blocks.pop((name, blockid)) for blockid in block_list)
+        self.put(name, content, 'etag-%s' % name, x_ms_blob_content_md5)
+
+class BundleCacheTests(TestCase):
+    """Tests for BundleCache and its use by getBundle."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.service = FakeBlobService()
+        self.service.put('runs/1/run.txt', "program: programs/scoring.zip\ninput: data/ref.zip\n", '"r1"')
+        self.service.put('runs/2/run.txt', "program: programs/scoring.zip\ninput: data/ref.zip\n", '"r2"')
+        self.service.put('programs/scoring.zip', make_zip({'metadata': "command: python score.py\n",
+                                                           'score.py': "print 1\n"}), '"p1"')
+        self.service.put('data/ref.zip', make_zip({'ref/truth.txt': "1 2 3\n"}), '"d1"')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def stage(self, run_id, cache):
+        root = tempfile.mkdtemp(dir=self.tmp)
+        return root, getBundle(root, self.service, 'bundles', run_id, 'run', cache=cache,
+                               cached_bundles=['programs/scoring.zip', 'data/ref.zip'])
+
+    def staged_from_cache_test(self):
+        """Shared bundles are downloaded once and copied into later runs."""
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 1024 * 1024)
+        root1, bundles = self.stage('runs/1/run.txt', cache)
+        root2, bundles = self.stage('runs/2/run.txt', cache)
+        self.assertEqual({'command': 'python score.py'}, bundles[os.path.join('run', 'program')])
+        self.assertEqual(['data/ref.zip', 'programs/scoring.zip', 'runs/1/run.txt', 'runs/2/run.txt'],
+                         sorted(self.service.downloads))
+        truth = os.path.join(root2, 'run', 'input', 'ref', 'truth.txt')
+        with open(truth) as f:
+            self.assertEqual("1 2 3\n", f.read())
+        self.assertEqual(1, os.stat(truth).st_nlink)
+
+    def modified_copy_test(self):
+        """A run modifying its staged files does not change the bundles of later runs."""
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 1024 * 1024)
+        root1, bundles = self.stage('runs/1/run.txt', cache)
+        truth = os.path.join(root1, 'run', 'input', 'ref', 'truth.txt')
+        os.chmod(truth, 0o644)
+        with open(truth, 'w') as f:
+            f.write("tampered\n")
+        root2, bundles = self.stage('runs/2/run.txt', cache)
+        with open(os.path.join(root2, 'run', 'input', 'ref', 'truth.txt')) as f:
+            self.assertEqual("1 2 3\n", f.read())
+        self.assertEqual(1, self.service.downloads.count('data/ref.zip'))
+
+    def participant_bundle_not_cached_test(self):
+        """Bundles which are not listed as cached are downloaded for each run."""
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 1024 * 1024)
+        for run_id in ('runs/1/run.txt', 'runs/2/run.txt'):
+            getBundle(tempfile.mkdtemp(dir=self.tmp), self.service, 'bundles', run_id, 'run', cache=cache,
+                      cached_bundles=['programs/scoring.zip'])
+        self.assertEqual(1, self.service.downloads.count('programs/scoring.zip'))
+        self.assertEqual(2, self.service.downloads.count('data/ref.zip'))
+        self.assertEqual(1, len(os.listdir(cache.entries_path)))
+
+    def changed_blob_test(self):
+        """A Blob with a new ETag is downloaded again."""
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 1024 * 1024)
+        self.stage('runs/1/run.txt', cache)
+        self.service.put('programs/scoring.zip', make_zip({'metadata': "command: python score2.py\n"}), '"p2"')
+        root, bundles = self.stage('runs/1/run.txt', cache)
+        self.assertEqual({'command': 'python score2.py'}, bundles[os.path.join('run', 'program')])
+        self.assertEqual(2, self.service.downloads.count('programs/scoring.zip'))
+        self.assertEqual(1, self.service.downloads.count('data/ref.zip'))
+
+    def lru_eviction_test(self):
+        """The least recently used entries are evicted to fit the size budget."""
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 10)
+        dest = tempfile.mkdtemp(dir=self.tmp)
+        def stage_file(name, size):
+            def fill(path):
+                with open(os.path.join(path, name), 'wb') as f:
+                    f.write('x' * size)
+            return fill
+        cache.stage('a', stage_file('a', 4), dest)
+        cache.stage('b', stage_file('b', 4), dest)
+        os.utime(os.path.join(cache.entries_path, 'a', BundleCache.ACCESS_MARKER), (0, 0))
+        cache.stage('c', stage_file('c', 4), dest)
+        self.assertFalse('a' in cache)
+        self.assertTrue('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(8, cache.size())
+
+    def persistent_test(self):
+        """Entries are found again by a new cache on the same directory."""
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 1024 * 1024)
+        self.stage('runs/1/run.txt', cache)
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 1024 * 1024)
+        self.stage('runs/2/run.txt', cache)
+        self.assertEqual(1, self.service.downloads.count('data/ref.zip'))
+
+
+    def prestaged_test(self):
+        """Pre-staged phase assets are found in the cache by the first run."""
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 1024 * 1024)
+        staged = prestageBundles(self.tmp, self.service, 'bundles',
+                                 ['programs/scoring.zip', 'data/ref.zip', 'runs/1/run.txt', 'data/missing.zip'],
+                                 cache, time.time() + 3600)
+        self.assertEqual(2, staged)
+        self.assertEqual(['data/ref.zip', 'programs/scoring.zip'], sorted(self.service.downloads))
+        root, bundles = self.stage('runs/1/run.txt', cache)
+        self.assertEqual(1, self.service.downloads.count('data/ref.zip'))
+        self.assertEqual(1, self.service.downloads.count('programs/scoring.zip'))
+        self.assertEqual(0, prestageBundles(self.tmp, self.service, 'bundles', ['data/ref.zip'], cache))
+
+    def pinned_not_evicted_test(self):
+        """Pinned entries survive eviction until their pin expires, across restarts."""
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 10)
+        def stage_file(name, size):
+            def fill(path):
+                with open(os.path.join(path, name), 'wb') as f:
+                    f.write('x' * size)
+            return fill
+        cache.stage('a', stage_file('a', 4))
+        cache.pin('a', time.time() + 3600)
+        cache.stage('b', stage_file('b', 4))
+        os.utime(os.path.join(cache.entries_path, 'a', BundleCache.ACCESS_MARKER), (0, 0))
+        cache = BundleCache(os.path.join(self.tmp, 'cache'), 10)
+        self.assertTrue(cache.is_pinned('a'))
+        cache.stage('c', stage_file('c', 4))
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        cache.pin('a', time.time() - 1)
+        cache.stage('d', stage_file('d', 4))
+        self.assertFalse('a' in cache)
+
+
+class ParallelFetchTests(TestCase):
+    """Tests for the concurrent staging of bundles by getBundle."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.service = FakeBlobService(delay=0.3)
+        self.service.put('runs/1/run.txt', "program: programs/p.zip\ninput: data/input.zip\n", '"r1"')
+        self.service.put('programs/p.zip', make_zip({'metadata': "command: python score.py\n"}), '"p1"')
+        self.service.put('data/input.zip', make_zip({'metadata': "ref: data/ref.zip\nres: data/res.zip\n"}), '"i1"')
+        self.service.put('data/ref.zip', make_zip({'truth.txt': "1\n"}), '"d1"')
+        self.service.put('data/res.zip', make_zip({'answer.txt': "1\n"}), '"d2"')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def concurrent_fetch_test(self):
+        """Independent bundles are staged at the same time and timed one by one."""
+        timings = {}
+        start = time.time()
+        bundles = getBundle(self.tmp, self.service, 'bundles', 'runs/1/run.txt', 'run', timings=timings)
+        elapsed = time.time() - start
+        # Three levels of dependencies: run, then program and input, then ref and res.
+        self.assertTrue(elapsed < 5 * 0.3, elapsed)
+        expected = set(['run', join('run', 'program'), join('run', 'input'),
+                        join('run', 'input', 'ref'), join('run', 'input', 'res')])
+        self.assertEqual(expected, set(bundles.keys()))
+        self.assertEqual(expected, set(timings.keys()))
+        self.assertTrue(os.path.exists(join(self.tmp, 'run', 'input', 'ref', 'truth.txt')))
+
+    def missing_bundle_test(self):
+        """A missing dependency is reported as None."""
+        self.service.put('data/input.zip', make_zip({'metadata': "ref: data/missing.zip\n"}), '"i2"')
+        bundles = getBundle(self.tmp, self.service, 'bundles', 'runs/1/run.txt', 'run')
+        self.assertEqual(None, bundles[join('run', 'input', 'ref')])
+
+    def failure_test(self):
+        """Errors staging a dependency are raised to the caller."""
+        self.service.put('data/ref.zip', "not a zip", '"d3"')
+        with self.assertRaises(Exception):
+            getBundle(self.tmp, self.service, 'bundles', 'runs/1/run.txt', 'run')
+
+# Stages a zip bundle served in chunks from a file under a cap on the address space of the
+# process. Arguments: path of the zip file, staging directory, address space cap in bytes.
+STAGE_UNDER_LIMIT_SCRIPT = """
+import os, resource, sys
+from codalabtools.compute.worker import _stage_bundle
+
+class FileBlobService(object):
+    def __init__(self, path):
+        self.path = path
+    def get_blob_properties(self, container, name):
+        return {'content-length': str(os.path.getsize(self.path))}
+    def get_blob(self, container, name, x_ms_range=None):
+        first, last = [int(x) for x in x_ms_range[len('bytes='):].split('-')]
+        with open(self.path, 'rb') as f:
+            f.seek(first)
+            return f.read(last - first + 1)
+
+resource.setrlimit(resource.RLIMIT_AS, (int(sys.argv[3]), int(sys.argv[3])))
+_stage_bundle(sys.argv[2], FileBlobService(sys.argv[1]), 'bundles', 'big.zip', os.path.join(sys.argv[2], 'big'))
+"""
+
+class StreamingDownloadTests(TestCase):
+    """Tests for the chunked download of bundles."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def chunked_download_test(self):
+        """Blobs are downloaded in ranges and their checksum verified."""
+        service = FakeBlobService()
+        content = os.urandom(1000)
+        service.put('blob.bin', content, '"e"', base64.b64encode(hashlib.md5(content).digest()))
+        path = join(self.tmp, 'blob.bin')
+        download_blob_to_file(service, 'bundles', 'blob.bin', path, chunk_size=64)
+        with open(path, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(16, len(service.downloads))
+
+    def checksum_mismatch_test(self):
+        """A Blob whose content does not match its Content-MD5 is rejected."""
+        service = FakeBlobService()
+        service.put('blob.bin', "abc", '"e"', base64.b64encode(hashlib.md5("abd").digest()))
+        with self.assertRaises(BlobChecksumError):
+            download_blob_to_file(service, 'bundles', 'blob.bin', join(self.tmp, 'blob.bin'))
+
+    def memory_bounded_test(self):
+        """A bundle larger than the memory available to the process is staged."""
+        if not hasattr(resource, 'RLIMIT_AS'):
+            raise SkipTest("Address space limits are not supported on this platform.")
+        size = 96 * 1024 * 1024
+        data_path = join(self.tmp, 'data.bin')
+        with open(data_path, 'wb') as f:
+            for _ in range(size / (1024 * 1024)):
+                f.write('x' * 1024 * 1024)
+        zip_path = join(self.tmp, 'big.zip')
+        with ZipFile(zip_path, 'w') as z:
+            z.write(data_path, 'data.bin')
+        os.remove(data_path)
+        # Address space of an idle interpreter which imported the worker, plus less than
+        # the size of the bundle.
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        probe = subprocess.Popen([sys.executable, '-c',
+                                  "import resource\nfrom codalabtools.compute import worker\n"
+                                  "print open('/proc/self/statm').read().split()[0]"],
+                                 stdout=subprocess.PIPE, env=env)
+        pages = int(probe.communicate()[0])
+        limit = pages * resource.getpagesize() + size / 2
+        process = subprocess.Popen([sys.executable, '-c', STAGE_UNDER_LIMIT_SCRIPT, zip_path, self.tmp, str(limit)],
+                                   stderr=subprocess.PIPE, env=env)
+        stderr = process.communicate()[1]
+        self.assertEqual(0, process.returncode, stderr)
+        self.assertEqual(size, os.path.getsize(join(self.tmp, 'big', 'data.bin')))
+
+class BlockUploadTests(TestCase):
+    """Tests for upload_files_to_blobs."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.blob_service = FakeBlobService()
+
+    def write(self, name, content):
+        path = join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def round_trip_test(self):
+        """Files are uploaded in blocks and committed with their Content-MD5."""
+        contents = {'run/output.zip': os.urandom(2500), 'run/stdout.txt': 'hello', 'run/stderr.txt': ''}
+        files = [(name, self.write(name.replace('/', '_'), content)) for (name, content) in contents.items()]
+        upload_files_to_blobs(self.blob_service, 'c', files, block_size=1000, max_threads=3)
+        self.assertEqual(3, len([name for (name, _) in self.blob_service.uploads if name == 'run/output.zip']))
+        for (name, content) in contents.items():
+            dest = join(self.tmp, 'downloaded')
+            properties = download_blob_to_file(self.blob_service, 'c', name, dest, chunk_size=700)
+            self.assertIn('content-md5', properties)
+            with open(dest, 'rb') as f:
+                self.assertEqual(content, f.read())
+
+    def retry_test(self):
+        """A failed block is retried on its own."""
+        path = self.write('output.zip', 'a' * 3000)
+        self.blob_service.failures[('output.zip', '000001')] = 2
+        upload_files_to_blobs(self.blob_service, 'c', [('output.zip', path)], block_size=1000, retry_wait=0)
+        self.assertEqual(5, len(self.blob_service.uploads))
+        self.assertEqual('a' * 3000, self.blob_service.blobs['output.zip'][0])
+
+    def retries_exhausted_test(self):
+        """The error is raised once the retries of a block are exhausted."""
+        path = self.write('output.zip', 'a' * 3000)
+        self.blob_service.failures[('output.zip', '000002')] = 10
+        with self.assertRaises(azure.WindowsAzureError):
+            upload_files_to_blobs(self.blob_service, 'c', [('output.zip', path)], block_size=1000,
+                                  max_retries=2, retry_wait=0)
+        self.assertNotIn('output.zip', self.blob_service.blobs)
+
+class PackingTests(TestCase):
+    """Tests for pack_tree and the upload of run results."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.output_dir = join(self.tmp, 'output')
+        self.files = {'metadata': 'exitCode: 0\n',
+                      join('scores', 'scores.txt'): 'score: 0.5\n' * 1000,
+                      join('private', 'detailed.txt'): os.urandom(3000)}
+        for (name, content) in self.files.items():
+            path = join(self.output_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(content)
+
+    def read_zip(self, data):
+        with ZipFile(BytesIO(data)) as z:
+            self.assertIsNone(z.testzip())
+            return dict((info.filename, (z.read(info.filename), info.compress_type)) for info in z.infolist())
+
+    def single_pass_test(self):
+        """Both archives are written in one pass; the public one leaves out the private folder."""
+        private, public = BytesIO(), BytesIO()
+        pack_tree(self.output_dir, [(private, lambda rel_path: True),
+                                    (public, lambda rel_path: not rel_path.startswith('private'))],
+                  chunk_size=1000)
+        private_members = self.read_zip(private.getvalue())
+        self.assertEqual(set(['metadata', 'scores/scores.txt', 'private/detailed.txt']), set(private_members))
+        for (name, content) in self.files.items():
+            self.assertEqual((content, ZIP_DEFLATED), private_members[name.replace(os.sep, '/')])
+        self.assertEqual(set(['metadata', 'scores/scores.txt']), set(self.read_zip(public.getvalue())))
+
+    def store_only_test(self):
+        """Level 0 stores the files without compression."""
+        stored, compressed = BytesIO(), BytesIO()
+        pack_tree(self.output_dir, [(stored, lambda rel_path: True)], compression_level=0)
+        pack_tree(self.output_dir, [(compressed, lambda rel_path: True)], compression_level=9)
+        members = self.read_zip(stored.getvalue())
+        self.assertEqual((self.files['metadata'], ZIP_STORED), members['metadata'])
+        self.assertLess(len(compressed.getvalue()), len(stored.getvalue()))
+
+    def upload_results_test(self):
+        """Archives are streamed to Blobs in blocks next to the uploaded files."""
+        blob_service = FakeBlobService()
+        stdout_file = join(self.tmp, 'stdout.txt')
+        with open(stdout_file, 'wb') as f:
+            f.write('done')
+        archives = [('run/private_output.zip', lambda rel_path: True),
+                    ('run/output.zip', lambda rel_path: rel_path.split(os.sep)[0] != 'private')]
+        _upload(blob_service, 'c', [('run/stdout.txt', stdout_file)], self.output_dir, archives)
+        self.assertEqual('done', blob_service.blobs['run/stdout.txt'][0])
+        self.assertEqual(set(['metadata', 'scores/scores.txt']),
+                         set(self.read_zip(blob_service.blobs['run/output.zip'][0])))
+        content, etag, content_md5 = blob_service.blobs['run/private_output.zip']
+        self.assertEqual(3, len(self.read_zip(content)))
+        self.assertEqual(base64.b64encode(hashlib.md5(content).digest()), content_md5)
+
+class FakeMessage(QueueMessage):
+    def __init__(self, body):
+        self.body = body
+    def get_body(self):
+        return self.body
+
+class FakeQueue(object):
+    """Queue handing out the given task ids, then stopping the worker."""
+    def __init__(self, task_ids):
+        self.task_ids = list(task_ids)
+        self.worker = None
+        self.receive_count = 0
+
+    def receive_message(self):
+        self.receive_count += 1
+        if len(self.task_ids) == 0:
+            self.worker.stop()
+            return None
+        task_id = self.task_ids.pop(0)
+        return FakeMessage(json.dumps({'id': task_id, 'task_type': 'run', 'task_args': {}}))
+
+class BaseWorkerSlotsTests(TestCase):
+    """Tests for the execution slots of BaseWorker."""
+
+    def concurrent_slots_test(self):
+        """Tasks run in parallel up to the number of slots."""
+        queue = FakeQueue(range(6))
+        lock = threading.Lock()
+        release = threading.Event()
+        state = {'running': 0, 'max_running': 0, 'done': 0}
+
+        def run(task_id, task_args):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'], state['running'])
+                if state['running'] == 3:
+                    release.set()
+            release.wait(5)
+            with lock:
+                state['running'] -= 1
+                state['done'] += 1
+
+        worker = BaseWorker(queue, {'run': run}, logging.getLogger('codalabtools'), slots=3)
+        queue.worker = worker
+        worker.start()
+        for _ in range(50):
+            with lock:
+                if state['done'] == 6:
+                    break
+            time.sleep(0.1)
+        self.assertEqual(6, state['done'])
+        self.assertEqual(3, state['max_running'])
+        # 6 tasks plus the empty receive which stopped the worker.
+        self.assertEqual(7, queue.receive_count)
+
+    def single_slot_test(self):
+        """With one slot, tasks run on the calling thread."""
+        queue = FakeQueue(range(2))
+        threads = []
+        worker = BaseWorker(queue, {'run': lambda i, a: threads.append(threading.current_thread())},
+                            logging.getLogger('codalabtools'))
+        queue.worker = worker
+        worker.start()
+        self.assertEqual([threading.current_thread()] * 2, threads)
+
+
+class SupervisorTests(TestCase):
+    """Tests for run_supervised."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def run_python(self, code, limits):
+        with open(join(self.tmp, 'out'), 'wb') as out, open(join(self.tmp, 'err'), 'wb') as err:
+            return run_supervised([sys.executable, '-c', code], self.tmp, out, err, limits)
+
+    def exit_code_test(self):
+        """Reports the exit code and resource usage of the program."""
+        result = self.run_python("import sys; open('x', 'w').write('a'); sys.exit(3)", RunLimits(time_limit=30))
+        self.assertEqual(3, result.exit_code)
+        self.assertIsNone(result.limit_exceeded)
+        self.assertTrue(os.path.exists(join(self.tmp, 'x')))
+        if POSIX:
+            self.assertGreater(result.max_rss, 0)
+            self.assertGreaterEqual(result.cpu_time, 0)
+
+    def own_session_test(self):
+        """The program is executed directly, as the leader of a new session."""
+        if not POSIX:
+            raise SkipTest("Process groups are only used on POSIX systems.")
+        result = self.run_python("import os, sys; sys.exit(0 if os.getsid(0) == os.getpid() else 1)",
+                                 RunLimits(time_limit=30))
+        self.assertEqual(0, result.exit_code)
+
+    def missing_program_test(self):
+        """A program which cannot be executed is reported in its standard error."""
+        if not POSIX:
+            raise SkipTest("The launcher is only used on POSIX systems.")
+        with open(join(self.tmp, 'out'), 'wb') as out, open(join(self.tmp, 'err'), 'wb') as err:
+            result = run_supervised([join(self.tmp, 'missing')], self.tmp, out, err, RunLimits(time_limit=30))
+        self.assertEqual(127, result.exit_code)
+        self.assertIn("Unable to run", open(join(self.tmp, 'err')).read())
+
+    def timeout_kills_group_test(self):
+        """A program over its time limit is killed with the processes it started."""
+        if not POSIX:
+            raise SkipTest("Process groups are only used on POSIX systems.")
+        code = ("import subprocess, sys, time\n"
+                "child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])\n"
+                "open('child.pid', 'w').write(str(child.pid))\n"
+                "time.sleep(60)\n")
+        start = time.time()
+        result = self.run_python(code, RunLimits(time_limit=1))
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(-1, result.exit_code)
+        self.assertEqual('time', result.limit_exceeded)
+        child_pid = int(open(join(self.tmp, 'child.pid')).read())
+        # The orphaned child is reaped by init once killed.
+        for _ in range(50):
+            if not os.path.exists('/proc/%d' % child_pid) or \
+                    open('/proc/%d/stat' % child_pid).read().split()[2] == 'Z':
+                break
+            time.sleep(0.1)
+        else:
+            self.fail("Child process survived the time limit.")
+
+    def cpu_limit_test(self):
+        """A program using more CPU than allowed is stopped."""
+        if not POSIX:
+            raise SkipTest("Resource limits are only applied on POSIX systems.")
+        result = self.run_python("while True: pass", RunLimits(time_limit=30, cpu_time_limit=1))
+        self.assertEqual('cpu', result.limit_exceeded)
+        self.assertGreaterEqual(result.cpu_time, 0.9)
+
+    def output_limit_test(self):
+        """A program writing more than allowed to its standard output is stopped."""
+        if not POSIX:
+            raise SkipTest("Resource limits are only applied on POSIX systems.")
+        with open(join(self.tmp, 'out'), 'wb') as out, open(join(self.tmp, 'err'), 'wb') as err:
+            result = run_supervised(['head', '-c', '4000000', '/dev/zero'], self.tmp, out, err,
+                                    RunLimits(time_limit=30, output_size_limit=1024 * 1024))
+        self.assertEqual('output', result.limit_exceeded)
+        self.assertLessEqual(os.path.getsize(join(self.tmp, 'out')), 1024 * 1024)
+
+
+class LeasedMessage(FakeMessage):
+    """Message recording the calls to its lease methods."""
+    def __init__(self, body):
+        FakeMessage.__init__(self, body)
+        self.events = []
+    def complete(self):
+        self.events.append('complete')
+    def abandon(self):
+        self.events.append('abandon')
+    def renew_lease(self):
+        self.events.append('renew')
+
+class LeasedQueue(FakeQueue):
+    """Queue handing out leased messages in batches."""
+    lease_renewal_interval = 0.05
+
+    def __init__(self, task_ids):
+        FakeQueue.__init__(self, task_ids)
+        self.batches = []
+        self.messages = []
+
+    def receive_messages(self, max_count):
+        self.receive_count += 1
+        batch = []
+        while len(self.task_ids) > 0 and len(batch) < max_count:
+            task_id = self.task_ids.pop(0)
+            batch.append(LeasedMessage(json.dumps({'id': task_id, 'task_type': 'run', 'task_args': {}})))
+        if len(batch) == 0:
+            self.worker.stop()
+        self.batches.append(len(batch))
+        self.messages.extend(batch)
+        return batch
+
+class BaseWorkerLeaseTests(TestCase):
+    """Tests for the lease handling and the batches of BaseWorker."""
+
+    def batch_test(self):
+        """With one slot, the messages of a batch run in order and are completed one by one."""
+        queue = LeasedQueue(range(5))
+        done = []
+        worker = BaseWorker(queue, {'run': lambda i, a: done.append(i)}, logging.getLogger('codalabtools'),
+                            batch_size=3)
+        queue.worker = worker
+        worker.start()
+        self.assertEqual(range(5), done)
+        self.assertEqual([3, 2, 0], queue.batches)
+        self.assertEqual([['complete']] * 5, [msg.events for msg in queue.messages])
+
+    def renewed_while_running_test(self):
+        """The lease of a message is renewed until its task is done, failed tasks included."""
+        queue = LeasedQueue(range(1))
+        def run(task_id, task_args):
+            time.sleep(0.3)
+            raise Exception("failed")
+        worker = BaseWorker(queue, {'run': run}, logging.getLogger('codalabtools'), batch_size=2)
+        queue.worker = worker
+        worker.start()
+        events = queue.messages[0].events
+        self.assertEqual('complete', events[-1])
+        self.assertGreaterEqual(events.count('renew'), 2)
+        renewals = len(events)
+        time.sleep(0.2)
+        self.assertEqual(renewals, len(events))
+
+    def stop_abandons_batch_test(self):
+        """Messages of a batch which have not started when the worker stops are abandoned."""
+        queue = LeasedQueue(range(3))
+        worker = BaseWorker(queue, {'run': lambda i, a: worker.stop()}, logging.getLogger('codalabtools'),
+                            batch_size=3)
+        queue.worker = worker
+        worker.start()
+        self.assertEqual([['complete'], ['abandon'], ['abandon']], [msg.events for msg in queue.messages])
+
+    def slots_limit_batch_test(self):
+        """No more messages are received than there are free slots."""
+        queue = LeasedQueue(range(4))
+        release = threading.Event()
+        done = []
+        def run(task_id, task_args):
+            release.wait(5)
+            done.append(task_id)
+        worker = BaseWorker(queue, {'run': run}, logging.getLogger('codalabtools'), slots=2, batch_size=4)
+        queue.worker = worker
+        thread = threading.Thread(target=worker.start)
+        thread.start()
+        time.sleep(0.3)
+        self.assertEqual([2], queue.batches)
+        release.set()
+        thread.join(5)
+        for _ in range(50):
+            if len(done) == 4:
+                break
+            time.sleep(0.1)
+        self.assertEqual(range(4), sorted(done))
+
+class FakeServiceBusService(object):
+    """Stand-in for azure.servicebus.ServiceBusService handing out peek-locked messages."""
+    def __init__(self, bodies, failures=0):
+        self.bodies = list(bodies)
+        self.failures = failures
+        self.calls = []
+        self.requests = []
+
+    def receive_queue_message(self, name, peek_lock=True, timeout=60):
+        self.calls.append(('receive', peek_lock, timeout))
+        if self.failures > 0:
+            self.failures -= 1
+            raise azure.WindowsAzureError("transient")
+        if len(self.bodies) == 0:
+            return Message(None, self)
+        seq = len(self.calls)
+        location = 'https://ns.servicebus.windows.net/%s/messages/%d/token%d' % (name, seq, seq)
+        return Message(self.bodies.pop(0), self, location, broker_properties={'SequenceNumber': seq,
+                                                                                'LockToken': 'token%d' % seq})
+
+    def delete_queue_message(self, name, seq, token):
+        self.calls.append(('delete', name, seq, token))
+
+    def unlock_queue_message(self, name, seq, token):
+        self.calls.append(('unlock', name, seq, token))
+
+    def _get_host(self):
+        return 'ns.servicebus.windows.net'
+
+    def _update_service_bus_header(self, request):
+        return request.headers
+
+    def _perform_request(self, request):
+        self.requests.append((request.method, request.path))
+
+class AzureServiceBusQueueTests(TestCase):
+    """Tests for AzureServiceBusQueue with peek-locked messages."""
+
+    def queue(self, service):
+        queue = AzureServiceBusQueue('ns', 'key', 'owner', 'q')
+        queue.service = service
+        queue.wait = lambda count: 0
+        return queue
+
+    def lease_test(self):
+        """Messages are peek-locked, renewed with a POST to their lock, deleted when completed."""
+        service = FakeServiceBusService(['a', 'b'])
+        queue = self.queue(service)
+        msgs = queue.receive_messages(5)
+        self.assertEqual(['a', 'b'], [msg.get_body() for msg in msgs])
+        self.assertEqual([('receive', True, 60), ('receive', True, 1), ('receive', True, 1)], service.calls)
+        msgs[0].renew_lease()
+        self.assertEqual([('POST', '/q/messages/1/token1')], service.requests)
+        msgs[0].complete()
+        msgs[1].abandon()
+        self.assertEqual([('delete', 'q', 1, 'token1'), ('unlock', 'q', 2, 'token2')], service.calls[3:])
+        self.assertIs(queue, msgs[0].get_queue())
+
+    def retry_test(self):
+        """Failed requests are retried up to max_retries times."""
+        service = FakeServiceBusService(['a'], failures=3)
+        self.assertEqual('a', self.queue(service).receive_message().get_body())
+        service = FakeServiceBusService(['a'], failures=4)
+        with self.assertRaises(azure.WindowsAzureError):
+            self.queue(service).receive_message()
+
+class SQLiteQueueTests(TestCase):
+    """Tests for SQLiteQueue."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = join(self.root, 'queues.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def queue(self, name='q', **kwargs):
+        queue = SQLiteQueue(self.path, name, **kwargs)
+        queue.polling_timeout = 0
+        return queue
+
+    def fifo_test(self):
+        """Messages are received in order, in batches, and queues do not share messages."""
+        queue = self.queue()
+        for body in ('a', 'b', 'c'):
+            queue.send_message(body)
+        self.queue('other').send_message('x')
+        self.assertEqual(['a', 'b'], [msg.get_body() for msg in queue.receive_messages(2)])
+        self.assertEqual('c', queue.receive_message().get_body())
+        self.assertIsNone(queue.receive_message())
+        self.assertEqual('x', self.queue('other').receive_message().get_body())
+
+    def lease_test(self):
+        """A leased message is hidden until completed, abandoned or its visibility timeout expires."""
+        queue = self.queue(visibility_timeout=0.2)
+        queue.send_message('a')
+        msg = queue.receive_message()
+        self.assertIsNone(queue.receive_message())
+        msg.abandon()
+        msg = queue.receive_message()
+        self.assertEqual(2, msg.delivery_count)
+        time.sleep(0.3)
+        redelivered = queue.receive_message()
+        self.assertEqual('a', redelivered.get_body())
+        # The first lease is lost: completing it leaves the message in place.
+        msg.complete()
+        self.assertEqual(1, queue.count())
+        redelivered.renew_lease()
+        time.sleep(0.1)
+        redelivered.renew_lease()
+        time.sleep(0.15)
+        self.assertIsNone(queue.receive_message())
+        redelivered.complete()
+        self.assertEqual(0, queue.count())
+
+    def durable_test(self):
+        """Messages survive the queue object and are dead-lettered after max_deliveries."""
+        self.queue(max_deliveries=2).send_message('a')
+        for _ in range(2):
+            self.queue(max_deliveries=2).receive_message().abandon()
+        queue = self.queue(max_deliveries=2)
+        self.assertIsNone(queue.receive_message())
+        self.assertEqual(0, queue.count())
+
+    def worker_test(self):
+        """BaseWorker processes the messages of a SQLiteQueue and completes them."""
+        queue = self.queue()
+        for i in range(5):
+            queue.send_message(json.dumps({'id': i, 'task_type': 'run', 'task_args': {}}))
+        done = []
+        def run(task_id, task_args):
+            done.append(task_id)
+            if len(done) == 5:
+                worker.stop()
+        worker = BaseWorker(queue, {'run': run}, logging.getLogger('test'), batch_size=2)
+        worker.start()
+        self.assertEqual(range(5), sorted(done))
+        self.assertEqual(0, queue.count())
+
+class LocalBlobServiceTests(TestCase):
+    """Tests for LocalBlobService."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.service = LocalBlobService(join(self.root, 'blobs'))
+
+    def round_trip_test(self):
+        """Blobs uploaded in blocks are read back in ranges with their Content-MD5."""
+        content = os.urandom(2500)
+        path = join(self.root, 'output.zip')
+        with open(path, 'wb') as f:
+            f.write(content)
+        upload_files_to_blobs(self.service, 'c', [('run/output.zip', path)], block_size=1000)
+        dest = join(self.root, 'downloaded')
+        properties = download_blob_to_file(self.service, 'c', 'run/output.zip', dest, chunk_size=700)
+        self.assertEqual('2500', properties['content-length'])
+        with open(dest, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertEqual(content[2000:], self.service.get_blob('c', 'run/output.zip', x_ms_range='bytes=2000-9999'))
+        with self.assertRaises(azure.WindowsAzureError):
+            self.service.get_blob('c', 'run/output.zip', x_ms_range='bytes=2500-2600')
+
+    def blocks_test(self):
+        """Blocks are invisible until committed and a commit replaces the Blob and its metadata."""
+        self.service.put_blob('c', 'a.txt', 'old', 'BlockBlob', x_ms_meta_name_values={'name': 'a.txt'})
+        etag = self.service.get_blob_properties('c', 'a.txt')['etag']
+        self.service.put_block('c', 'a.txt', 'new ', '1')
+        self.service.put_block('c', 'a.txt', 'data', '2')
+        self.assertEqual('old', self.service.get_blob('c', 'a.txt'))
+        self.service.put_block_list('c', 'a.txt', ['1', '2'], x_ms_blob_content_type='text/plain',
+                                    x_ms_meta_name_values={'Name': 'b.txt'})
+        properties = self.service.get_blob_properties('c', 'a.txt')
+        self.assertEqual('new data', self.service.get_blob('c', 'a.txt'))
+        self.assertEqual('b.txt', properties['x-ms-meta-name'])
+        self.assertEqual('text/plain', properties['content-type'])
+        self.assertNotEqual(etag, properties['etag'])
+        with self.assertRaises(azure.WindowsAzureError):
+            self.service.put_block_list('c', 'a.txt', ['1'])
+
+    def list_delete_test(self):
+        """Blobs are listed by prefix; missing Blobs raise WindowsAzureMissingResourceError."""
+        for name in ('x/1.zip', 'x/2.zip', 'y/1.zip'):
+            self.service.put_blob('c', name, name, 'BlockBlob')
+        self.assertEqual(['x/1.zip', 'x/2.zip'], [blob.name for blob in self.service.list_blobs('c', 'x/')])
+        self.service.delete_blob('c', 'x/1.zip')
+        with self.assertRaises(azure.WindowsAzureMissingResourceError):
+            self.service.get_blob_properties('c', 'x/1.zip')
+        with self.assertRaises(azure.WindowsAzureMissingResourceError):
+            self.service.get_blob('c', 'x/1.zip')
+        with self.assertRaises(azure.WindowsAzureError):
+            self.service.put_blob('c', '../escape', '', 'BlockBlob')
+
+    def names_confined_test(self):
+        """Container and Blob names cannot reach outside of the storage directory."""
+        for (container_name, blob_name) in (('..', 'escape'), ('c/..', 'escape'), ('C', 'a.txt')):
+            with self.assertRaises(azure.WindowsAzureError):
+                self.service.put_blob(container_name, blob_name, '', 'BlockBlob')
+        with self.assertRaises(azure.WindowsAzureError):
+            self.service.list_blobs('..')
+        if hasattr(os, 'symlink'):
+            os.makedirs(join(self.root, 'blobs', 'blobs', 'c'))
+            os.symlink(self.root, join(self.root, 'blobs', 'blobs', 'c', 'link'))
+            with self.assertRaises(azure.WindowsAzureError):
+                self.service.put_blob('c', 'link/escape', '', 'BlockBlob')
+            self.assertFalse(os.path.exists(join(self.root, 'escape')))
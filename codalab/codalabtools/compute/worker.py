@@ -10,10 +10,11 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import yaml
+from multiprocessing.pool import ThreadPool
 from os.path import dirname, abspath, join
-from subprocess import Popen, PIPE
 from zipfile import ZipFile
 
 
@@ -22,7 +23,12 @@ sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
 
 from azure.storage import BlobService
 from codalabtools import BaseWorker, BaseConfig
-from codalabtools.azure_extensions import AzureServiceBusQueue
+from codalabtools.azure_extensions import AzureServiceBusQueue, AzureServiceBusTopic, BlobUploader, download_blob_to_file
+from codalabtools.compute.bundle_cache import BundleCache, bundle_cache_key, _tree_size
+from codalabtools.compute.packing import pack_tree
+from codalabtools.compute.supervisor import RunLimits, run_supervised
+from codalabtools.local_queue import SQLiteQueue
+from codalabtools.local_storage import LocalBlobService
 
 logger = logging.getLogger('codalabtools')
 
@@ -65,15 +71,126 @@ class WorkerConfig(BaseConfig):
         """Gets the name of the Azure Service Bus queue to listen to."""
         return self._winfo['azure-service-bus']['listen-to']
 
+    def getLocalQueuePath(self):
+        """
+        Gets the path of the SQLite database replacing Azure Service Bus or None if the
+        worker uses Service Bus.
+        """
+        if 'local-queue' in self._winfo:
+            return self._winfo['local-queue']['path']
+        return None
+
+    def getLocalQueueVisibilityTimeout(self):
+        """Gets how long, in seconds, a received message stays leased (default: 60)."""
+        return self._winfo['local-queue'].get('visibility-timeout', 60)
+
+    def getLocalStoragePath(self):
+        """
+        Gets the path of the local directory replacing Azure Storage or None if the worker
+        uses Azure Storage.
+        """
+        if 'local-storage' in self._winfo:
+            return self._winfo['local-storage']['path']
+        return None
+
     def getLocalRoot(self):
         """Gets the path for the local directory where files are staged or None if the path is not provided."""
         return self._winfo['local-root'] if 'local-root' in self._winfo else None
 
-def getBundle(root_path, blob_service, container, bundle_id, bundle_rel_path, max_depth=3):
+    def getSlotCount(self):
+        """Gets the number of runs the worker executes at the same time (default: 1)."""
+        return self._winfo.get('slots', 1)
+
+    def getFetchThreadCount(self):
+        """Gets the number of bundles staged at the same time for a run (default: 4)."""
+        return self._winfo.get('fetch-threads', 4)
+
+    def getUploadThreadCount(self):
+        """Gets the number of blocks of run results uploaded at the same time (default: 4)."""
+        return self._winfo.get('upload-threads', 4)
+
+    def getBundleCachePath(self):
+        """Gets the path of the local bundle cache or None if bundles are not cached."""
+        if 'bundle-cache' in self._winfo:
+            return self._winfo['bundle-cache']['path']
+        return None
+
+    def getBundleCacheMaxSize(self):
+        """Gets the size budget of the local bundle cache in bytes (default: 10 GB)."""
+        size_mb = 10 * 1024
+        if 'bundle-cache' in self._winfo:
+            size_mb = self._winfo['bundle-cache'].get('max-size-mb', size_mb)
+        return size_mb * 1024 * 1024
+
+    def getPhaseAssetsTopic(self):
+        """
+        Gets the name of the Azure Service Bus topic announcing the assets of active phases
+        or None if the worker does not pre-stage phase assets.
+        """
+        if 'phase-assets' in self._winfo:
+            return self._winfo['phase-assets']['topic']
+        return None
+
+    def getPhaseAssetsSubscription(self):
+        """Gets the name of the subscription of the worker to the phase assets topic."""
+        return self._winfo['phase-assets']['subscription']
+
+    def getPhaseAssetsPinHours(self):
+        """
+        Gets how long, in hours, pre-staged assets are kept when the end of their phase is
+        not known (default: 24).
+        """
+        return self._winfo['phase-assets'].get('pin-hours', 24)
+
+    def getRunLimits(self):
+        """
+        Gets the default limits enforced on programs as a dictionary with the keys
+        'cpu_time_limit' (seconds), 'memory_limit' and 'output_size_limit' (bytes). Limits
+        which are not configured are None.
+        """
+        limits = self._winfo.get('limits', {})
+        def megabytes(name):
+            return limits[name] * 1024 * 1024 if name in limits else None
+        return {'cpu_time_limit': limits.get('cpu-time'),
+                'memory_limit': megabytes('memory-mb'),
+                'output_size_limit': megabytes('output-mb')}
+
+def _stage_bundle(root_path, blob_service, container, bundle_id, bundle_path, properties=None):
+    """
+    Downloads a bundle and stages it in the given directory: zip bundles are extracted,
+    other bundles are saved as the 'metadata' file of the directory. The Blob is streamed to
+    disk in chunks and zip bundles are extracted from the spooled file, so memory use does
+    not depend on the size of the bundle.
+
+    properties: Properties of the Blob if they are already known.
+    """
+    bundle_ext = os.path.splitext(bundle_id)[1]
+    if bundle_ext == '.zip':
+        fd, bundle_file = tempfile.mkstemp(prefix='tmp', suffix=bundle_ext, dir=root_path)
+        os.close(fd)
+        try:
+            download_blob_to_file(blob_service, container, bundle_id, bundle_file, properties=properties)
+            with ZipFile(bundle_file, 'r') as z:
+                z.extractall(bundle_path)
+        finally:
+            os.remove(bundle_file)
+    else:
+        if not os.path.exists(bundle_path):
+            os.mkdir(bundle_path)
+        download_blob_to_file(blob_service, container, bundle_id, join(bundle_path, 'metadata'),
+                              properties=properties)
+
+def getBundle(root_path, blob_service, container, bundle_id, bundle_rel_path, max_depth=3, cache=None,
+              cached_bundles=(), max_threads=4, timings=None):
     """
     Gets a bundle and its dependent bundles from Azure storage and stage them on the local
-    system to prepare for execution. The function is recursive but depth of recursion can
-    be controlled with the max_depth parameter.
+    system to prepare for execution. The depth of the dependency tree can be controlled with
+    the max_depth parameter.
+
+    Dependencies are only known once the metadata of the bundle referencing them is staged.
+    As soon as a bundle is staged, its dependencies are queued on a pool of threads, so that
+    independent bundles (e.g. program, input and reference data) are downloaded and extracted
+    concurrently.
 
     root_path: Path of the local directory under which all files are staged for execution.
     blob_service: Azure BlobService to access the storage account holding the bundles.
@@ -87,56 +204,136 @@ def getBundle(root_path, blob_service, container, bundle_id, bundle_rel_path, ma
         program bundle will be located at 'C:\\tmp123\\run\\program'.
     max_depth: An optional argument to limit the depth of recursion when resolving bundle
         dependencies.
+    cache: An optional BundleCache. The zip bundles listed in cached_bundles are then staged
+        from the cache when their content did not change instead of being downloaded and
+        extracted again.
+    cached_bundles: IDs of the bundles which may be staged through the cache: the competition
+        assets of the phase. Bundles of participants (submissions, results) are always
+        downloaded.
+    max_threads: Maximum number of bundles staged at the same time.
+    timings: An optional dictionary which receives the time in seconds spent staging each
+        bundle, keyed by the relative path of the bundle.
 
     Return value: A dictionary where each key denotes the relative path of a bundle which
         was staged. The value associated with a key is a dictionary representing the bundle's
         metadata. The value may be None if a metadata file was not found. For a valid run,
         the set of keys should contain at the minimum: 'run', 'run\\program' and 'run\\input'.
     """
-
-    def getThem(bundle_id, bundle_rel_path, bundles, depth):
-        """Recursively gets the bundles."""
-        # download the bundle and save it to a temporary location
-        try:
-            blob = blob_service.get_blob(container, bundle_id)
-        except azure.WindowsAzureMissingResourceError:
-            #file not found lets None this bundle
-            bundles[bundle_rel_path] = None
-            return bundles
-
-        bundle_ext = os.path.splitext(bundle_id)[1]
-        bundle_file = tempfile.NamedTemporaryFile(prefix='tmp', suffix=bundle_ext, dir=root_path, delete=False)
-
-        #take our temp file and write whatever is it form the blob
-        with open(bundle_file.name, 'wb') as f:
-            f.write(blob)
+    bundles = {}
+    errors = []
+    pending = [0]
+    done = threading.Condition()
+    pool = ThreadPool(max(1, max_threads))
+
+    def stage(bundle_id, bundle_path):
+        """Stages a bundle, through the cache when possible."""
+        properties = blob_service.get_blob_properties(container, bundle_id)
+        if cache is not None and bundle_id in cached_bundles and os.path.splitext(bundle_id)[1] == '.zip':
+            key = bundle_cache_key(bundle_id, properties)
+            if key is not None:
+                fetch = lambda path: _stage_bundle(root_path, blob_service, container, bundle_id, path, properties)
+                cache.stage(key, fetch, bundle_path)
+                return
+        _stage_bundle(root_path, blob_service, container, bundle_id, bundle_path, properties)
+
+    def getIt(bundle_id, bundle_rel_path, depth):
+        """Stages a bundle and queues the bundles it references."""
         # stage the bundle directory
         bundle_path = join(root_path, bundle_rel_path)
         metadata_path = join(bundle_path, 'metadata')
+        start = time.time()
+        try:
+            stage(bundle_id, bundle_path)
+        except azure.WindowsAzureMissingResourceError:
+            #file not found lets None this bundle
+            with done:
+                bundles[bundle_rel_path] = None
+            return
+        elapsed = time.time() - start
+        logger.debug("Staged bundle %s in %.2f seconds.", bundle_rel_path, elapsed)
 
-        if bundle_ext == '.zip':
-            with ZipFile(bundle_file.file, 'r') as z:
-                z.extractall(bundle_path)
-        else:
-            os.mkdir(bundle_path)
-            shutil.copyfile(bundle_file.name, metadata_path)
         # read the metadata if it exists
         bundle_info = None
         if os.path.exists(metadata_path):
             with open(metadata_path) as mf:
                 bundle_info = yaml.load(mf)
-        bundles[bundle_rel_path] = bundle_info
+        with done:
+            bundles[bundle_rel_path] = bundle_info
+            if timings is not None:
+                timings[bundle_rel_path] = elapsed
         # get referenced bundles
 
         if (bundle_info is not None) and (depth < max_depth):
             for (k, v) in bundle_info.items():
-                if k not in ("description", "command", "exitCode", "elapsedTime", "stdout", "stderr", "submitted-by", "submitted-at"):
+                if k not in ("description", "command", "exitCode", "elapsedTime", "cpuTime", "maxRss", "outputSize", "limitExceeded", "stdout", "stderr", "submitted-by", "submitted-at"):
                     if isinstance(v, str):
-                        getThem(v, join(bundle_rel_path, k), bundles, depth + 1)
+                        submit(v, join(bundle_rel_path, k), depth + 1)
 
-        return bundles
+    def run(bundle_id, bundle_rel_path, depth):
+        """Runs getIt on a pool thread and records failures."""
+        try:
+            getIt(bundle_id, bundle_rel_path, depth)
+        except Exception as e:
+            logger.exception("Failed to stage bundle %s", bundle_rel_path)
+            with done:
+                errors.append(e)
+        finally:
+            with done:
+                pending[0] -= 1
+                done.notify_all()
+
+    def submit(bundle_id, bundle_rel_path, depth):
+        with done:
+            pending[0] += 1
+        pool.apply_async(run, (bundle_id, bundle_rel_path, depth))
+
+    try:
+        submit(bundle_id, bundle_rel_path, 0)
+        with done:
+            while pending[0] > 0:
+                # wait with a timeout so the calling thread can be interrupted
+                done.wait(1.0)
+    finally:
+        pool.close()
+        pool.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return bundles
+
+def prestageBundles(root_path, blob_service, container, bundle_ids, cache, keep_until=None):
+    """
+    Stages bundles into the bundle cache ahead of the runs which use them, so that these runs
+    find them in the cache. Only zip bundles are cached; other bundles are skipped.
 
-    return getThem(bundle_id, bundle_rel_path, {}, 0)
+    root_path: Path of the local directory where bundles are downloaded before extraction.
+    blob_service: Azure BlobService to access the storage account holding the bundles.
+    container: Name of Blob container holding the bundles in the specified storage account.
+    bundle_ids: IDs of the bundles to stage. See getBundle.
+    cache: BundleCache receiving the bundles.
+    keep_until: Time, in seconds since the epoch, until which the bundles are pinned in the
+        cache, or None to leave them subject to eviction.
+
+    Returns the number of bundles which were not already cached.
+    """
+    staged = 0
+    for bundle_id in bundle_ids:
+        if os.path.splitext(bundle_id)[1] != '.zip':
+            logger.debug("Not pre-staging bundle %s: only zip bundles are cached.", bundle_id)
+            continue
+        try:
+            properties = blob_service.get_blob_properties(container, bundle_id)
+        except azure.WindowsAzureMissingResourceError:
+            logger.warning("Not pre-staging bundle %s: the Blob does not exist.", bundle_id)
+            continue
+        key = bundle_cache_key(bundle_id, properties)
+        if key is None:
+            continue
+        fetch = lambda path: _stage_bundle(root_path, blob_service, container, bundle_id, path, properties)
+        if not cache.stage(key, fetch):
+            staged += 1
+        if keep_until is not None:
+            cache.pin(key, keep_until)
+    return staged
 
 def _send_update(queue, task_id, status):
     """
@@ -151,27 +348,131 @@ def _send_update(queue, task_id, status):
                        'task_args': {'status': status}})
     queue.send_message(body)
 
-def _upload(blob_service, container, blob_id, blob_file):
+def _upload(blob_service, container, uploads, output_dir=None, archives=(), compression_level=6, max_threads=4):
     """
-    Uploads a Blob.
+    Uploads the results of a run as BlockBlobs. The files are uploaded concurrently, in
+    blocks, and the output directory is packed in a single pass into zip archives which are
+    streamed to their Blobs as they are written.
 
     blob_service: A BlobService object.
-    container: Name of the container to uplaod the Blob to.
-    blob_id: Name of the Blob relative to the container.
-    blob_file: Path of the local file to upload as a BlockBlob.
+    container: Name of the container to upload the Blobs to.
+    uploads: List of (blob_id, blob_file) pairs where blob_id is the name of the Blob
+        relative to the container and blob_file the path of the local file to upload.
+    output_dir: Path of the directory packed into the archives.
+    archives: List of (blob_id, include) pairs where include(rel_path) tells whether a file
+        of the output directory belongs to the archive uploaded to blob_id.
+    compression_level: zlib compression level of the archives, 0 to store files as they are.
+    max_threads: Number of blocks uploaded at the same time.
+    """
+    uploader = BlobUploader(blob_service, container, max_threads=max_threads)
+    try:
+        for (blob_id, blob_file) in uploads:
+            uploader.upload_file(blob_id, blob_file)
+        if len(archives) > 0:
+            pack_tree(output_dir, [(uploader.open(blob_id), include) for (blob_id, include) in archives],
+                      compression_level)
+    except:
+        uploader.close()
+        raise
+    uploader.commit()
+
+def get_bundle_cache(config):
+    """
+    Returns the BundleCache described by the configuration or None if bundles are not cached.
+
+    config: A pre-configured instance of WorkerConfig.
+    """
+    if config.getBundleCachePath() is None:
+        return None
+    return BundleCache(config.getBundleCachePath(), config.getBundleCacheMaxSize())
+
+def get_prestage_func(config, cache):
+    """
+    Returns the function to invoke in order to pre-stage the assets of a phase.
+
+    config: A pre-configured instance of WorkerConfig.
+    cache: The BundleCache shared with the runs.
+
+    Returns: The function to invoke given a Prestage task: f(task_id, task_args)
+    """
+    def prestage(task_id, task_args):
+        """
+        Stages the scoring program and reference data of a phase into the bundle cache.
+
+        task_id: The tracking ID for this task.
+        task_args: The input arguments for this task: 'container_name', 'bundles' (list of
+            bundle IDs), 'phase_id' and 'keep_until' (end of the phase in seconds since the
+            epoch, or None if it is not known).
+        """
+        keep_until = task_args.get('keep_until')
+        if keep_until is None:
+            keep_until = time.time() + config.getPhaseAssetsPinHours() * 3600
+        if keep_until <= time.time():
+            logger.info("Not pre-staging assets of phase %s: the phase has ended (task_id=%s).",
+                        task_args.get('phase_id'), task_id)
+            return
+        blob_service = get_blob_service(config)
+        start = time.time()
+        staged = prestageBundles(config.getLocalRoot(), blob_service, task_args['container_name'],
+                                 task_args['bundles'], cache, keep_until)
+        logger.info("Pre-staged %d new bundle(s) of phase %s in %.2f seconds (task_id=%s).", staged,
+                    task_args.get('phase_id'), time.time() - start, task_id)
+    return prestage
+
+def get_queue(config, name):
     """
-    with open(blob_file, 'rb') as f:
-        blob = f.read()
-        blob_service.put_blob(container, blob_id, blob, x_ms_blob_type='BlockBlob')
+    Returns the Queue with the given name: a local queue when one is configured, a Service
+    Bus queue otherwise.
 
-def get_run_func(config):
+    config: A pre-configured instance of WorkerConfig.
+    name: Name of the queue.
+    """
+    if config.getLocalQueuePath() is not None:
+        return SQLiteQueue(config.getLocalQueuePath(), name, config.getLocalQueueVisibilityTimeout())
+    return AzureServiceBusQueue(config.getAzureServiceBusNamespace(),
+                                config.getAzureServiceBusKey(),
+                                config.getAzureServiceBusIssuer(),
+                                name)
+
+def get_topic(config, name, subscription):
+    """
+    Returns a Queue receiving the messages of a subscription to a Service Bus topic. With a
+    local queue, the topic is a queue of the same name and the subscription is ignored.
+
+    config: A pre-configured instance of WorkerConfig.
+    name: Name of the topic.
+    subscription: Name of the subscription.
+    """
+    if config.getLocalQueuePath() is not None:
+        return get_queue(config, name)
+    return AzureServiceBusTopic(config.getAzureServiceBusNamespace(),
+                                config.getAzureServiceBusKey(),
+                                config.getAzureServiceBusIssuer(),
+                                name,
+                                subscription)
+
+def get_blob_service(config):
+    """
+    Returns the Blob service holding the bundles: a LocalBlobService when local storage is
+    configured, an Azure BlobService otherwise.
+
+    config: A pre-configured instance of WorkerConfig.
+    """
+    if config.getLocalStoragePath() is not None:
+        return LocalBlobService(config.getLocalStoragePath())
+    return BlobService(config.getAzureStorageAccountName(), config.getAzureStorageAccountKey())
+
+def get_run_func(config, cache=None):
     """
     Returns the function to invoke in order to do a run given the specified configuration.
 
     config: A pre-configured instance of WorkerConfig.
+    cache: The BundleCache to stage bundles through. Created from the configuration if None.
 
     Returns: The function to invoke given a Run task: f(task_id, task_args)
     """
+    if cache is None:
+        cache = get_bundle_cache(config)
 
     def run(task_id, task_args):
         """
@@ -184,21 +485,23 @@ def get_run_func(config):
         execution_time_limit = task_args['execution_time_limit']
         container = task_args['container_name']
         reply_to_queue_name = task_args['reply_to']
-        queue = AzureServiceBusQueue(config.getAzureServiceBusNamespace(),
-                                     config.getAzureServiceBusKey(),
-                                     config.getAzureServiceBusIssuer(),
-                                     reply_to_queue_name)
+        queue = get_queue(config, reply_to_queue_name)
         root_dir = None
-        current_dir = os.getcwd()
 
         try:
             _send_update(queue, task_id, 'running')
             # Create temporary directory for the run
             root_dir = tempfile.mkdtemp(dir=config.getLocalRoot())
             # Fetch and stage the bundles
-            blob_service = BlobService(config.getAzureStorageAccountName(),
-                                       config.getAzureStorageAccountKey())
-            bundles = getBundle(root_dir, blob_service, container, run_id, 'run')
+            staging_start = time.time()
+            blob_service = get_blob_service(config)
+            timings = {}
+            bundles = getBundle(root_dir, blob_service, container, run_id, 'run', cache=cache,
+                                cached_bundles=task_args.get('cached_bundles', ()),
+                                max_threads=config.getFetchThreadCount(), timings=timings)
+            logger.info("Staged %d bundles in %.2f seconds (task_id=%s): %s", len(timings),
+                        time.time() - staging_start, task_id,
+                        ", ".join("%s=%.2fs" % (k, v) for (k, v) in sorted(timings.items())))
             # Verify we have an input folder: create one if it's not in the bundle.
             input_rel_path = join('run', 'input')
             if input_rel_path not in bundles:
@@ -228,8 +531,9 @@ def get_run_func(config):
             # Report the list of folders and files staged
             #
             # Invoke custom evaluation program
+            # The program runs in its own directory. The working directory of the worker is
+            # left alone since it is shared by the runs of all slots.
             run_dir = join(root_dir, 'run')
-            os.chdir(run_dir)
             logger.debug("Execution directory: %s", run_dir)
             # Update command-line with the real paths
             logger.debug("CMD: %s", prog_cmd)
@@ -242,61 +546,67 @@ def get_run_func(config):
             logger.debug("Invoking program: %s", prog_cmd)
             stdout_file = join(run_dir, 'stdout.txt')
             stderr_file = join(run_dir, 'stderr.txt')
-            startTime = time.time()
-            exit_code = None
-            timed_out = False
+            # Limits sent with the task take precedence over the defaults of the worker.
+            limit_args = config.getRunLimits()
+            for name in limit_args:
+                if task_args.get(name) is not None:
+                    limit_args[name] = task_args[name]
+            limits = RunLimits(time_limit=execution_time_limit, **limit_args)
 
             with open(stdout_file, "wb") as out, open(stderr_file, "wb") as err:
-                evaluator_process = Popen(prog_cmd.split(' '), stdout=out, stderr=err)
-
-                while exit_code is None:
-                    exit_code = evaluator_process.poll()
-
-                    # time in seconds
-                    if exit_code is None and time.time() - startTime > execution_time_limit:
-                        evaluator_process.kill()
-                        exit_code = -1
-                        logger.info("Killed process for running too long!")
-                        err.write("Execution time limit exceeded!")
-                        timed_out = True
-                        break
-                    else:
-                        time.sleep(.1)
-
-            logger.debug("Exit Code: %d", exit_code)
-            endTime = time.time()
-            elapsedTime = endTime - startTime
+                prog_args = prog_cmd.split(' ')
+                # Executables are resolved against the directory of the worker, not cwd.
+                if prog_args[0].startswith('.' + os.path.sep):
+                    prog_args[0] = join(run_dir, prog_args[0])
+                result = run_supervised(prog_args, run_dir, out, err, limits)
+                if result.timed_out:
+                    logger.info("Killed process for running too long!")
+                    err.write("Execution time limit exceeded!")
+                elif result.limit_exceeded == 'cpu':
+                    err.write("CPU time limit exceeded!")
+
+            logger.debug("Exit Code: %d", result.exit_code)
+            output_size = _tree_size(output_dir) + os.path.getsize(stdout_file) + os.path.getsize(stderr_file)
+            if result.limit_exceeded is None and limits.output_size_limit is not None \
+                    and output_size > limits.output_size_limit:
+                result.limit_exceeded = 'output'
+            if result.limit_exceeded == 'output':
+                with open(stderr_file, "ab") as err:
+                    err.write("Output size limit exceeded!")
             prog_status = {
-                'exitCode': exit_code,
-                'elapsedTime': elapsedTime
+                'exitCode': result.exit_code,
+                'elapsedTime': result.elapsed_time,
+                'cpuTime': result.cpu_time,
+                'maxRss': result.max_rss,
+                'outputSize': output_size,
+                'limitExceeded': result.limit_exceeded
             }
             with open(join(output_dir, 'metadata'), 'w') as f:
                 f.write(yaml.dump(prog_status, default_flow_style=False))
-            # Upload stdout and stderr files
-            stdout_id = "%s/stdout.txt" % (os.path.splitext(run_id)[0])
-            _upload(blob_service, container, stdout_id, stdout_file)
-            stderr_id = "%s/stderr.txt" % (os.path.splitext(run_id)[0])
-            _upload(blob_service, container, stderr_id, stderr_file)
-
-            # check if timed out AFTER output files are written! If we exit sooner, no output is written
-            if timed_out:
-                raise Exception("Execution time limit exceeded!")
-
-            private_dir = join(output_dir, 'private')
-            if os.path.exists(private_dir):
-                logger.debug("Packing private results...")
-                private_output_file = join(root_dir, 'run', 'private_output.zip')
-                shutil.make_archive(os.path.splitext(private_output_file)[0], 'zip', output_dir)
-                private_output_id = "%s/private_output.zip" % (os.path.splitext(run_id)[0])
-                _upload(blob_service, container, private_output_id, private_output_file)
-                shutil.rmtree(private_dir)
-
-            # Pack results and send them to Blob storage
-            logger.debug("Packing results...")
-            output_file = join(root_dir, 'run', 'output.zip')
-            shutil.make_archive(os.path.splitext(output_file)[0], 'zip', output_dir)
-            output_id = "%s/output.zip" % (os.path.splitext(run_id)[0])
-            _upload(blob_service, container, output_id, output_file)
+            run_prefix = os.path.splitext(run_id)[0]
+            uploads = [("%s/stdout.txt" % run_prefix, stdout_file),
+                       ("%s/stderr.txt" % run_prefix, stderr_file)]
+
+            # check if a limit was exceeded AFTER output files are written! If we exit sooner, no output is written
+            if result.limit_exceeded is not None:
+                _upload(blob_service, container, uploads, max_threads=config.getUploadThreadCount())
+                if result.timed_out:
+                    raise Exception("Execution time limit exceeded!")
+                raise Exception("Run exceeded its %s limit." % result.limit_exceeded)
+
+            # Pack results and send them to Blob storage. The private results include the
+            # whole output directory, the public results everything but the private folder.
+            archives = []
+            if os.path.exists(join(output_dir, 'private')):
+                archives.append(("%s/private_output.zip" % run_prefix, lambda rel_path: True))
+            is_public = lambda rel_path: rel_path.split(os.sep)[0] != 'private'
+            archives.append(("%s/output.zip" % run_prefix, is_public))
+            logger.debug("Packing and uploading results...")
+            upload_start = time.time()
+            _upload(blob_service, container, uploads, output_dir, archives,
+                    task_args.get('output_compression_level', 6), config.getUploadThreadCount())
+            logger.info("Uploaded %d results in %.2f seconds (task_id=%s)", len(uploads) + len(archives),
+                        time.time() - upload_start, task_id)
 
             _send_update(queue, task_id, 'finished')
         except Exception:
@@ -307,7 +617,6 @@ def get_run_func(config):
         if root_dir is not None:
            # Try cleaning-up temporary directory
            try:
-               os.chdir(current_dir)
                shutil.rmtree(root_dir)
            except:
                logger.exception("Unable to clean-up local folder %s (task_id=%s)", root_dir, task_id)
@@ -322,17 +631,26 @@ def main():
     logging.config.dictConfig(config.getLoggerDictConfig())
 
     # queue to listen to for notifications of tasks to perform
-    queue = AzureServiceBusQueue(config.getAzureServiceBusNamespace(),
-                                 config.getAzureServiceBusKey(),
-                                 config.getAzureServiceBusIssuer(),
-                                 config.getAzureServiceBusQueue())
+    queue = get_queue(config, config.getAzureServiceBusQueue())
+    cache = get_bundle_cache(config)
     # map task type to function to accomplish the task
     vtable = {
-        'run' : get_run_func(config)
+        'run' : get_run_func(config, cache)
     }
+    # warm mode: pre-stage the assets of active phases as they are announced
+    if config.getPhaseAssetsTopic() is not None:
+        if cache is None:
+            logger.warning("Phase assets are not pre-staged because the bundle cache is not configured.")
+        else:
+            topic = get_topic(config, config.getPhaseAssetsTopic(), config.getPhaseAssetsSubscription())
+            prestager = BaseWorker(topic, {'prestage': get_prestage_func(config, cache)}, logger)
+            thread = threading.Thread(target=prestager.start)
+            thread.daemon = True
+            thread.start()
+            logger.info("Pre-staging phase assets announced on topic %s.", config.getPhaseAssetsTopic())
     # create and start the worker
-    worker = BaseWorker(queue, vtable, logger)
-    logger.info("Starting compute worker.")
+    worker = BaseWorker(queue, vtable, logger, slots=config.getSlotCount(), batch_size=config.getSlotCount())
+    logger.info("Starting compute worker with %d slot(s).", worker.slots)
     worker.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+"""
+Defines a durable Queue backed by a local SQLite database, for single node deployments and
+tests which run without Windows Azure Service Bus.
+
+Several named queues share one database file, which may be used by several processes of the
+same machine. A received message stays in the database, invisible to other receivers, until
+it is completed or its visibility timeout expires, in which case it is delivered again.
+Messages delivered more than max_deliveries times are dead-lettered: they are kept in the
+database but no longer delivered.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from codalabtools import (
+    Queue,
+    QueueMessage)
+
+logger = logging.getLogger('codalabtools')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    body TEXT NOT NULL,
+    visible_at REAL NOT NULL,
+    lease_token TEXT,
+    delivery_count INTEGER NOT NULL DEFAULT 0,
+    dead INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_visible ON messages (queue, dead, visible_at, id);
+"""
+
+class SQLiteQueueMessage(QueueMessage):
+    """
+    Implements a QueueMessage backed by a row of a SQLiteQueue database. The lease methods
+    do nothing once the lease has been lost to another receiver.
+    """
+    def __init__(self, queue, message_id, body, lease_token, delivery_count):
+        self.queue = queue
+        self.message_id = message_id
+        self.body = body
+        self.lease_token = lease_token
+        self.delivery_count = delivery_count
+    def get_body(self):
+        return self.body
+    def get_queue(self):
+        return self.queue
+    def complete(self):
+        self.queue._execute("DELETE FROM messages WHERE id = ? AND lease_token = ?",
+                            (self.message_id, self.lease_token))
+    def abandon(self):
+        self.queue._execute("UPDATE messages SET visible_at = 0, lease_token = NULL WHERE id = ? AND lease_token = ?",
+                            (self.message_id, self.lease_token))
+    def renew_lease(self):
+        self.queue._execute("UPDATE messages SET visible_at = ? WHERE id = ? AND lease_token = ?",
+                            (time.time() + self.queue.visibility_timeout, self.message_id, self.lease_token))
+
+class SQLiteQueue(Queue):
+    """
+    Implements a Queue backed by a table of a local SQLite database.
+    """
+
+    # Timeout in seconds. receive_message is blocking and returns as soon as one of two
+    # conditions occurs: a message is received or the timeout period has elapsed.
+    polling_timeout = 60
+    # Seconds between two checks for new messages while waiting.
+    polling_interval = 0.2
+
+    def __init__(self, path, name, visibility_timeout=60, max_deliveries=10):
+        """
+        path: Path of the database file. Created if it does not exist.
+        name: Name of the queue.
+        visibility_timeout: Seconds a received message stays invisible to other receivers
+            unless its lease is renewed.
+        max_deliveries: Number of deliveries after which a message is dead-lettered.
+        """
+        self.path = path
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.lease_renewal_interval = visibility_timeout / 3.0
+        self.max_deliveries = max_deliveries
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        """Returns the connection of the current thread: connections cannot be shared."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Transactions are managed explicitly.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, sql, args=()):
+        return self._connection().execute(sql, args)
+
+    def _take(self, max_count):
+        """Leases up to max_count visible messages in a single transaction."""
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("UPDATE messages SET dead = 1 WHERE queue = ? AND dead = 0 AND visible_at <= ? "
+                               "AND delivery_count >= ?", (self.name, now, self.max_deliveries))
+            rows = connection.execute("SELECT id, body, delivery_count FROM messages "
+                                      "WHERE queue = ? AND dead = 0 AND visible_at <= ? ORDER BY id LIMIT ?",
+                                      (self.name, now, max_count)).fetchall()
+            msgs = []
+            for (message_id, body, delivery_count) in rows:
+                token = uuid.uuid4().hex
+                connection.execute("UPDATE messages SET visible_at = ?, lease_token = ?, delivery_count = ? "
+                                   "WHERE id = ?", (now + self.visibility_timeout, token, delivery_count + 1,
+                                                    message_id))
+                msgs.append(SQLiteQueueMessage(self, message_id, body, token, delivery_count + 1))
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        return msgs
+
+    def receive_message(self):
+        msgs = self.receive_messages(1)
+        return msgs[0] if len(msgs) > 0 else None
+
+    def receive_messages(self, max_count):
+        deadline = time.time() + self.polling_timeout
+        while True:
+            msgs = self._take(max_count)
+            if len(msgs) > 0 or time.time() >= deadline:
+                return msgs
+            time.sleep(self.polling_interval)
+
+    def send_message(self, body):
+        self._execute("INSERT INTO messages (queue, body, visible_at) VALUES (?, ?, 0)", (self.name, body))
+
+    def count(self):
+        """Returns the number of messages of the queue which are not dead-lettered."""
+        return self._execute("SELECT COUNT(*) FROM messages WHERE queue = ? AND dead = 0", (self.name,)).fetchone()[0]
@@ -0,0 +1,244 @@
+"""
+Defines a stand-in for Windows Azure Blob storage over a local directory, for single node
+deployments and tests which run without an Azure storage account.
+
+LocalBlobService implements the subset of azure.storage.BlobService used by CodaLab with
+the same semantics: Blob properties are returned as a dictionary of lower-cased headers
+(content-length, content-md5, etag, x-ms-meta-*...), ranged reads follow the 'bytes=a-b'
+syntax of x_ms_range, and block Blobs are written with put_block followed by put_block_list,
+uncommitted blocks being invisible to readers. Missing Blobs raise
+WindowsAzureMissingResourceError.
+
+The directory holds the content of each Blob under 'blobs/<container>/<name>' and its
+properties under 'properties/<container>/<name>'. Blobs are replaced with atomic renames so
+that several processes of the same machine can share the directory.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import uuid
+from email.utils import formatdate
+from os.path import join
+
+import azure
+
+# Container names of Azure storage: lower case letters, digits and dashes.
+CONTAINER_NAME_RE = re.compile(r'^[a-z0-9-]+$')
+
+class LocalBlob(object):
+    """Item returned by LocalBlobService.list_blobs."""
+    def __init__(self, name, properties):
+        self.name = name
+        self.properties = properties
+
+class LocalBlobResult(str):
+    """Content of a Blob with its properties, like azure.storage.BlobResult."""
+    def __new__(cls, blob, properties):
+        return str.__new__(cls, blob)
+    def __init__(self, blob, properties):
+        self.properties = properties
+
+def _parse_range(x_ms_range, size):
+    """Returns the (first, last) offsets of a 'bytes=first-last' range within a Blob."""
+    match = re.match(r'^bytes=(\d+)-(\d*)$', x_ms_range)
+    if match is None:
+        raise azure.WindowsAzureError("Invalid range: %s" % x_ms_range)
+    first = int(match.group(1))
+    last = int(match.group(2)) if match.group(2) else size - 1
+    if first >= size:
+        raise azure.WindowsAzureError("The range specified is invalid for the current size of the resource.")
+    return first, min(last, size - 1)
+
+class LocalBlobService(object):
+    """
+    Stores Blobs in a local directory. Safe to use from several threads and processes.
+    """
+    def __init__(self, root_path):
+        """
+        root_path: Path of the directory holding the Blobs. Created if it does not exist.
+        """
+        self.root_path = root_path
+        for name in ('blobs', 'properties', 'blocks', 'tmp'):
+            path = join(root_path, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _check_name(self, container_name, blob_name):
+        parts = blob_name.replace('\\', '/').split('/')
+        if CONTAINER_NAME_RE.match(container_name) is None or '..' in parts or '' in parts:
+            raise azure.WindowsAzureError("Invalid Blob name: %s/%s" % (container_name, blob_name))
+
+    def _path(self, area, container_name, blob_name):
+        """Returns the path of a Blob in the given area, which must resolve under that area."""
+        self._check_name(container_name, blob_name)
+        area_path = os.path.realpath(join(self.root_path, area))
+        path = os.path.realpath(join(area_path, container_name, blob_name))
+        if not path.startswith(area_path + os.sep):
+            raise azure.WindowsAzureError("Invalid Blob name: %s/%s" % (container_name, blob_name))
+        return path
+
+    def _blob_path(self, container_name, blob_name):
+        return self._path('blobs', container_name, blob_name)
+
+    def _properties_path(self, container_name, blob_name):
+        return self._path('properties', container_name, blob_name)
+
+    def _blocks_path(self, container_name, blob_name):
+        self._check_name(container_name, blob_name)
+        key = hashlib.sha1("%s/%s" % (container_name, blob_name)).hexdigest()
+        return join(self.root_path, 'blocks', key)
+
+    def _replace(self, path, write):
+        """Atomically replaces the file at path with a file filled by write(f)."""
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another writer.
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=join(self.root_path, 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _commit(self, container_name, blob_name, write, content_type=None, content_md5=None,
+                x_ms_meta_name_values=None):
+        """Writes the content of a Blob with write(f) then its properties."""
+        path = self._blob_path(container_name, blob_name)
+        self._replace(path, write)
+        properties = {
+            'content-length': str(os.path.getsize(path)),
+            'content-type': content_type or 'application/octet-stream',
+            'etag': '"0x%s"' % uuid.uuid4().hex[:15].upper(),
+            'last-modified': formatdate(usegmt=True),
+            'x-ms-blob-type': 'BlockBlob',
+        }
+        if content_md5 is not None:
+            properties['content-md5'] = content_md5
+        for (name, value) in (x_ms_meta_name_values or {}).items():
+            properties['x-ms-meta-%s' % name.lower()] = str(value)
+        self._replace(self._properties_path(container_name, blob_name),
+                      lambda f: f.write(json.dumps(properties)))
+
+    def create_container(self, container_name, x_ms_meta_name_values=None, x_ms_blob_public_access=None,
+                         fail_on_exist=False):
+        if CONTAINER_NAME_RE.match(container_name) is None:
+            raise azure.WindowsAzureError("Invalid container name: %s" % container_name)
+        path = join(self.root_path, 'blobs', container_name)
+        if os.path.isdir(path):
+            if fail_on_exist:
+                raise azure.WindowsAzureConflictError("The specified container already exists.")
+            return False
+        os.makedirs(path)
+        return True
+
+    def list_blobs(self, container_name, prefix=None, marker=None, maxresults=None, include=None, delimiter=None):
+        if CONTAINER_NAME_RE.match(container_name) is None:
+            raise azure.WindowsAzureError("Invalid container name: %s" % container_name)
+        root = join(self.root_path, 'properties', container_name)
+        blobs = []
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            for filename in filenames:
+                name = os.path.relpath(join(dirpath, filename), root).replace('\\', '/')
+                if prefix is None or name.startswith(prefix):
+                    blobs.append(name)
+        return [LocalBlob(blob_name, self.get_blob_properties(container_name, blob_name))
+                for blob_name in sorted(blobs)]
+
+    def get_blob_properties(self, container_name, blob_name, x_ms_lease_id=None):
+        try:
+            with open(self._properties_path(container_name, blob_name)) as f:
+                return json.load(f)
+        except IOError:
+            raise azure.WindowsAzureMissingResourceError("The specified blob does not exist.")
+
+    def get_blob_metadata(self, container_name, blob_name, snapshot=None, x_ms_lease_id=None):
+        properties = self.get_blob_properties(container_name, blob_name)
+        return dict((name, value) for (name, value) in properties.items() if name.startswith('x-ms-meta-'))
+
+    def set_blob_metadata(self, container_name, blob_name, x_ms_meta_name_values=None, x_ms_lease_id=None):
+        properties = self.get_blob_properties(container_name, blob_name)
+        for name in [name for name in properties.keys() if name.startswith('x-ms-meta-')]:
+            del properties[name]
+        for (name, value) in (x_ms_meta_name_values or {}).items():
+            properties['x-ms-meta-%s' % name.lower()] = str(value)
+        self._replace(self._properties_path(container_name, blob_name),
+                      lambda f: f.write(json.dumps(properties)))
+
+    def put_blob(self, container_name, blob_name, blob, x_ms_blob_type, content_encoding=None,
+                 content_language=None, content_md5=None, cache_control=None, x_ms_blob_content_type=None,
+                 x_ms_blob_content_encoding=None, x_ms_blob_content_language=None, x_ms_blob_content_md5=None,
+                 x_ms_blob_cache_control=None, x_ms_meta_name_values=None, x_ms_lease_id=None,
+                 x_ms_blob_content_length=None, x_ms_blob_sequence_number=None):
+        if x_ms_blob_type != 'BlockBlob':
+            raise azure.WindowsAzureError("Only block Blobs are supported.")
+        blob = blob or ''
+        computed_md5 = base64.b64encode(hashlib.md5(blob).digest())
+        if content_md5 is not None and content_md5 != computed_md5:
+            raise azure.WindowsAzureError("The MD5 value specified in the request did not match the MD5 value "
+                                          "calculated by the server.")
+        self._commit(container_name, blob_name, lambda f: f.write(blob), x_ms_blob_content_type,
+                     computed_md5, x_ms_meta_name_values)
+        shutil.rmtree(self._blocks_path(container_name, blob_name), ignore_errors=True)
+
+    def get_blob(self, container_name, blob_name, snapshot=None, x_ms_range=None, x_ms_lease_id=None,
+                 x_ms_range_get_content_md5=None):
+        properties = self.get_blob_properties(container_name, blob_name)
+        try:
+            with open(self._blob_path(container_name, blob_name), 'rb') as f:
+                if x_ms_range is None:
+                    data = f.read()
+                else:
+                    first, last = _parse_range(x_ms_range, os.fstat(f.fileno()).st_size)
+                    f.seek(first)
+                    data = f.read(last - first + 1)
+        except IOError:
+            raise azure.WindowsAzureMissingResourceError("The specified blob does not exist.")
+        return LocalBlobResult(data, properties)
+
+    def delete_blob(self, container_name, blob_name, snapshot=None, x_ms_lease_id=None):
+        try:
+            os.remove(self._properties_path(container_name, blob_name))
+        except OSError:
+            raise azure.WindowsAzureMissingResourceError("The specified blob does not exist.")
+        try:
+            os.remove(self._blob_path(container_name, blob_name))
+        except OSError:
+            pass
+
+    def put_block(self, container_name, blob_name, block, blockid, content_md5=None, x_ms_lease_id=None):
+        if content_md5 is not None and content_md5 != base64.b64encode(hashlib.md5(block).digest()):
+            raise azure.WindowsAzureError("The MD5 value specified in the request did not match the MD5 value "
+                                          "calculated by the server.")
+        block_path = join(self._blocks_path(container_name, blob_name), base64.urlsafe_b64encode(blockid))
+        self._replace(block_path, lambda f: f.write(block))
+
+    def put_block_list(self, container_name, blob_name, block_list, content_md5=None, x_ms_blob_cache_control=None,
+                       x_ms_blob_content_type=None, x_ms_blob_content_encoding=None,
+                       x_ms_blob_content_language=None, x_ms_blob_content_md5=None, x_ms_meta_name_values=None,
+                       x_ms_lease_id=None):
+        blocks_path = self._blocks_path(container_name, blob_name)
+        block_paths = [join(blocks_path, base64.urlsafe_b64encode(blockid)) for blockid in block_list]
+        for path in block_paths:
+            if not os.path.exists(path):
+                raise azure.WindowsAzureError("The specified block list is invalid.")
+        def write(f):
+            for path in block_paths:
+                with open(path, 'rb') as block:
+                    shutil.copyfileobj(block, f)
+        self._commit(container_name, blob_name, write, x_ms_blob_content_type, x_ms_blob_content_md5,
+                     x_ms_meta_name_values)
+        shutil.rmtree(blocks_path, ignore_errors=True)